@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Benchmark mempool acceptance of a synthetic mempool with deep chains.
+
+Times MemPool._accept_transactions() against the original loop, which
+retried the transactions it could not yet accept until no more were
+accepted.  Transactions are built directly rather than deserialized.
+'''
+
+import argparse
+import itertools
+import os
+import time
+from random import randrange, shuffle
+
+from electrumx.lib.hash import HASHX_LEN
+from electrumx.server.mempool import MemPool, MemPoolAPI, MemPoolTx
+
+
+class StubAPI(MemPoolAPI):
+    '''Acceptance queries nothing.'''
+
+    async def height(self):
+        return 0
+
+    def cached_height(self):
+        return 0
+
+    def db_height(self):
+        return 0
+
+    def db_tip(self):
+        return bytes(32)
+
+    async def mempool_hashes(self):
+        return []
+
+    async def raw_transactions(self, hex_hashes):
+        return []
+
+    async def lookup_utxos(self, prevouts):
+        return []
+
+    async def on_mempool(self, touched, height):
+        pass
+
+
+def legacy_accept_transactions(mempool, tx_map, utxo_map, touched):
+    '''The original implementation and the loop that called it.'''
+    def accept_transactions(tx_map, utxo_map):
+        hashXs = mempool.hashXs
+        txs = mempool.txs
+
+        deferred = {}
+        unspent = set(utxo_map)
+        for tx_hash, tx in tx_map.items():
+            in_pairs = []
+            try:
+                for prevout in tx.prevouts:
+                    utxo = utxo_map.get(prevout)
+                    if not utxo:
+                        prev_hash, prev_index = prevout
+                        utxo = txs[prev_hash].out_pairs[prev_index]
+                    in_pairs.append(utxo)
+            except KeyError:
+                deferred[tx_hash] = tx
+                continue
+
+            unspent.difference_update(tx.prevouts)
+            tx.in_pairs = tuple(in_pairs)
+            tx.fee = max(0, (sum(v for _, v in tx.in_pairs) -
+                             sum(v for _, v in tx.out_pairs)))
+            txs[tx_hash] = tx
+
+            for hashX, _value in itertools.chain(tx.in_pairs, tx.out_pairs):
+                touched.add(hashX)
+                hashXs[hashX].add(tx_hash)
+
+        return deferred, {prevout: utxo_map[prevout] for prevout in unspent}
+
+    prior_count = 0
+    passes = 0
+    while tx_map and len(tx_map) != prior_count:
+        prior_count = len(tx_map)
+        tx_map, utxo_map = accept_transactions(tx_map, utxo_map)
+        passes += 1
+    return len(tx_map), passes
+
+
+def synthetic_mempool(tx_count, chain_depth, chain_fraction, address_count):
+    '''Return a (tx_map, utxo_map, parents) triple as _fetch_transactions()
+    would.  chain_fraction of the transactions are in chains of
+    chain_depth transactions each spending an output of the one before;
+    the rest spend only confirmed outputs.'''
+    hashXs = [os.urandom(HASHX_LEN) for _ in range(address_count)]
+    tx_map = {}
+    utxo_map = {}
+    parents = {}
+
+    def confirmed_prevout():
+        prevout = (os.urandom(32), randrange(4))
+        utxo_map[prevout] = (hashXs[randrange(address_count)], randrange(1, 1 << 30))
+        return prevout
+
+    def add_tx(prevouts):
+        tx_hash = os.urandom(32)
+        out_pairs = tuple((hashXs[randrange(address_count)], randrange(1, 1 << 20))
+                          for _ in range(randrange(1, 4)))
+        tx_map[tx_hash] = MemPoolTx(tuple(prevouts), None, out_pairs, 0, randrange(200, 2000))
+        return tx_hash
+
+    chained = int(tx_count * chain_fraction)
+    while len(tx_map) < chained:
+        tx_hash = add_tx([confirmed_prevout()])
+        for _ in range(min(chain_depth - 1, chained - len(tx_map))):
+            prev_hash = tx_hash
+            prevouts = [(prev_hash, 0)]
+            if randrange(4) == 0:
+                prevouts.append(confirmed_prevout())
+            tx_hash = add_tx(prevouts)
+            parents[tx_hash] = {prev_hash}
+    while len(tx_map) < tx_count:
+        add_tx([confirmed_prevout() for _ in range(randrange(1, 3))])
+
+    return tx_map, utxo_map, parents
+
+
+def ordered(tx_map, order):
+    '''The daemon returns mempool hashes in no particular order.'''
+    items = list(tx_map.items())
+    if order == 'reverse':
+        items.reverse()
+    elif order == 'random':
+        shuffle(items)
+    return dict(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--txs', type=int, default=100_000,
+                        help='mempool transaction count')
+    parser.add_argument('--chain-depth', type=int, default=500,
+                        help='transactions in each unconfirmed chain')
+    parser.add_argument('--chain-fraction', type=float, default=0.5,
+                        help='fraction of transactions in chains')
+    parser.add_argument('--addresses', type=int, default=20_000)
+    parser.add_argument('--order', choices=('forward', 'reverse', 'random'),
+                        default='random', help='order the daemon returns transactions')
+    parser.add_argument('--no-legacy', action='store_true',
+                        help='skip timing the original implementation')
+    args = parser.parse_args()
+
+    tx_map, utxo_map, parents = synthetic_mempool(args.txs, args.chain_depth,
+                                                  args.chain_fraction, args.addresses)
+    tx_map = ordered(tx_map, args.order)
+    print(f'{len(tx_map):,d} txs, {len(parents):,d} with unconfirmed parents, '
+          f'chain depth {args.chain_depth:,d}, {args.order} order')
+
+    mempool = MemPool(None, StubAPI())
+    start = time.perf_counter()
+    dropped = mempool._accept_transactions(tx_map, utxo_map, parents, set())
+    elapsed = time.perf_counter() - start
+    assert not dropped and len(mempool.txs) == len(tx_map)
+    print(f'topological: {elapsed:.2f}s')
+
+    if not args.no_legacy:
+        mempool = MemPool(None, StubAPI())
+        start = time.perf_counter()
+        dropped, passes = legacy_accept_transactions(mempool, tx_map, utxo_map, set())
+        legacy_elapsed = time.perf_counter() - start
+        assert not dropped and len(mempool.txs) == len(tx_map)
+        print(f'legacy:      {legacy_elapsed:.2f}s in {passes:,d} passes, '
+              f'{legacy_elapsed / elapsed:.1f}x slower')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Benchmark hashing of wide synthetic version 2 (rich) transactions.
+
+Times Deserializer.read_tx_and_hash() against the original quadratic
+preimage construction for transactions of increasing width.
+'''
+
+import argparse
+import os
+import time
+from random import randrange
+
+from electrumx.lib.hash import double_sha256, sha256
+from electrumx.lib.script import OpCodes
+from electrumx.lib.tx import Deserializer, Tx, TxInput, TxOutput
+from electrumx.lib.util import pack_le_int32, pack_le_uint32, pack_le_uint64
+
+
+def legacy_rich_hash(tx):
+    '''The original implementation.'''
+    inputs = b''
+    for txin in tx.inputs:
+        inputhash = b''.join((txin.prev_hash, pack_le_uint32(txin.prev_idx),
+                              sha256(txin.script), pack_le_uint32(txin.sequence)))
+        inputs = b''.join((inputs, sha256(inputhash)))
+    outputs = b''
+    for txout in tx.outputs:
+        outputhash = b''.join((pack_le_uint64(txout.value), sha256(txout.pk_script)))
+        pc = Deserializer(b'').get_state(txout.pk_script)
+        if pc:
+            outputhash = b''.join((outputhash, sha256(txout.pk_script[0:pc]),
+                                   sha256(txout.pk_script[pc:])))
+        outputs = b''.join((outputs, sha256(outputhash)))
+    return double_sha256(b''.join((
+        pack_le_uint32(tx.version), pack_le_int32(len(tx.inputs)), sha256(inputs),
+        pack_le_int32(len(tx.outputs)), sha256(outputs), pack_le_uint32(tx.locktime))))
+
+
+def wide_tx(width, state_fraction):
+    '''A version 2 transaction with width inputs and outputs.'''
+    inputs = [TxInput(os.urandom(32), randrange(4), os.urandom(107), 0xffffffff)
+              for _ in range(width)]
+    outputs = []
+    for _ in range(width):
+        script = b'\x76\xa9\x14' + os.urandom(20) + b'\x88\xac'
+        if randrange(1000) < state_fraction * 1000:
+            state = os.urandom(64)
+            script += (bytes([OpCodes.OP_RETURN]) + state
+                       + pack_le_uint32(len(state)) + b'\x00')
+        outputs.append(TxOutput(randrange(1 << 40), script))
+    return Tx(2, inputs, outputs, 0).serialize()
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--widths', default='10,100,1000,5000,20000',
+                        help='comma-separated input and output counts')
+    parser.add_argument('--state-fraction', type=float, default=0.1,
+                        help='fraction of outputs carrying a state')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-legacy', action='store_true',
+                        help='skip timing the original implementation')
+    args = parser.parse_args()
+
+    print(f'{"width":>8} {"size KB":>9} {"hash ms":>10} {"legacy ms":>10} {"speedup":>8}')
+    for width in (int(width) for width in args.widths.split(',')):
+        raw_tx = wide_tx(width, args.state_fraction)
+        (tx, tx_hash), elapsed = timed(lambda: Deserializer(raw_tx).read_tx_and_hash(),
+                                       args.repeat)
+        legacy = speedup = ''
+        if not args.no_legacy:
+            # Include the parse so the two are comparable
+            legacy_hash, legacy_elapsed = timed(
+                lambda: legacy_rich_hash(Deserializer(raw_tx).read_tx()), args.repeat)
+            assert legacy_hash == tx_hash
+            legacy = f'{legacy_elapsed * 1000:.2f}'
+            speedup = f'{legacy_elapsed / elapsed:.1f}x'
+        print(f'{width:>8,d} {len(raw_tx) / 1000:>9,.0f} {elapsed * 1000:>10.2f} '
+              f'{legacy:>10} {speedup:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -86,6 +86,17 @@ class Novo:
     CHAIN_SIZE_HEIGHT = 709_728
     AVG_BLOCK_SIZE = 150_000_000
 
+    @classmethod
+    def lookup_coin_class(cls, name, net):
+        '''Return a coin class given name and network.
+
+        Raise an exception if unrecognised.'''
+        for coin in util.subclasses(Novo, strict=False):
+            if (coin.NAME.lower() == name.lower() and
+                    coin.NET.lower() == net.lower()):
+                return coin
+        raise CoinError(f'unknown coin {name} and network {net} combination')
+
     @classmethod
     def max_fetch_blocks(cls, height):
         if height < 130000:
@@ -108,3 +119,11 @@ class Novo:
         header = raw_block[:80]
         txs = cls.DESERIALIZER(raw_block, start=len(header)).read_tx_block()
         return Block(raw_block, header, txs)
+
+    @classmethod
+    def block_records(cls, raw_block):
+        '''Return a (header, tx records) pair given a raw block, which can be a
+        memoryview.  See RecordDeserializer.read_tx_records().'''
+        header = bytes(raw_block[:80])
+        records = lib_tx.RecordDeserializer(raw_block, start=len(header)).read_tx_records()
+        return header, records
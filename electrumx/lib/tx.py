@@ -28,8 +28,9 @@
 '''Transaction-related classes and functions.'''
 
 from collections import namedtuple
+from hashlib import sha256 as _sha256
 
-from electrumx.lib.hash import double_sha256, hash_to_hex_str, sha256
+from electrumx.lib.hash import double_sha256, hash_to_hex_str
 from electrumx.lib.util import (
     unpack_le_int32_from, unpack_le_int64_from, unpack_le_uint16_from,
     unpack_be_uint16_from,
@@ -40,6 +41,7 @@ from electrumx.lib.script import OpCodes
 
 ZERO = bytes(32)
 MINUS_1 = 4294967295
+GENERATION_PREVOUT = ZERO + pack_le_uint32(MINUS_1)
 
 
 class Tx(namedtuple("Tx", "version inputs outputs locktime")):
@@ -134,34 +136,31 @@ class Deserializer(object):
 
 
     def get_richtransaction(self, tx):
-        hashInputs = self.get_hashinputs(tx)
-        hashoutputs = self.get_hashoutputs(tx)
+        '''Return the hash of a version 2 (rich) transaction.
 
+        Inputs and outputs are hashed one at a time into running hashes so
+        the cost is linear in their number.'''
         preimage = b''.join((
             pack_le_uint32(tx.version),
             pack_le_int32(len(tx.inputs)),
-            hashInputs,
+            self.get_hashinputs(tx),
             pack_le_int32(len(tx.outputs)),
-            hashoutputs,
+            self.get_hashoutputs(tx),
             pack_le_uint32(tx.locktime)
         ))
-        h = double_sha256(preimage)
-        return h
-    
+        return double_sha256(preimage)
+
     def get_hashinputs(self, tx):
-        inputs = b''
+        hasher = _sha256()
+        update = hasher.update
         for txin in tx.inputs:
-            inputhash = b''.join((
+            update(_sha256(b''.join((
                 txin.prev_hash,
                 pack_le_uint32(txin.prev_idx),
-                sha256(txin.script),
+                _sha256(txin.script).digest(),
                 pack_le_uint32(txin.sequence)
-            ))
-            inputs = b''.join((
-                inputs,
-                sha256(inputhash)
-                ))
-        return sha256(inputs)
+            ))).digest())
+        return hasher.digest()
 
     def get_state(self, script):
         pc = len(script)
@@ -171,7 +170,7 @@ class Deserializer(object):
 
         pc -= 5
 
-        stateLen, = unpack_le_uint32_from(script[pc:])
+        stateLen, = unpack_le_uint32_from(script, pc)
         if len(script) < 1 + stateLen + 4 + 1:
             return False
 
@@ -179,29 +178,27 @@ class Deserializer(object):
 
         if script[pc - 1] != OpCodes.OP_RETURN:
             return False
-        
+
         return pc
 
     def get_hashoutputs(self, tx):
-        outputs = b''
+        hasher = _sha256()
+        update = hasher.update
+        get_state = self.get_state
         for txout in tx.outputs:
-            outputhash = b''.join((
-                pack_le_uint64(txout.value),
-                sha256(txout.pk_script)
-                ))
-            pc = self.get_state(txout.pk_script)
+            script = txout.pk_script
+            outputhash = pack_le_uint64(txout.value) + _sha256(script).digest()
+            pc = get_state(script)
             if pc:
+                # The code and state parts of the script, hashed without copying
+                script = memoryview(script)
                 outputhash = b''.join((
                     outputhash,
-                    sha256(txout.pk_script[0:pc]),
-                    sha256(txout.pk_script[pc:len(txout.pk_script)]),
+                    _sha256(script[:pc]).digest(),
+                    _sha256(script[pc:]).digest(),
                 ))
-                print("success")
-            outputs = b''.join((
-                outputs,
-                sha256(outputhash)
-            ))
-        return sha256(outputs)
+            update(_sha256(outputhash).digest())
+        return hasher.digest()
 
     def read_tx_and_vsize(self):
         '''Return a (deserialized TX, vsize) pair.'''
@@ -309,3 +306,166 @@ class Deserializer(object):
         result, = unpack_le_uint64_from(self.binary, self.cursor)
         self.cursor += 8
         return result
+
+
+class RecordDeserializer(Deserializer):
+    '''Deserializes blocks over a memoryview, without copying.
+
+    read_tx_records() returns compact per-transaction records holding
+    only what the block processor needs; of the transaction data only
+    prevouts are materialized as bytes.  The other entry points return Tx
+    objects as Deserializer does.
+
+    Malformed inputs and outputs are skipped exactly as by Deserializer so
+    that transaction hashes agree.
+    '''
+
+    def __init__(self, binary, start=0):
+        self.binary = memoryview(binary)
+        self.binary_length = len(self.binary)
+        self.cursor = start
+
+    def read_tx(self):
+        return self._tx(*self._read_tx_parts())
+
+    def read_tx_and_hash(self):
+        parts = self._read_tx_parts()
+        return self._tx(*parts), self._tx_hash(*parts)
+
+    def read_tx_records(self):
+        '''Return a list of (tx_hash, prevouts, outputs) records, one per
+        transaction of the block.
+
+        prevouts is a tuple of the 36-byte prev_hash + prev_idx keys of the
+        non-generation inputs.  outputs is a tuple of (idx, pk_script,
+        value) triples, the scripts being memoryviews into the block.
+        '''
+        binary = self.binary
+        read_tx_parts = self._read_tx_parts
+        tx_hash = self._tx_hash
+        records = []
+        append = records.append
+        for _ in range(self._read_varint()):
+            parts = read_tx_parts()
+            inputs, outputs = parts[3], parts[4]
+            prevouts = tuple(prevout for prevout in
+                             (binary[offset:offset + 36].tobytes() for offset, _, _ in inputs)
+                             if prevout != GENERATION_PREVOUT)
+            outputs = tuple((idx, script, value)
+                            for idx, (_, script, value) in enumerate(outputs))
+            append((tx_hash(*parts), prevouts, outputs))
+        return records
+
+    def _read_tx_parts(self):
+        '''Read a transaction.  Return (start, end, version, inputs, outputs,
+        locktime).  Inputs are (offset, script, sequence offset) triples and
+        outputs (offset, pk_script, value) triples.'''
+        start = self.cursor
+        version = self._read_le_int32()
+        inputs = self._read_inputs()
+        outputs = self._read_outputs()
+        if (self.binary_length - self.cursor) < 4:
+            self.cursor = self.binary_length - 4
+        locktime = self._read_le_uint32()
+        return start, self.cursor, version, inputs, outputs, locktime
+
+    def _tx(self, _start, _end, version, inputs, outputs, locktime):
+        '''Materialize a Tx from its parts.'''
+        binary = self.binary
+        return Tx(
+            version,
+            [TxInput(binary[offset:offset + 32].tobytes(),
+                     unpack_le_uint32_from(binary, offset + 32)[0],
+                     script.tobytes(),
+                     unpack_le_uint32_from(binary, sequence_offset)[0])
+             for offset, script, sequence_offset in inputs],
+            [TxOutput(value, script.tobytes()) for _, script, value in outputs],
+            locktime
+        )
+
+    def _tx_hash(self, start, end, version, inputs, outputs, locktime):
+        '''The hash of a transaction from its parts.  See
+        Deserializer.read_tx_and_hash().'''
+        binary = self.binary
+        if version != 2:
+            return double_sha256(binary[start:end])
+
+        hasher = _sha256()
+        update = hasher.update
+        for offset, script, sequence_offset in inputs:
+            update(_sha256(b''.join((
+                binary[offset:offset + 36],
+                _sha256(script).digest(),
+                binary[sequence_offset:sequence_offset + 4],
+            ))).digest())
+        hash_inputs = hasher.digest()
+
+        hasher = _sha256()
+        update = hasher.update
+        get_state = self.get_state
+        for _, script, value in outputs:
+            outputhash = pack_le_uint64(value) + _sha256(script).digest()
+            pc = get_state(script)
+            if pc:
+                outputhash = b''.join((
+                    outputhash,
+                    _sha256(script[:pc]).digest(),
+                    _sha256(script[pc:]).digest(),
+                ))
+            update(_sha256(outputhash).digest())
+
+        return double_sha256(b''.join((
+            pack_le_uint32(version),
+            pack_le_int32(len(inputs)),
+            hash_inputs,
+            pack_le_int32(len(outputs)),
+            hasher.digest(),
+            pack_le_uint32(locktime)
+        )))
+
+    def _read_inputs(self):
+        # As Deserializer but without the filter() pass
+        read_input = self._read_input
+        inputs = []
+        append = inputs.append
+        for _ in range(self._read_varint()):
+            try:
+                txin = read_input()
+            except Exception:   # pylint:disable=W0703
+                continue
+            if txin:
+                append(txin)
+        return inputs
+
+    def _read_input(self):
+        cursor = self.cursor
+        try:
+            self._read_nbytes(32)           # prev_hash
+            self._read_le_uint32()          # prev_idx
+            script = self._read_varbytes()  # script
+            self._read_le_uint32()          # sequence
+        except AssertionError:
+            self.cursor = cursor
+            return None
+        return cursor, script, self.cursor - 4
+
+    def _read_outputs(self):
+        # As Deserializer but without the filter() pass
+        read_output = self._read_output
+        outputs = []
+        append = outputs.append
+        for _ in range(self._read_varint()):
+            txout = read_output()
+            if txout:
+                append(txout)
+        return outputs
+
+    def _read_output(self):
+        cursor = self.cursor
+        try:
+            value = self._read_le_int64()
+            pk_script = self._read_varbytes()
+        except Exception:   # pylint:disable=W0703
+            self.cursor = cursor
+            return None
+        return cursor, pk_script, value
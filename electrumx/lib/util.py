@@ -30,9 +30,13 @@
 import array
 import inspect
 from ipaddress import ip_address
+import itertools
 import logging
+import mmap
+import os
 import sys
-from collections.abc import Container, Mapping
+import threading
+from collections.abc import Container, Mapping, Sequence
 from struct import Struct
 
 
@@ -135,6 +139,47 @@ def deep_getsizeof(obj):
     return size(obj)
 
 
+def sampled_getsizeof(obj, sample_size=100):
+    '''Estimate the memory footprint of a large mapping or sequence whose
+    items are of similar size.
+
+    The container is sized shallowly, and the deep size of a sample of
+    its items scaled up to all of them.  Sequences are sampled at evenly
+    spaced indices; other containers cannot be indexed, so their first
+    items in iteration order are sampled rather than walking them all.
+    '''
+    count = len(obj)
+    size = sys.getsizeof(obj)
+    if not count:
+        return size
+    if isinstance(obj, Sequence):
+        step = max(count // sample_size, 1)
+        sample = [obj[n] for n in range(0, count, step)]
+        sample_size = sum(deep_getsizeof(item) for item in sample)
+    elif isinstance(obj, Mapping):
+        sample = list(itertools.islice(obj.items(), sample_size))
+        sample_size = sum(deep_getsizeof(key) + deep_getsizeof(value) for key, value in sample)
+    else:
+        sample = list(itertools.islice(obj, sample_size))
+        sample_size = sum(deep_getsizeof(item) for item in sample)
+    return size + sample_size * count // len(sample)
+
+
+def process_rss():
+    '''Return the anonymous resident memory of the process in bytes, or
+    None if it cannot be determined.
+
+    File-backed pages, such as those of mmapped block files, are shared
+    and reclaimable so are not counted.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            fields = f.read().split()
+        return (int(fields[1]) - int(fields[2])) * mmap.PAGESIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
 def subclasses(base_class, strict=True):
     '''Return a list of subclasses of base_class in its module.'''
     def select(obj):
@@ -227,6 +272,94 @@ class LogicalFile(object):
         return f
 
 
+class MappedLogicalFile(LogicalFile):
+    '''A LogicalFile that keeps each of its files open and memory mapped.
+
+    A read is then a slice of a map rather than opening, seeking and
+    closing a file, and view() returns slices without copying.  Writes go
+    through the open file so are seen by its shared map, which is only
+    remade when a read goes past its end after the file has grown.
+    '''
+
+    def __init__(self, prefix, digits, file_size):
+        super().__init__(prefix, digits, file_size)
+        self.fds = {}
+        self.maps = {}
+        # Serializes opening files and replacing maps
+        self.lock = threading.Lock()
+
+    def _fd(self, file_num, create):
+        '''Return the descriptor of the open file, or None if it is missing
+        and create is False.'''
+        fd = self.fds.get(file_num)
+        if fd is None:
+            with self.lock:
+                fd = self.fds.get(file_num)
+                if fd is None:
+                    flags = os.O_RDWR | (os.O_CREAT if create else 0)
+                    try:
+                        fd = os.open(self.filename_fmt.format(file_num), flags, 0o644)
+                    except FileNotFoundError:
+                        return None
+                    self.fds[file_num] = fd
+        return fd
+
+    def _map(self, file_num, end):
+        '''Return a map of the file covering its first end bytes, or all of
+        it if shorter.  Return None if it is missing or empty.'''
+        mm = self.maps.get(file_num)
+        if mm is not None and len(mm) >= end:
+            return mm
+        fd = self._fd(file_num, False)
+        if fd is None:
+            return None
+        with self.lock:
+            mm = self.maps.get(file_num)
+            if mm is None or len(mm) < end:
+                size = os.fstat(fd).st_size
+                if size > (0 if mm is None else len(mm)):
+                    # Readers holding the old map are unaffected
+                    mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                    self.maps[file_num] = mm
+        return mm
+
+    def read(self, start, size=-1):
+        parts = []
+        while size != 0:
+            file_num, offset = divmod(start, self.file_size)
+            end = self.file_size if size < 0 else min(offset + size, self.file_size)
+            mm = self._map(file_num, end)
+            if mm is None:
+                break
+            part = mm[offset:end]
+            if not part:
+                break
+            parts.append(part)
+            start += len(part)
+            if size > 0:
+                size -= len(part)
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def view(self, start, size):
+        '''As for read() but return a memoryview where the bytes are in a
+        single file.'''
+        file_num, offset = divmod(start, self.file_size)
+        if offset + size <= self.file_size:
+            mm = self._map(file_num, offset + size)
+            if mm is not None:
+                return memoryview(mm)[offset:offset + size]
+        return self.read(start, size)
+
+    def write(self, start, b):
+        b = memoryview(b)
+        while b:
+            file_num, offset = divmod(start, self.file_size)
+            size = min(len(b), self.file_size - offset)
+            size = os.pwrite(self._fd(file_num, True), b[:size], offset)
+            b = b[size:]
+            start += size
+
+
 def open_file(filename, create=False):
     '''Open the file name.  Return its handle.'''
     try:
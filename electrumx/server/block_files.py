@@ -0,0 +1,166 @@
+# Copyright (c) 2016-2018, Neil Booth
+# Copyright (c) 2017, the ElectrumX authors
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Read blocks directly from a co-located daemon's blk*.dat files.'''
+
+import mmap
+import os
+import threading
+from collections import defaultdict
+
+from electrumx.lib import util
+from electrumx.lib.util import unpack_le_uint32_from, unpack_le_uint64_from
+
+
+class BlockFiles(object):
+    '''An index of the blocks in a daemon's block files, by block hash.
+
+    Each record in a blk?????.dat file is the network magic, a 4-byte
+    little-endian size and the serialized block.  Blocks of 4GB or more
+    have a size of 0xffffffff followed by an 8-byte size.  Files are
+    pre-allocated and zero-filled beyond the last record.
+
+    The index is built by scanning the files, hashing each block header,
+    and is extended incrementally as the daemon appends blocks.  Blocks
+    are returned as memoryviews of mmap-ed files so are not copied.  A
+    block is dropped from the index once read, so the index only holds
+    blocks ahead of the block processor, and a file's mmap is dropped
+    once it is scanned and all its blocks are read.  A block read again,
+    for example after a reorg, is then fetched from the daemon.
+
+    read_blocks() is called from several worker threads at once so holds
+    a lock; the other methods must be called with it held or from a
+    single thread.
+    '''
+
+    def __init__(self, blocks_dir, coin):
+        self.logger = util.class_logger(__name__, self.__class__.__name__)
+        self.blocks_dir = blocks_dir
+        self.coin = coin
+        self.magic = None
+        # Block hash to (file number, offset, size) of blocks not yet read
+        self.index = {}
+        # The position scanning has reached
+        self.scan_file = 0
+        self.scan_offset = 0
+        self.mmaps = {}
+        # File number to the hashes of its indexed blocks not yet read
+        self.unread = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def file_path(self, file_num):
+        return os.path.join(self.blocks_dir, f'blk{file_num:05d}.dat')
+
+    def _mmap(self, file_num, end):
+        '''Return an mmap of the block file covering at least end bytes, or
+        None if the file is missing or too short.'''
+        mm = self.mmaps.get(file_num)
+        if mm is None or len(mm) < end:
+            # Files grow as the daemon appends blocks so remap; views of
+            # an old mmap keep it alive until they are released
+            try:
+                with open(self.file_path(file_num), 'rb') as f:
+                    if os.fstat(f.fileno()).st_size < end:
+                        return None
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (FileNotFoundError, ValueError):
+                return None
+            self.mmaps[file_num] = mm
+        return mm
+
+    def scan(self):
+        '''Index blocks in the files from where the last scan left off.
+        Return the number of blocks added.'''
+        count = 0
+        while True:
+            try:
+                file_size = os.path.getsize(self.file_path(self.scan_file))
+            except FileNotFoundError:
+                break
+            if file_size > self.scan_offset:
+                mm = self._mmap(self.scan_file, file_size)
+                if mm is not None:
+                    count += self._scan_file(mm)
+            # Move to the next file only once it exists as the daemon may
+            # still be appending to this one
+            if not os.path.exists(self.file_path(self.scan_file + 1)):
+                break
+            self.scan_file += 1
+            self.scan_offset = 0
+        for file_num in [file_num for file_num in self.mmaps
+                         if file_num < self.scan_file and not self.unread.get(file_num)]:
+            self._release(file_num)
+        if count:
+            self.logger.info(f'indexed {count:,d} blocks; scanned to file '
+                             f'{self.scan_file:,d} offset {self.scan_offset:,d}')
+        return count
+
+    def _scan_file(self, mm):
+        count = 0
+        offset = self.scan_offset
+        length = len(mm)
+        header_len = 80
+        while offset + 8 <= length:
+            magic = mm[offset:offset + 4]
+            if self.magic is None:
+                self.magic = magic
+            if magic != self.magic:
+                # The zero-filled end of the file, or a partial write
+                break
+            size, = unpack_le_uint32_from(mm, offset + 4)
+            start = offset + 8
+            if size == 0xffffffff:
+                if start + 8 > length:
+                    break
+                size, = unpack_le_uint64_from(mm, start)
+                start += 8
+            if start + size > length or size < header_len:
+                break
+            block_hash = self.coin.header_hash(mm[start:start + header_len])
+            self.index[block_hash] = (self.scan_file, start, size)
+            self.unread[self.scan_file].add(block_hash)
+            offset = start + size
+            count += 1
+        self.scan_offset = offset
+        return count
+
+    def _release(self, file_num):
+        '''Drop a file's mmap.  It is unmapped when the last view of it is
+        released.'''
+        self.mmaps.pop(file_num, None)
+        self.unread.pop(file_num, None)
+
+    def read_block(self, block_hash):
+        '''Return a memoryview of the raw block with the given hash, or None
+        if it is not in the block files or was already read.'''
+        location = self.index.pop(block_hash, None)
+        if location is None:
+            return None
+        file_num, start, size = location
+        mm = self._mmap(file_num, start + size)
+        if mm is None:
+            # Pruned by the daemon
+            return None
+        block = memoryview(mm)[start:start + size]
+        unread = self.unread.get(file_num)
+        if unread:
+            unread.discard(block_hash)
+        if not unread and file_num < self.scan_file:
+            self._release(file_num)
+        return block
+
+    def read_blocks(self, block_hashes):
+        '''Return a list of memoryviews of the raw blocks with the given
+        hashes, None for any not in the block files.  Scans for newly
+        appended blocks if any are missing.'''
+        with self.lock:
+            blocks = [self.read_block(block_hash) for block_hash in block_hashes]
+            if None in blocks and self.scan():
+                blocks = [block if block is not None else self.read_block(block_hash)
+                          for block, block_hash in zip(blocks, block_hashes)]
+            return blocks
@@ -12,26 +12,139 @@
 import asyncio
 import time
 from asyncio import sleep
+from concurrent.futures import ProcessPoolExecutor
 
-from aiorpcx import TaskGroup, CancelledError
+from aiorpcx import TaskGroup, CancelledError, ignore_after, run_in_thread
 
 import electrumx
 from electrumx.server.daemon import DaemonError
-from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
+from electrumx.lib.hash import hash_to_hex_str, hex_str_to_hash, HASHX_LEN
 from electrumx.lib.script import is_unspendable_legacy, is_unspendable_genesis
 from electrumx.lib.util import (
-    class_logger, pack_le_uint32, pack_le_uint64, unpack_le_uint64
+    class_logger, pack_le_uint32, pack_le_uint64, process_rss, sampled_getsizeof
 )
+from electrumx.server.block_files import BlockFiles
 from electrumx.server.db import FlushData
+from electrumx.server.utxo_cache import UTXOCache
+
+
+def parse_block(coin, raw_block, height):
+    '''Parse a raw block at the given height into a (header, txs) pair.
+
+    txs is a list of (tx_hash, prevouts, outputs) tuples, one per
+    transaction in block order.  prevouts is a tuple of the 36-byte
+    prev_hash + prev_idx keys of the non-generation inputs, and outputs
+    a tuple of (idx, hashX, value) triples of the spendable outputs.
+    This is all advance_txs() and _backup_txs() need.
+
+    raw_block can be a memoryview; nothing returned refers to it.  This
+    is a pure function so it can be run in a worker process.
+    '''
+    is_unspendable = (is_unspendable_genesis if height >= coin.GENESIS_ACTIVATION
+                      else is_unspendable_legacy)
+    script_hashX = coin.hashX_from_script
+
+    header, records = coin.block_records(raw_block)
+    txs = []
+    append_tx = txs.append
+    for tx_hash, prevouts, outputs in records:
+        outputs = tuple((idx, script_hashX(pk_script), value)
+                        for idx, pk_script, value in outputs
+                        if not is_unspendable(pk_script))
+        append_tx((tx_hash, prevouts, outputs))
+    return header, txs
+
+
+class BlockParser:
+    '''Parses raw blocks into the records advance_txs() consumes.
+
+    With a positive process count the CPU-bound deserialization and
+    tx hashing happens in a pool of worker processes, overlapping with
+    the block processor applying earlier blocks.  Otherwise blocks are
+    parsed inline, one at a time.
+    '''
+
+    def __init__(self, coin, processes):
+        self.logger = class_logger(__name__, self.__class__.__name__)
+        self.coin = coin
+        self.processes = processes
+        self.executor = None
+
+    def start(self):
+        if self.processes > 0 and self.executor is None:
+            self.logger.info(f'parsing blocks in {self.processes:,d} processes')
+            self.executor = ProcessPoolExecutor(self.processes)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def parsed_blocks(self, raw_blocks, first_height):
+        '''Asynchronously yield a (raw_block, header, txs) triple for each
+        raw block in order.  The first block is at first_height.'''
+        batches = self.parsed_batches(raw_blocks, first_height)
+        try:
+            async for batch in batches:
+                for block in batch:
+                    yield block
+        finally:
+            await batches.aclose()
+
+    async def parsed_batches(self, raw_blocks, first_height):
+        '''Asynchronously yield the (raw_block, header, txs) triples of the
+        raw blocks in lists of consecutive blocks.
+
+        Parsed inline, all the blocks are in one list.  With a pool each
+        list is the next block and those after it already parsed, so the
+        caller can work on them while the pool parses the rest.
+        '''
+        if self.executor is None:
+            yield [(raw_block, *parse_block(self.coin, raw_block, height))
+                   for height, raw_block in enumerate(raw_blocks, start=first_height)]
+            return
+
+        loop = asyncio.get_running_loop()
+        # Memoryviews of block files cannot be pickled
+        futures = [loop.run_in_executor(self.executor, parse_block, self.coin,
+                                        bytes(raw_block), height)
+                   for height, raw_block in enumerate(raw_blocks, start=first_height)]
+        try:
+            n = 0
+            while n < len(futures):
+                await futures[n]
+                batch = []
+                while n < len(futures) and futures[n].done():
+                    header, txs = futures[n].result()
+                    batch.append((raw_blocks[n], header, txs))
+                    n += 1
+                yield batch
+        finally:
+            # Don't waste the pool on blocks we won't process, e.g. after a reorg
+            for future in futures:
+                future.cancel()
 
 
 class Prefetcher:
-    '''Prefetches blocks (in the forward direction only).'''
+    '''Prefetches blocks (in the forward direction only).
+
+    Several requests are kept in flight to the daemon at once.  They are
+    sized in bytes: at most an equal share of the memory budget, and no
+    more than the measured daemon throughput can deliver in about
+    target_request_secs.
 
-    def __init__(self, daemon, coin, blocks_event):
+    If block_files is given, blocks are read from the daemon's block files
+    rather than requested from it until caught up.
+    '''
+
+    target_request_secs = 2
+
+    def __init__(self, daemon, coin, blocks_event, *, prefetch_MB=200, concurrency=4,
+                 block_files=None):
         self.logger = class_logger(__name__, self.__class__.__name__)
         self.daemon = daemon
         self.coin = coin
+        self.block_files = block_files
         self.blocks_event = blocks_event
         self.blocks = []
         self.caught_up = False
@@ -39,13 +152,19 @@ class Prefetcher:
         self.fetched_height = None
         self.semaphore = asyncio.Semaphore()
         self.refill_event = asyncio.Event()
-        # The prefetched block cache size.  The min cache size has
-        # little effect on sync time.
+        # The size of blocks queued for the block processor, and the
+        # budget for that plus requests in flight
         self.cache_size = 0
-        self.min_cache_size = 10 * 1024 * 1024
-        # This makes the first fetch be 10 blocks
-        self.ave_size = self.min_cache_size // 10
+        self.max_cache_size = prefetch_MB * 1_000_000
+        self.concurrency = max(concurrency, 1)
+        # This makes the first requests be 10 blocks
+        self.ave_size = self.max_cache_size // (self.concurrency * 10)
+        # Measured bytes per second of a request, and the requests in flight
+        self.fetch_rate = 0
+        self.requests = []
         self.polling_delay = 5
+        # Set when the daemon notifies a new block so polling is cut short
+        self.new_block_event = asyncio.Event()
 
     async def main_loop(self, bp_height):
         '''Loop forever polling for more blocks.'''
@@ -55,7 +174,9 @@ class Prefetcher:
                 # Sleep a while if there is nothing to prefetch
                 await self.refill_event.wait()
                 if not await self._prefetch_blocks():
-                    await sleep(self.polling_delay)
+                    async with ignore_after(self.polling_delay):
+                        await self.new_block_event.wait()
+                    self.new_block_event.clear()
             except DaemonError as e:
                 self.logger.info(f'ignoring daemon error: {e}')
             except CancelledError as e:
@@ -64,6 +185,10 @@ class Prefetcher:
             except Exception:   # pylint:disable=W0703
                 self.logger.exception('ignoring unexpected exception')
 
+    def notify_block(self):
+        '''Notify that the daemon has a new block.'''
+        self.new_block_event.set()
+
     def get_prefetched_blocks(self):
         '''Called by block processor when it is processing queued blocks.'''
         blocks = self.blocks
@@ -72,6 +197,15 @@ class Prefetcher:
         self.refill_event.set()
         return blocks
 
+    def info(self):
+        '''Prefetch statistics.'''
+        return {
+            'fetch rate MB/s': round(self.fetch_rate / 1_000_000, 2),
+            'queued blocks': len(self.blocks),
+            'queued MB': round(self.cache_size / 1_000_000, 2),
+            'requests in flight': len(self.requests),
+        }
+
     async def reset_height(self, height):
         '''Reset to prefetch blocks from the block processor's height.
 
@@ -95,55 +229,214 @@ class Prefetcher:
             self.logger.info('caught up to daemon height {:,d}'
                              .format(daemon_height))
 
+    def _request_size(self, room):
+        '''The number of bytes to ask for in a request.'''
+        size = min(room, self.max_cache_size // self.concurrency)
+        if self.fetch_rate:
+            size = min(size, int(self.fetch_rate * self.target_request_secs))
+        return size
+
+    def _read_block_files(self, hex_hashes):
+        '''Return memoryviews of the blocks with the given hex hashes from the
+        block files, None for those not found.'''
+        return self.block_files.read_blocks([hex_str_to_hash(hex_hash)
+                                             for hex_hash in hex_hashes])
+
+    async def _fetch_blocks(self, first, count):
+        '''Fetch count blocks starting at height first.  Return the blocks and
+        the time taken.'''
+        start = time.monotonic()
+        hex_hashes = await self.daemon.block_hex_hashes(first, count)
+        if self.caught_up:
+            self.logger.info('new block height {:,d} hash {}'
+                             .format(first + count - 1, hex_hashes[-1]))
+        if self.block_files and not self.caught_up:
+            blocks = await run_in_thread(self._read_block_files, hex_hashes)
+            missing = [hex_hash for hex_hash, block in zip(hex_hashes, blocks)
+                       if block is None]
+            if missing:
+                fetched = iter(await self.daemon.raw_blocks(missing))
+                blocks = [next(fetched) if block is None else block for block in blocks]
+        else:
+            blocks = await self.daemon.raw_blocks(hex_hashes)
+        assert count == len(blocks)
+
+        # Special handling for genesis block
+        if first == 0:
+            blocks[0] = self.coin.genesis_block(blocks[0])
+            self.logger.info('verified genesis block with hash {}'
+                             .format(hex_hashes[0]))
+        return blocks, time.monotonic() - start
+
     async def _prefetch_blocks(self):
         '''Prefetch some blocks and put them on the queue.
 
         Repeats until the queue is full or caught up.
         '''
-        daemon = self.daemon
-        daemon_height = await daemon.height()
+        daemon_height = await self.daemon.height()
+        requests = self.requests
         async with self.semaphore:
-            while self.cache_size < self.min_cache_size:
-                first = self.fetched_height + 1
-                # Try and catch up all blocks but limit to room in cache.
-                cache_room = max(self.min_cache_size // self.ave_size, 1)
-                count = min(daemon_height - self.fetched_height, cache_room)
-                # Don't make too large a request
-                count = min(self.coin.max_fetch_blocks(first), max(count, 0))
-                if not count:
-                    self.caught_up = True
-                    return False
-
-                hex_hashes = await daemon.block_hex_hashes(first, count)
-                if self.caught_up:
-                    self.logger.info('new block height {:,d} hash {}'
-                                     .format(first + count-1, hex_hashes[-1]))
-                blocks = await daemon.raw_blocks(hex_hashes)
-
-                assert count == len(blocks)
-
-                # Special handling for genesis block
-                if first == 0:
-                    blocks[0] = self.coin.genesis_block(blocks[0])
-                    self.logger.info('verified genesis block with hash {}'
-                                     .format(hex_hashes[0]))
-
-                # Update our recent average block size estimate
-                size = sum(len(block) for block in blocks)
-                if count >= 10:
-                    self.ave_size = size // count
-                else:
-                    self.ave_size = (size + (10 - count) * self.ave_size) // 10
-
-                self.blocks.extend(blocks)
-                self.cache_size += size
-                self.fetched_height += count
-                self.blocks_event.set()
-
+            next_height = self.fetched_height + 1
+            try:
+                while True:
+                    # Top up the requests in flight while there is room in the budget.
+                    # If nothing is queued or in flight ask for a block regardless.
+                    while len(requests) < self.concurrency:
+                        room = self.max_cache_size - self.cache_size - sum(
+                            size for _count, size, _task in requests)
+                        if room <= 0 and (requests or self.blocks):
+                            break
+                        count = min(daemon_height - next_height + 1,
+                                    self.coin.max_fetch_blocks(next_height),
+                                    max(self._request_size(room) // self.ave_size, 1))
+                        if count <= 0:
+                            break
+                        task = asyncio.ensure_future(self._fetch_blocks(next_height, count))
+                        requests.append((count, count * self.ave_size, task))
+                        next_height += count
+
+                    if not requests:
+                        break
+
+                    # Queue blocks in order as their requests complete
+                    count, _size, task = requests[0]
+                    blocks, elapsed = await task
+                    requests.pop(0)
+
+                    # Update our recent average block size and fetch rate estimates
+                    size = sum(len(block) for block in blocks)
+                    if count >= 10:
+                        self.ave_size = size // count
+                    else:
+                        self.ave_size = (size + (10 - count) * self.ave_size) // 10
+                    rate = size / max(elapsed, 0.001)
+                    self.fetch_rate = (rate + 3 * self.fetch_rate) / 4 if self.fetch_rate else rate
+
+                    self.blocks.extend(blocks)
+                    self.cache_size += size
+                    self.fetched_height += count
+                    self.blocks_event.set()
+            finally:
+                # Don't leave requests running on an error or a cancellation
+                for _count, _size, task in requests:
+                    task.cancel()
+                requests.clear()
+
+        if self.fetched_height >= daemon_height:
+            self.caught_up = True
+            return False
         self.refill_event.clear()
         return True
 
 
+class CachePolicy:
+    '''Decides when the block processor flushes its caches.
+
+    Caches are sized by sampling their contents rather than from fixed
+    per-entry estimates.  The budget of cache_MB is split between UTXOs
+    and history.  History is flushed when it outgrows its share, and
+    UTXOs when the caches as a whole outgrow the budget and the UTXOs
+    their share.
+
+    Two things adapt:
+
+      - the budget shrinks multiplicatively whenever the anonymous
+        resident memory of the process exceeds its expected size - the
+        memory it had at startup, cache_MB and headroom_MB - and recovers
+        gradually otherwise.  This catches allocator overhead and fragmentation
+        that sizing objects cannot see.
+
+      - the UTXO share grows when the time spent looking up spent UTXOs
+        in the DB since the last UTXO flush exceeds how long that flush
+        took, as the cache is then too small for the working set, and
+        shrinks otherwise.
+    '''
+
+    MIN_UTXO_FRACTION = 0.5
+    MAX_UTXO_FRACTION = 0.9
+    MIN_SCALE = 0.25
+
+    def __init__(self, cache_MB, headroom_MB=0):
+        self.cache_size = cache_MB * 1_000_000
+        self.base_rss = process_rss()
+        self.rss_limit = (None if self.base_rss is None else
+                          self.base_rss + (cache_MB + headroom_MB) * 1_000_000)
+        self.rss = self.base_rss
+        self.scale = 1.0
+        self.utxo_fraction = 0.8
+        self.utxo_size = 0
+        self.hist_size = 0
+        # DB lookups of spent UTXOs since the last UTXO flush
+        self.db_spends = 0
+        self.db_spend_secs = 0.0
+        self.utxo_flush_secs = None
+        self.hist_flush_secs = None
+
+    def budget(self):
+        return int(self.cache_size * self.scale)
+
+    def note_db_spends(self, count, secs):
+        '''Note count spent UTXOs were looked up in the DB in secs.'''
+        self.db_spends += count
+        self.db_spend_secs += secs
+
+    def note_flush(self, flush_utxos, secs):
+        '''Note a flush of the UTXOs if flush_utxos, otherwise of history
+        only, took secs.'''
+        if flush_utxos:
+            self.utxo_flush_secs = secs
+            self.db_spends = 0
+            self.db_spend_secs = 0.0
+        else:
+            self.hist_flush_secs = secs
+
+    def check(self, utxo_size, hist_size):
+        '''Given the sizes of the UTXO and history caches in bytes, return
+        None if no flush is needed, otherwise whether to flush UTXOs as
+        well as history.'''
+        self.utxo_size = utxo_size
+        self.hist_size = hist_size
+        self.rss = process_rss()
+        if self.rss is not None:
+            if self.rss > self.rss_limit:
+                self.scale = max(self.scale * 0.9, self.MIN_SCALE)
+            else:
+                self.scale = min(self.scale + 0.05, 1.0)
+
+        budget = self.budget()
+        utxo_limit = int(budget * self.utxo_fraction)
+        if utxo_size + hist_size < budget and hist_size < budget - utxo_limit:
+            return None
+        flush_utxos = utxo_size >= utxo_limit
+        if flush_utxos and self.utxo_flush_secs is not None:
+            step = 0.05 if self.db_spend_secs > self.utxo_flush_secs else -0.05
+            self.utxo_fraction = min(max(self.utxo_fraction + step, self.MIN_UTXO_FRACTION),
+                                     self.MAX_UTXO_FRACTION)
+        return flush_utxos
+
+    def info(self):
+        '''Cache policy state.'''
+        def MB(size):
+            return None if size is None else round(size / 1_000_000, 1)
+
+        def secs(value):
+            return None if value is None else round(value, 2)
+
+        return {
+            'budget MB': MB(self.budget()),
+            'cache MB': MB(self.cache_size),
+            'DB spends': self.db_spends,
+            'DB spend secs': secs(self.db_spend_secs),
+            'history MB': MB(self.hist_size),
+            'history flush secs': secs(self.hist_flush_secs),
+            'RSS MB': MB(self.rss),
+            'RSS limit MB': MB(self.rss_limit),
+            'UTXO fraction': round(self.utxo_fraction, 2),
+            'UTXO flush secs': secs(self.utxo_flush_secs),
+            'UTXO MB': MB(self.utxo_size),
+        }
+
+
 class ChainError(Exception):
     '''Raised on error processing blocks.'''
 
@@ -173,7 +466,16 @@ class BlockProcessor:
         self.backed_up_event = asyncio.Event()
 
         self.coin = env.coin
-        self.prefetcher = Prefetcher(daemon, env.coin, self.blocks_event)
+        self.prefetcher = Prefetcher(daemon, env.coin, self.blocks_event,
+                                     prefetch_MB=env.prefetch_MB,
+                                     concurrency=env.prefetch_concurrency,
+                                     block_files=(BlockFiles(env.blocks_dir, env.coin)
+                                                  if env.blocks_dir else None))
+        self.block_parser = BlockParser(env.coin, env.parse_processes)
+        # A flush in flight can hold a second set of caches
+        self.cache_policy = CachePolicy(
+            env.cache_MB,
+            headroom_MB=env.prefetch_MB + (env.cache_MB if env.pipelined_flush else 0))
         self.logger = class_logger(__name__, self.__class__.__name__)
 
         # Meta
@@ -191,8 +493,17 @@ class BlockProcessor:
         self.undo_infos = []
 
         # UTXO cache
-        self.utxo_cache = {}
+        self.utxo_cache_class = UTXOCache if env.compact_utxo_cache else dict
+        self.utxo_cache = self.utxo_cache_class()
         self.db_deletes = []
+        # The cache values of the UTXOs spent from the DB, for balances
+        self.db_spent_values = []
+
+        # A flush committing in a worker thread, and the UTXOs it is writing out
+        self._flush_task = None
+        self.flushing_adds = {}
+        # UTXOs the blocks being advanced spend from the DB; see prefetch_utxos()
+        self.prefetched_utxos = {}
 
     async def run_with_lock(self, coro):
         # Shielded so that cancellations from shutdown don't lose work.  Cancellation will
@@ -213,33 +524,43 @@ class BlockProcessor:
         '''Handle a chain reorganisation.
 
         Count is the number of blocks to simulate a reorg, or None for
-        a real reorg.'''
+        a real reorg.
+
+        All the blocks are backed up into the caches and then written out
+        in a single flush, so history is backed up once for the union of
+        touched hashXs.'''
         if count < 0:
             self.logger.info('chain reorg detected')
         else:
             self.logger.info(f'faking a reorg of {count:,d} blocks')
         await self.flush(True)
-
-        async def get_raw_block(hex_hash, height):
-            try:
-                block = self.db.read_raw_block(height)
+        start_time = time.monotonic()
+
+        async def get_block(block_hash, height):
+            '''Return the (header, txs) pair of a block, from its digest if
+            on disk, otherwise from the daemon.'''
+            hex_hash = hash_to_hex_str(block_hash)
+            block = self.db.read_block_digest(height)
+            if block is not None and self.coin.header_hash(block[0]) == block_hash:
                 self.logger.info(f'read block {hex_hash} at height {height:,d} from disk')
-            except FileNotFoundError:
-                block = await self.daemon.raw_blocks([hex_hash])[0]
-                self.logger.info(f'obtained block {hex_hash} at height {height:,d} from daemon')
-            return block
+                return block
+            raw_block = (await self.daemon.raw_blocks([hex_hash]))[0]
+            self.logger.info(f'obtained block {hex_hash} at height {height:,d} from daemon')
+            return parse_block(self.coin, raw_block, height)
 
         _start, height, hashes = await self._reorg_hashes(count)
-        hex_hashes = [hash_to_hex_str(block_hash) for block_hash in hashes]
-        for hex_hash in reversed(hex_hashes):
-            raw_block = await get_raw_block(hex_hash, height)
-            await self._backup_block(raw_block)
-            # self.touched can include other addresses which is harmless, but remove None.
-            self.touched.discard(None)
-            self.db.flush_backup(self.flush_data(), self.touched)
+        self.db.assert_flushed(self.flush_data())
+        for block_hash in reversed(hashes):
+            header, txs = await get_block(block_hash, height)
+            await self._backup_block(header, txs)
             height -= 1
+        # self.touched can include other addresses which is harmless, but remove None.
+        self.touched.discard(None)
+        self.db.flush_backup(self.flush_data(), self.touched)
 
-        self.logger.info('backed up to height {:,d}'.format(self.height))
+        s = '' if len(hashes) == 1 else 's'
+        self.logger.info(f'backed up {len(hashes):,d} block{s} to height {self.height:,d} '
+                         f'in {time.monotonic() - start_time:.1f}s')
 
         await self.prefetcher.reset_height(self.height)
         self.backed_up_event.set()
@@ -308,47 +629,85 @@ class BlockProcessor:
         assert self.state_lock.locked()
         return FlushData(self.height, self.tx_count, self.headers,
                          self.tx_hashes, self.undo_infos, self.utxo_cache,
-                         self.db_deletes, self.tip)
+                         self.db_deletes, self.db_spent_values, self.tip)
 
-    async def flush(self, flush_utxos):
-        self.db.flush_dbs(self.flush_data(), flush_utxos, self.estimate_txs_remaining)
+    async def flush(self, flush_utxos, background=False):
+        '''Flush cached state to the DB.
+
+        If background is True the flush is committed in a worker thread and
+        block processing continues against fresh caches in the meantime.
+        Only one flush is in flight at a time, so the on-disk commit order,
+        and hence crash recovery, is as for a foreground flush.
+        '''
+        await self.wait_for_background_flush()
+        if background:
+            flush_data = self.flush_data()
+            flush_data.history = self.db.history.take_unflushed()
+            self.headers = []
+            self.tx_hashes = []
+            if flush_utxos:
+                self.undo_infos = []
+                self.utxo_cache = self.utxo_cache_class()
+                self.db_deletes = []
+                self.db_spent_values = []
+                self.flushing_adds = flush_data.adds
+            self._flush_task = asyncio.ensure_future(run_in_thread(
+                self._flush_dbs, flush_data, flush_utxos))
+        else:
+            self._flush_dbs(self.flush_data(), flush_utxos)
         self.next_cache_check = time.monotonic() + 30
 
+    def _flush_dbs(self, flush_data, flush_utxos):
+        start = time.monotonic()
+        self.db.flush_dbs(flush_data, flush_utxos, self.estimate_txs_remaining)
+        self.cache_policy.note_flush(flush_utxos, time.monotonic() - start)
+
+    async def wait_for_background_flush(self):
+        '''Wait for an in-flight background flush, if any, to commit.'''
+        if self._flush_task:
+            task, self._flush_task = self._flush_task, None
+            await task
+            self.flushing_adds = {}
+
     def check_cache_size(self):
-        '''Flush a cache if it gets too big.'''
-        # Good average estimates based on traversal of subobjects and
-        # requesting size from Python (see deep_getsizeof).
+        '''Flush a cache if it gets too big.  See CachePolicy.'''
+        if isinstance(self.utxo_cache, UTXOCache):
+            utxo_cache_size = self.utxo_cache.memsize()
+        else:
+            utxo_cache_size = sampled_getsizeof(self.utxo_cache)
+        utxo_size = (utxo_cache_size + sampled_getsizeof(self.db_deletes)
+                     + sampled_getsizeof(self.db_spent_values))
+        hist_size = (self.db.history.unflushed_memsize() + sampled_getsizeof(self.tx_hashes)
+                     + sampled_getsizeof(self.headers))
+        policy = self.cache_policy
+        flush_arg = policy.check(utxo_size, hist_size)
+
         one_MB = 1000*1000
-        utxo_cache_size = len(self.utxo_cache) * 205
-        db_deletes_size = len(self.db_deletes) * 57
-        hist_cache_size = self.db.history.unflushed_memsize()
-        # Roughly ntxs * 32 + nblocks * 42
-        tx_hash_size = ((self.tx_count - self.db.fs_tx_count) * 32
-                        + (self.height - self.db.fs_height) * 42)
-        utxo_MB = (db_deletes_size + utxo_cache_size) // one_MB
-        hist_MB = (hist_cache_size + tx_hash_size) // one_MB
-
-        self.logger.info('our height: {:,d} daemon: {:,d} '
-                         'UTXOs {:,d}MB hist {:,d}MB'
-                         .format(self.height, self.daemon.cached_height(),
-                                 utxo_MB, hist_MB))
-
-        # Flush history if it takes up over 20% of cache memory.
-        # Flush UTXOs once they take up 80% of cache memory.
-        cache_MB = self.env.cache_MB
-        if utxo_MB + hist_MB >= cache_MB or hist_MB >= cache_MB // 5:
-            return utxo_MB >= cache_MB * 4 // 5
-        return None
+        rss = '' if policy.rss is None else f' RSS {policy.rss // one_MB:,d}MB'
+        self.logger.info(f'our height: {self.height:,d} daemon: {self.daemon.cached_height():,d} '
+                         f'UTXOs {utxo_size // one_MB:,d}MB hist {hist_size // one_MB:,d}MB '
+                         f'budget {policy.budget() // one_MB:,d}MB{rss}')
+        return flush_arg
 
     async def _advance_blocks(self, raw_blocks):
         '''Process the list of raw blocks passed.  Detects and handles reorgs.'''
         start = time.monotonic()
-        for raw_block in raw_blocks:
-            block = self.coin.block(raw_block)
-            if self.coin.header_prevhash(block.header) != self.tip:
-                self.schedule_reorg(-1)
-                return
-            await self._advance_block(block)
+        # Each batch's UTXOs are prefetched as it arrives, so a parser pool
+        # keeps parsing later blocks while earlier ones are applied
+        batches = self.block_parser.parsed_batches(raw_blocks, self.height + 1)
+        try:
+            async for blocks in batches:
+                await self.prefetch_utxos(blocks)
+                for _raw_block, header, txs in blocks:
+                    if self.coin.header_prevhash(header) != self.tip:
+                        self.schedule_reorg(-1)
+                        return
+                    await self._advance_block(header, txs)
+                self.prefetched_utxos = {}
+        finally:
+            # Anything left over was not spent and may be stale after a reorg
+            self.prefetched_utxos = {}
+            await batches.aclose()
         end = time.monotonic()
 
         if not self.db.first_sync:
@@ -365,38 +724,62 @@ class BlockProcessor:
         elif end > self.next_cache_check:
             flush_arg = self.check_cache_size()
             if flush_arg is not None:
-                await self.flush(flush_arg)
+                await self.flush(flush_arg, background=self.env.pipelined_flush)
 
         if self._caught_up_event.is_set():
             await self.notifications.on_block(self.touched, self.height)
 
         self.touched = set()
 
-    async def _advance_block(self, block):
+    async def prefetch_utxos(self, blocks):
+        '''Look up in bulk, in a worker thread, the DB UTXOs spent by the
+        parsed blocks.
+
+        Prevouts in the UTXO cache or created earlier in the blocks are
+        skipped.  spend_utxo() then finds the rest in prefetched_utxos
+        rather than going to the DB one at a time.
+        '''
+        utxo_cache = self.utxo_cache
+        flushing_adds = self.flushing_adds
+        created = set()
+        prevouts = []
+        for _raw_block, _header, txs in blocks:
+            for tx_hash, tx_prevouts, _outputs in txs:
+                prevouts.extend(prevout for prevout in tx_prevouts
+                                if prevout[:32] not in created
+                                and prevout not in utxo_cache
+                                and prevout not in flushing_adds)
+                created.add(tx_hash)
+        if prevouts:
+            start = time.monotonic()
+            self.prefetched_utxos = await run_in_thread(self.db.lookup_spent_utxos,
+                                                        prevouts)
+            self.cache_policy.note_db_spends(len(prevouts), time.monotonic() - start)
+
+    async def _advance_block(self, header, txs):
         '''Advance once block.  It is already verified they correctly connect onto our tip.'''
         min_height = self.db.min_undo_height(self.daemon.cached_height())
         height = self.height + 1
 
-        is_unspendable = (is_unspendable_genesis if height >= self.coin.GENESIS_ACTIVATION
-                          else is_unspendable_legacy)
-        undo_info = self.advance_txs(block.transactions, is_unspendable)
+        undo_info = self.advance_txs(txs)
         if height >= min_height:
             self.undo_infos.append((undo_info, height))
-            self.db.write_raw_block(block.raw, height)
+            self.db.write_block_digest(height, header, txs)
 
         self.height = height
-        self.headers.append(block.header)
-        self.tip = self.coin.header_hash(block.header)
+        self.headers.append(header)
+        self.tip = self.coin.header_hash(header)
 
         await sleep(0)
 
-    def advance_txs(self, txs, is_unspendable):
-        self.tx_hashes.append(b''.join(tx_hash for tx, tx_hash in txs))
+    def advance_txs(self, txs):
+        '''Apply the UTXO and history changes of a block's parsed txs (see
+        parse_block()).  Returns the block's undo information.'''
+        self.tx_hashes.append(b''.join(tx_hash for tx_hash, _prevouts, _outputs in txs))
 
         # Use local vars for speed in the loops
         undo_info = []
         tx_num = self.tx_count
-        script_hashX = self.coin.hashX_from_script
         put_utxo = self.utxo_cache.__setitem__
         spend_utxo = self.spend_utxo
         undo_info_append = undo_info.append
@@ -406,34 +789,26 @@ class BlockProcessor:
         to_le_uint32 = pack_le_uint32
         to_le_uint64 = pack_le_uint64
 
-        for tx, tx_hash in txs:
+        for tx_hash, prevouts, outputs in txs:
             hashXs = []
             append_hashX = hashXs.append
             tx_numb = to_le_uint64(tx_num)[:5]
 
             # Spend the inputs
-            for txin in tx.inputs:
-                if txin.is_generation():
-                    continue
-                cache_value = spend_utxo(txin.prev_hash, txin.prev_idx)
+            for prevout in prevouts:
+                cache_value = spend_utxo(prevout)
                 undo_info_append(cache_value)
                 if cache_value: append_hashX(cache_value[:-13])
 
             # Add the new UTXOs
-            for idx, txout in enumerate(tx.outputs):
-                # Ignore unspendable outputs
-                if is_unspendable(txout.pk_script):
-                    continue
-
-                # Get the hashX
-                hashX = script_hashX(txout.pk_script)
+            for idx, hashX, value in outputs:
                 append_hashX(hashX)
-                
-                if txout.value < 0:
+
+                if value < 0:
                     continue
 
                 put_utxo(tx_hash + to_le_uint32(idx),
-                         hashX + tx_numb + to_le_uint64(txout.value))
+                         hashX + tx_numb + to_le_uint64(value))
 
             append_hashXs(hashXs)
             update_touched(hashXs)
@@ -446,36 +821,31 @@ class BlockProcessor:
 
         return undo_info
 
-    async def _backup_block(self, raw_block):
-        '''Backup the raw block and flush.
+    async def _backup_block(self, header, txs):
+        '''Backup the block, parsed as by parse_block(), into the caches.
 
-        The blocks should be in order of decreasing height, starting at.  self.height.  A
+        The blocks should be in order of decreasing height, starting at self.height.  A
         flush is performed once the blocks are backed up.
         '''
-        self.db.assert_flushed(self.flush_data())
         assert self.height > 0
-        genesis_activation = self.coin.GENESIS_ACTIVATION
 
         coin = self.coin
 
         # Check and update self.tip
-        block = coin.block(raw_block)
-        header_hash = coin.header_hash(block.header)
+        header_hash = coin.header_hash(header)
         if header_hash != self.tip:
             raise ChainError('backup block {} not tip {} at height {:,d}'
                              .format(hash_to_hex_str(header_hash),
                                      hash_to_hex_str(self.tip),
                                      self.height))
-        self.tip = coin.header_prevhash(block.header)
-        is_unspendable = (is_unspendable_genesis if self.height >= genesis_activation
-                          else is_unspendable_legacy)
-        self._backup_txs(block.transactions, is_unspendable)
+        self.tip = coin.header_prevhash(header)
+        self._backup_txs(txs)
         self.height -= 1
         self.db.tx_counts.pop()
 
         await sleep(0)
 
-    def _backup_txs(self, txs, is_unspendable):
+    def _backup_txs(self, txs):
         # Prevout values, in order down the block (coinbase first if present)
         # undo_info is in reverse block order
         undo_info = self.db.read_undo_info(self.height)
@@ -489,24 +859,22 @@ class BlockProcessor:
         spend_utxo = self.spend_utxo
         touched = self.touched
         undo_entry_len = 13 + HASHX_LEN
+        to_le_uint32 = pack_le_uint32
 
-        for tx, tx_hash in reversed(txs):
-            for idx, txout in enumerate(tx.outputs):
-                # Spend the TX outputs.  Be careful with unspendable
-                # outputs - we didn't save those in the first place.
-                if is_unspendable(txout.pk_script):
+        for tx_hash, prevouts, outputs in reversed(txs):
+            for idx, _hashX, value in outputs:
+                # Spend the TX outputs.  Unspendable outputs were not
+                # parsed and negative values were never saved.
+                if value < 0:
                     continue
-
-                cache_value = spend_utxo(tx_hash, idx)
+                cache_value = spend_utxo(tx_hash + to_le_uint32(idx))
                 touched.add(cache_value[:-13])
 
             # Restore the inputs
-            for txin in reversed(tx.inputs):
-                if txin.is_generation():
-                    continue
+            for prevout in reversed(prevouts):
                 n -= undo_entry_len
                 undo_item = undo_info[n:n + undo_entry_len]
-                put_utxo(txin.prev_hash + pack_le_uint32(txin.prev_idx), undo_item)
+                put_utxo(prevout, undo_item)
                 touched.add(undo_item[:-13])
 
         assert n == 0
@@ -529,7 +897,8 @@ class BlockProcessor:
     means each entry actually uses about 205 bytes of memory.  So
     almost 5 million UTXOs can fit in 1GB of RAM.  There are
     approximately 42 million UTXOs on bitcoin mainnet at height
-    433,000.
+    433,000.  With COMPACT_UTXO_CACHE set a UTXOCache is used instead,
+    at about 70 bytes per entry.
 
     Semantics:
 
@@ -566,46 +935,42 @@ class BlockProcessor:
     collision rate is low (<0.1%).
     '''
 
-    def spend_utxo(self, tx_hash, tx_idx):
-        '''Spend a UTXO and return the 33-byte value.
+    def spend_utxo(self, prevout):
+        '''Spend a UTXO and return the 24-byte value.
 
-        If the UTXO is not in the cache it must be on disk.  We store
-        all UTXOs so not finding one indicates a logic error or DB
-        corruption.
+        prevout is the 36-byte TX_HASH + TX_IDX cache key.  If the UTXO
+        is not in the cache it must be on disk.  We store all UTXOs so
+        not finding one indicates a logic error or DB corruption.
         '''
         # Fast track is it being in the cache
-        idx_packed = pack_le_uint32(tx_idx)
-        cache_value = self.utxo_cache.pop(tx_hash + idx_packed, None)
+        cache_value = self.utxo_cache.pop(prevout, None)
         if cache_value:
             return cache_value
 
-        # Spend it from the DB.
-
-        # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
-        # Value: hashX
-        prefix = b'h' + tx_hash[:4] + idx_packed
-        candidates = {db_key: hashX for db_key, hashX
-                      in self.db.utxo_db.iterator(prefix=prefix)}
-
-        for hdb_key, hashX in candidates.items():
-            tx_num_packed = hdb_key[-5:]
-
-            if len(candidates) > 1:
-                tx_num, = unpack_le_uint64(tx_num_packed + bytes(3))
-                fs_hash, _height = self.db.fs_tx_hash(tx_num)
-                if fs_hash != tx_hash:
-                    assert fs_hash is not None  # Should always be found
-                    continue
+        # Then is it being written out by a background flush?  If so it
+        # will be in the DB by the time our next flush commits.
+        cache_value = self.flushing_adds.get(prevout)
+        if cache_value:
+            hashX = cache_value[:-13]
+            suffix = prevout[32:] + cache_value[-13:-8]
+            self.db_deletes.append(b'h' + prevout[:4] + suffix)
+            self.db_deletes.append(b'u' + hashX + suffix)
+            self.db_spent_values.append(cache_value)
+            return cache_value
 
-            # Key: b'u' + address_hashX + tx_idx + tx_num
-            # Value: the UTXO value as a 64-bit unsigned integer
-            udb_key = b'u' + hashX + hdb_key[-9:]
-            utxo_value_packed = self.db.utxo_db.get(udb_key)
-            if utxo_value_packed:
-                # Remove both entries for this UTXO
-                self.db_deletes.append(hdb_key)
-                self.db_deletes.append(udb_key)
-                return hashX + tx_num_packed + utxo_value_packed
+        # Spend it from the DB, looking it up if it was not prefetched
+        utxo = self.prefetched_utxos.pop(prevout, None)
+        if utxo is None:
+            start = time.monotonic()
+            utxo = self.db.lookup_spent_utxos([prevout]).get(prevout)
+            self.cache_policy.note_db_spends(1, time.monotonic() - start)
+        if utxo:
+            hdb_key, udb_key, cache_value = utxo
+            # Remove both entries for this UTXO
+            self.db_deletes.append(hdb_key)
+            self.db_deletes.append(udb_key)
+            self.db_spent_values.append(cache_value)
+            return cache_value
 
         #raise ChainError('UTXO {} / {:,d} not found in "h" table'
                          #.format(hash_to_hex_str(tx_hash), tx_idx))
@@ -665,6 +1030,7 @@ class BlockProcessor:
         '''
         self._caught_up_event = caught_up_event
         await self._first_open_dbs()
+        self.block_parser.start()
         try:
             async with TaskGroup() as group:
                 await group.spawn(self.prefetcher.main_loop(self.height))
@@ -679,6 +1045,8 @@ class BlockProcessor:
             self.logger.info('flushing to DB for a clean shutdown...')
             await self.run_with_lock(self.flush(True))
             self.logger.info('flushed cleanly')
+        finally:
+            self.block_parser.shutdown()
 
     def force_chain_reorg(self, count):
         '''Force a reorg of the given number of blocks.
@@ -15,6 +15,7 @@ from electrumx.lib.util import version_string
 from electrumx.server.db import DB
 from electrumx.server.mempool import MemPool, MemPoolAPI
 from electrumx.server.session import SessionManager
+from electrumx.server.zmq_subscriber import ZMQSubscriber
 
 
 class Notifications(object):
@@ -97,25 +98,37 @@ class Controller(ServerBase):
         self.logger.info(f'event loop policy: {env.loop_policy}')
         self.logger.info(f'reorg limit is {env.reorg_limit:,d} blocks')
 
+        # Fail now for a missing pyzmq rather than once caught up
+        if env.zmq_urls:
+            ZMQSubscriber.import_module()
+
         notifications = Notifications()
         Daemon = env.coin.DAEMON
         BlockProcessor = env.coin.BLOCK_PROCESSOR
 
-        async with Daemon(env.coin, env.daemon_url) as daemon:
+        async with Daemon(env.coin, env.daemon_url, rest=env.daemon_rest) as daemon:
             db = DB(env)
             bp = BlockProcessor(env, db, daemon, notifications)
 
             # Set notifications up to implement the MemPoolAPI
             def get_db_height():
                 return db.db_height
+
+            def get_db_tip():
+                return db.db_tip
             notifications.height = daemon.height
             notifications.db_height = get_db_height
+            notifications.db_tip = get_db_tip
             notifications.cached_height = daemon.cached_height
             notifications.mempool_hashes = daemon.mempool_hashes
             notifications.raw_transactions = daemon.getrawtransactions
             notifications.lookup_utxos = db.lookup_utxos
             MemPoolAPI.register(Notifications)
-            mempool = MemPool(env.coin, notifications)
+            # With ZMQ notifications the daemon's mempool is only polled as a
+            # safety net
+            mempool = MemPool(env.coin, notifications,
+                              resync_secs=60.0 if env.zmq_urls else None,
+                              snapshot_path='meta/mempool')
 
             session_mgr = SessionManager(env, db, bp, daemon, mempool,
                                          shutdown_event)
@@ -131,6 +144,9 @@ class Controller(ServerBase):
                 await caught_up_event.wait()
                 await group.spawn(db.populate_header_merkle_cache())
                 await group.spawn(mempool.keep_synchronized(mempool_event))
+                if env.zmq_urls:
+                    subscriber = ZMQSubscriber(env.zmq_urls, env.coin, mempool, bp.prefetcher)
+                    await group.spawn(subscriber.run())
 
             async with TaskGroup() as group:
                 await group.spawn(session_mgr.serve(notifications, mempool_event))
@@ -12,6 +12,8 @@ import asyncio
 import itertools
 import json
 import time
+from functools import partial
+from urllib.parse import urlsplit
 
 import aiohttp
 from aiorpcx import JSONRPC
@@ -32,15 +34,22 @@ class ServiceRefusedError(Exception):
     some reason.'''
 
 
+class RESTUnavailableError(Exception):
+    '''Internal - when the daemon's REST interface is not enabled or not permitted.'''
+
+
 class Daemon(object):
     '''Handles connections to a daemon at the given URL.'''
 
     WARMING_UP = -28
     id_counter = itertools.count()
 
-    def __init__(self, coin, url, *, max_workqueue=10, init_retry=0.25, max_retry=4.0):
+    def __init__(self, coin, url, *, max_workqueue=10, init_retry=0.25, max_retry=4.0,
+                 rest=False):
         self.coin = coin
         self.logger = class_logger(__name__, self.__class__.__name__)
+        # Whether to fetch raw blocks over the daemon's REST interface
+        self.rest = rest
         self.url_index = None
         self.urls = []
         self.set_url(url)
@@ -84,6 +93,13 @@ class Daemon(object):
         url = url or self.current_url()
         return url[url.rindex('@') + 1:]
 
+    def rest_url(self, path):
+        '''The URL of a REST path on the current daemon.  REST does not take
+        credentials.'''
+        parts = urlsplit(self.current_url())
+        host = parts.netloc.rpartition('@')[2]
+        return f'{parts.scheme}://{host}/rest/{path}'
+
     def failover(self):
         '''Call to fail-over to the next daemon URL.
 
@@ -111,6 +127,16 @@ class Daemon(object):
         Handles temporary connection issues.  Daemon reponse errors
         are raise through DaemonError.
         '''
+        data = json.dumps(payload)
+        return await self._request(partial(self._send_data, data), processor)
+
+    async def _request(self, request, processor):
+        '''Make a request, an async function of no arguments, and return
+        its result passed through processor.
+
+        Temporary connection issues are retried, failing over to the next
+        daemon URL as for JSON-RPC calls.
+        '''
         def log_error(error):
             nonlocal last_error_log, retry
             now = time.monotonic()
@@ -122,11 +148,10 @@ class Daemon(object):
 
         on_good_message = None
         last_error_log = -1000   # Monotonic time starts at 0
-        data = json.dumps(payload)
         retry = self.init_retry
         while True:
             try:
-                result = await self._send_data(data)
+                result = await request()
                 result = processor(result)
                 if on_good_message:
                     self.logger.info(on_good_message)
@@ -216,8 +241,41 @@ class Daemon(object):
         '''Return the deserialised block with the given hex hash.'''
         return await self._send_single('getblock', (hex_hash, True))
 
+    async def _rest_block(self, hex_hash):
+        '''Return the raw binary block with the given hex hash over REST.'''
+        async with self.workqueue_semaphore:
+            async with self.session.get(self.rest_url(f'block/{hex_hash}.bin')) as resp:
+                if resp.status == 200:
+                    return await resp.read()
+                text = (await resp.text()).strip()
+                if resp.status == 404 and hex_hash in text:
+                    # REST is enabled but the block is unknown
+                    raise DaemonError(text)
+                if resp.status in (403, 404):
+                    raise RESTUnavailableError(text or resp.reason)
+                raise ServiceRefusedError(text or resp.reason)
+
+    async def _rest_blocks(self, hex_hashes):
+        return [await self._rest_block(hex_hash) for hex_hash in hex_hashes]
+
     async def raw_blocks(self, hex_hashes):
-        '''Return the raw binary blocks with the given hex hashes.'''
+        '''Return the raw binary blocks with the given hex hashes.
+
+        If REST is enabled blocks are fetched in binary, avoiding the hex
+        encoding and JSON parsing of getblock.  Transient errors are
+        retried; if the daemon does not serve REST at all it falls back to
+        JSON-RPC for good.'''
+        hex_hashes = list(hex_hashes)
+        if self.rest:
+            try:
+                return await self._request(partial(self._rest_blocks, hex_hashes),
+                                           lambda blocks: blocks)
+            except RESTUnavailableError as e:
+                self.logger.warning(f'REST not available ({e}); falling back to JSON-RPC')
+                self.rest = False
+            except DaemonError:
+                # Let getblock report the error
+                pass
         params_iterable = ((h, False) for h in hex_hashes)
         blocks = await self._send_vector('getblock', params_iterable)
         # Convert hex string to bytes
@@ -16,16 +16,17 @@ import time
 from bisect import bisect_right
 from collections import namedtuple
 from glob import glob
+from struct import Struct
 
 import attr
 from aiorpcx import run_in_thread, sleep
 
 from electrumx.lib import util
-from electrumx.lib.hash import hash_to_hex_str
+from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
 from electrumx.lib.merkle import Merkle, MerkleCache
 from electrumx.lib.util import (
     formatted_time, pack_be_uint16, pack_be_uint32, pack_le_uint32,
-    unpack_le_uint32, unpack_be_uint32, unpack_le_uint64
+    unpack_le_uint32, unpack_le_uint32_from, unpack_be_uint32, unpack_le_uint64
 )
 from electrumx.server.storage import db_class
 from electrumx.server.history import History
@@ -33,6 +34,51 @@ from electrumx.server.history import History
 
 UTXO = namedtuple("UTXO", "tx_num tx_pos tx_hash height value")
 
+# Block digest file record header: height and size
+struct_digest_record = Struct('<IQ')
+# Per-tx: tx_hash, prevout count and output count
+struct_digest_tx = Struct('<32sII')
+# Per-output: idx, hashX and value
+struct_digest_output = Struct(f'<I{HASHX_LEN}sq')
+# Balance row: confirmed balance and UTXO count
+struct_balance = Struct('<QI')
+
+
+def pack_block_digest(header, txs):
+    '''Pack a block's header and parsed txs (see parse_block()) into a
+    digest.  It holds just what is needed to back the block up.'''
+    pack_tx = struct_digest_tx.pack
+    pack_output = struct_digest_output.pack
+    parts = [header, pack_le_uint32(len(txs))]
+    for tx_hash, prevouts, outputs in txs:
+        parts.append(pack_tx(tx_hash, len(prevouts), len(outputs)))
+        parts.extend(prevouts)
+        parts.extend(pack_output(idx, hashX, value) for idx, hashX, value in outputs)
+    return b''.join(parts)
+
+
+def unpack_block_digest(digest):
+    '''Return the (header, txs) pair packed by pack_block_digest().'''
+    unpack_tx = struct_digest_tx.unpack_from
+    tx_size = struct_digest_tx.size
+    iter_unpack_outputs = struct_digest_output.iter_unpack
+    output_size = struct_digest_output.size
+    header = digest[:80]
+    tx_count, = unpack_le_uint32_from(digest, 80)
+    offset = 84
+    txs = []
+    for _ in range(tx_count):
+        tx_hash, prevout_count, output_count = unpack_tx(digest, offset)
+        offset += tx_size
+        end = offset + prevout_count * 36
+        prevouts = tuple(digest[n:n + 36] for n in range(offset, end, 36))
+        offset = end
+        end = offset + output_count * output_size
+        outputs = tuple(iter_unpack_outputs(digest[offset:end]))
+        offset = end
+        txs.append((tx_hash, prevouts, outputs))
+    return header, txs
+
 
 @attr.s(slots=True)
 class FlushData(object):
@@ -44,7 +90,11 @@ class FlushData(object):
     undo_infos = attr.ib()
     adds = attr.ib()
     deletes = attr.ib()
+    # The 24-byte cache values of the UTXOs in deletes, for the balance rows
+    spent_values = attr.ib()
     tip = attr.ib()
+    # History taken for a background flush; None flushes History.unflushed
+    history = attr.ib(default=None)
 
 
 class DB(object):
@@ -54,7 +104,9 @@ class DB(object):
     it was shutdown uncleanly.
     '''
 
-    DB_VERSIONS = [6, 7, 8]
+    DB_VERSIONS = [6, 7, 8, 9]
+    # The most UTXO rows paged_utxos() reads
+    MAX_UTXO_SCAN = 10000
 
     class DBError(Exception):
         '''Raised on general DB errors generally indicating corruption.'''
@@ -89,9 +141,9 @@ class DB(object):
         self.merkle = Merkle()
         self.header_mc = MerkleCache(self.merkle, self.fs_block_hashes)
 
-        self.headers_file = util.LogicalFile('meta/headers', 2, 16000000)
-        self.tx_counts_file = util.LogicalFile('meta/txcounts', 2, 2000000)
-        self.hashes_file = util.LogicalFile('meta/hashes', 4, 16000000)
+        self.headers_file = util.MappedLogicalFile('meta/headers', 2, 16000000)
+        self.tx_counts_file = util.MappedLogicalFile('meta/txcounts', 2, 2000000)
+        self.hashes_file = util.MappedLogicalFile('meta/hashes', 4, 16000000)
 
     async def _read_tx_counts(self):
         if self.tx_counts is not None:
@@ -126,6 +178,7 @@ class DB(object):
         # Then history DB
         self.utxo_flush_count = self.history.open_db(self.db_class, for_sync,
                                                      self.utxo_flush_count,
+                                                     self.db_tx_count,
                                                      compacting)
         self.clear_excess_undo_info()
 
@@ -178,6 +231,7 @@ class DB(object):
         assert not flush_data.block_tx_hashes
         assert not flush_data.adds
         assert not flush_data.deletes
+        assert not flush_data.spent_values
         assert not flush_data.undo_infos
         self.history.assert_flushed()
 
@@ -196,13 +250,17 @@ class DB(object):
         self.flush_fs(flush_data)
 
         # Then history
-        self.flush_history()
+        self.flush_history(flush_data.history)
 
         # Flush state last as it reads the wall time.
         with self.utxo_db.write_batch() as batch:
             if flush_utxos:
                 self.flush_utxo_db(batch, flush_data)
             self.flush_state(batch)
+        if flush_utxos:
+            # Cleared only once committed so the UTXOs of a background flush
+            # remain visible to the block processor until they are in the DB
+            flush_data.adds.clear()
 
         # Update and put the wall time again - otherwise we drop the
         # time it took to commit the batch
@@ -235,9 +293,10 @@ class DB(object):
                           if self.fs_height >= 0 else 0)
         assert len(flush_data.block_tx_hashes) == len(flush_data.headers)
         assert flush_data.height == self.fs_height + len(flush_data.headers)
-        assert flush_data.tx_count == (self.tx_counts[-1] if self.tx_counts
-                                       else 0)
-        assert len(self.tx_counts) == flush_data.height + 1
+        # The block processor may have moved on if this is a background flush
+        assert len(self.tx_counts) >= flush_data.height + 1
+        assert flush_data.tx_count == (self.tx_counts[flush_data.height]
+                                       if flush_data.height >= 0 else 0)
         hashes = b''.join(flush_data.block_tx_hashes)
         flush_data.block_tx_hashes.clear()
         assert len(hashes) % 32 == 0
@@ -251,8 +310,8 @@ class DB(object):
         flush_data.headers.clear()
 
         offset = height_start * self.tx_counts.itemsize
-        self.tx_counts_file.write(offset,
-                                  self.tx_counts[height_start:].tobytes())
+        self.tx_counts_file.write(
+            offset, self.tx_counts[height_start:flush_data.height + 1].tobytes())
         offset = prior_tx_count * 32
         self.hashes_file.write(offset, hashes)
 
@@ -263,8 +322,8 @@ class DB(object):
             elapsed = time.monotonic() - start_time
             self.logger.info(f'flushed filesystem data in {elapsed:.2f}s')
 
-    def flush_history(self):
-        self.history.flush()
+    def flush_history(self, unflushed=None):
+        self.history.flush(unflushed)
 
     def flush_utxo_db(self, batch, flush_data):
         '''Flush the cached DB writes and UTXO set to the batch.'''
@@ -289,7 +348,10 @@ class DB(object):
             suffix = key[-4:] + value[-13:-8]
             batch_put(b'h' + key[:4] + suffix, hashX)
             batch_put(b'u' + hashX + suffix, value[-8:])
-        flush_data.adds.clear()
+
+        # Balances
+        self.flush_balances(batch, flush_data.adds, flush_data.spent_values)
+        flush_data.spent_values.clear()
 
         # New undo information
         self.flush_undo_infos(batch_put, flush_data.undo_infos)
@@ -309,6 +371,39 @@ class DB(object):
         self.db_tx_count = flush_data.tx_count
         self.db_tip = flush_data.tip
 
+    def flush_balances(self, batch, adds, spent_values):
+        '''Apply the UTXOs added and spent to the balance rows.'''
+        # hashX -> [balance delta, UTXO count delta]
+        deltas = {}
+        for sign, values in ((1, (value for _key, value in adds.items())),
+                             (-1, spent_values)):
+            for value in values:
+                hashX = value[:-13]
+                amount, = unpack_le_uint64(value[-8:])
+                delta = deltas.get(hashX)
+                if delta is None:
+                    deltas[hashX] = [sign * amount, sign]
+                else:
+                    delta[0] += sign * amount
+                    delta[1] += sign
+
+        get = self.utxo_db.get
+        for hashX in sorted(deltas):
+            amount, count = deltas[hashX]
+            if not (amount or count):
+                continue
+            key = b'b' + hashX
+            row = get(key)
+            if row:
+                balance, utxo_count = struct_balance.unpack(row)
+                amount += balance
+                count += utxo_count
+            if count:
+                batch.put(key, struct_balance.pack(amount, count))
+            else:
+                assert amount == 0
+                batch.delete(key)
+
     def flush_state(self, batch):
         '''Flush chain state to the batch.'''
         now = time.time()
@@ -333,6 +428,7 @@ class DB(object):
             self.flush_utxo_db(batch, flush_data)
             # Flush state last as it reads the wall time.
             self.flush_state(batch)
+        flush_data.adds.clear()
 
         elapsed = self.last_flush - start_time
         self.logger.info(f'backup flush #{self.history.flush_count:,d} took '
@@ -388,6 +484,52 @@ class DB(object):
             tx_hash = self.hashes_file.read(tx_num * 32, 32)
         return tx_hash, tx_height
 
+    def fs_tx_hashes(self, tx_nums):
+        '''Return a list of (tx_hash, tx_height) pairs, as fs_tx_hash()
+        returns, for a sorted sequence of tx numbers.
+
+        The search of tx_counts resumes from the previous height, and is
+        skipped within a block.  The hashes of runs of nearby tx numbers
+        are read in one go.'''
+        tx_counts = self.tx_counts
+        db_height = self.db_height
+        read = self.hashes_file.read
+        result = []
+        append = result.append
+        count = len(tx_nums)
+        height = 0
+        n = 0
+        while n < count:
+            first = tx_nums[n]
+            height = bisect_right(tx_counts, first, height)
+            if height > db_height:
+                # As are all the rest
+                for tx_num in tx_nums[n:]:
+                    height = bisect_right(tx_counts, tx_num, height)
+                    append((None, height))
+                break
+            end = n + 1
+            while end < count and tx_nums[end] - tx_nums[end - 1] <= 16:
+                end += 1
+            if end == n + 1:
+                append((read(first * 32, 32), height))
+                n = end
+                continue
+
+            hashes = read(first * 32, (tx_nums[end - 1] - first + 1) * 32)
+            block_end = tx_counts[height]
+            for tx_num in tx_nums[n:end]:
+                if tx_num >= block_end:
+                    height = bisect_right(tx_counts, tx_num, height)
+                    if height > db_height:
+                        append((None, height))
+                        continue
+                    block_end = tx_counts[height]
+                offset = (tx_num - first) * 32
+                append((hashes[offset:offset + 32], height))
+            n = end
+        return result
+
     def fs_tx_hashes_at_blockheight(self, block_height):
         '''Return a list of tx_hashes at given block height,
         in the same order as in the block.
@@ -400,9 +542,9 @@ class DB(object):
         else:
             first_tx_num = 0
         num_txs_in_block = self.tx_counts[block_height] - first_tx_num
-        tx_hashes = self.hashes_file.read(first_tx_num * 32, num_txs_in_block * 32)
+        tx_hashes = self.hashes_file.view(first_tx_num * 32, num_txs_in_block * 32)
         assert num_txs_in_block == len(tx_hashes) // 32
-        return [tx_hashes[idx * 32: (idx+1) * 32] for idx in range(num_txs_in_block)]
+        return [bytes(tx_hashes[idx * 32: (idx+1) * 32]) for idx in range(num_txs_in_block)]
 
     async def tx_hashes_at_blockheight(self, block_height):
         return await run_in_thread(self.fs_tx_hashes_at_blockheight, block_height)
@@ -421,23 +563,51 @@ class DB(object):
 
         return [self.coin.header_hash(header) for header in headers]
 
-    async def limited_history(self, hashX, *, limit=1000):
+    async def limited_history(self, hashX, *, limit=1000, from_height=0, to_height=None):
         '''Return an unpruned, sorted list of (tx_hash, height) tuples of
         confirmed transactions that touched the address, earliest in
         the blockchain first.  Includes both spending and receiving
         transactions.  By default returns at most 1000 entries.  Set
         limit to None to get them all.
+
+        Only transactions with from_height <= height and, if to_height is
+        not None, height < to_height are returned.  Only that slice of the
+        history is read.
+        '''
+        history, _cursor = await self.history_page(
+            hashX, limit=limit, from_height=from_height, to_height=to_height)
+        return history
+
+    async def history_page(self, hashX, *, limit=1000, from_height=0, to_height=None,
+                           cursor=0):
+        '''Return a pair (history, cursor).  history is as returned by
+        limited_history() but starts at tx number cursor.  Pass the
+        returned cursor to read the next page; it is None when there are
+        no more.
         '''
+        def tx_num_at(height):
+            # The first tx_num at the height
+            if height <= 0:
+                return 0
+            tx_counts = self.tx_counts
+            return tx_counts[min(height, len(tx_counts)) - 1]
+
         def read_history():
-            tx_nums = list(self.history.get_txnums(hashX, limit))
-            fs_tx_hash = self.fs_tx_hash
-            return [fs_tx_hash(tx_num) for tx_num in tx_nums]
+            start = max(tx_num_at(from_height), cursor)
+            end = None if to_height is None else tx_num_at(to_height)
+            # Read one more to find the next page's cursor
+            tx_nums = list(self.history.get_txnums(
+                hashX, None if limit is None else limit + 1, start=start, end=end))
+            next_cursor = None
+            if limit is not None and len(tx_nums) > limit:
+                next_cursor = tx_nums.pop()
+            return self.fs_tx_hashes(tx_nums), next_cursor
 
         while True:
-            history = await run_in_thread(read_history)
+            history, next_cursor = await run_in_thread(read_history)
             if all(hash is not None for hash, height in history):
-                return history
-            self.logger.warning('limited_history: tx hash not found (reorg?), retrying...')
+                return history, next_cursor
+            self.logger.warning('history_page: tx hash not found (reorg?), retrying...')
             await sleep(0.25)
 
     # -- Undo information
@@ -460,26 +630,68 @@ class DB(object):
             filtered = list(filter(None, undo_info))
             batch_put(self.undo_key(height), b''.join(filtered))
 
-    def raw_block_prefix(self):
-        return 'meta/block'
-
-    def raw_block_path(self, height):
-        return f'{self.raw_block_prefix()}{height:d}'
-
-    def read_raw_block(self, height):
-        '''Returns a raw block read from disk.  Raises FileNotFoundError
-        if the block isn't on-disk.'''
-        with util.open_file(self.raw_block_path(height)) as f:
-            return f.read(-1)
+    # -- Block digests
+    #
+    # Backing up a block needs only its header and parsed txs, so a
+    # compact digest of those is kept for blocks that may be backed up.
+    # Digests are appended to segment files of DIGEST_SEGMENT heights
+    # each, the last record for a height being current.  Segments are
+    # deleted once they are entirely below the undo height.
+
+    DIGEST_SEGMENT = 16
+
+    def block_digest_path(self, segment):
+        return f'meta/digests{segment:d}'
+
+    @staticmethod
+    def _digest_records(f):
+        '''Yield (height, start, size) for each complete record in a block
+        digest file.'''
+        file_size = os.fstat(f.fileno()).st_size
+        record_len = struct_digest_record.size
+        offset = 0
+        while offset + record_len <= file_size:
+            f.seek(offset)
+            height, size = struct_digest_record.unpack(f.read(record_len))
+            start = offset + record_len
+            if start + size > file_size:
+                break
+            yield height, start, size
+            offset = start + size
 
-    def write_raw_block(self, block, height):
-        '''Write a raw block to disk.'''
-        with util.open_truncate(self.raw_block_path(height)) as f:
-            f.write(block)
-        # Delete old blocks to prevent them accumulating
+    def read_block_digest(self, height):
+        '''Return the (header, txs) pair of the block at the given height
+        as parse_block() does, or None if it has no digest on disk.'''
         try:
-            del_height = self.min_undo_height(height) - 1
-            os.remove(self.raw_block_path(del_height))
+            with util.open_file(self.block_digest_path(height // self.DIGEST_SEGMENT)) as f:
+                location = None
+                for record_height, start, size in self._digest_records(f):
+                    if record_height == height:
+                        location = start, size
+                if location is None:
+                    return None
+                start, size = location
+                f.seek(start)
+                return unpack_block_digest(f.read(size))
+        except FileNotFoundError:
+            return None
+
+    def write_block_digest(self, height, header, txs):
+        '''Write the digest of a block to disk.'''
+        digest = pack_block_digest(header, txs)
+        segment = height // self.DIGEST_SEGMENT
+        with util.open_file(self.block_digest_path(segment), create=True) as f:
+            # Drop any partial record left by a crash
+            end = 0
+            for _height, start, size in self._digest_records(f):
+                end = start + size
+            f.seek(end)
+            f.truncate()
+            f.write(struct_digest_record.pack(height, len(digest)) + digest)
+        # Delete old segments to prevent them accumulating
+        old_segment = self.min_undo_height(height) // self.DIGEST_SEGMENT - 1
+        try:
+            os.remove(self.block_digest_path(old_segment))
         except FileNotFoundError:
             pass
 
@@ -500,11 +712,13 @@ class DB(object):
                     batch.delete(key)
             self.logger.info(f'deleted {len(keys):,d} stale undo entries')
 
-        # delete old block files
-        prefix = self.raw_block_prefix()
+        # Delete old block digest segments, and any raw block files from
+        # before digests were kept
+        prefix = self.block_digest_path(0)[:-1]
+        min_segment = min_height // self.DIGEST_SEGMENT
         paths = [path for path in glob(f'{prefix}[0-9]*')
-                 if len(path) > len(prefix)
-                 and int(path[len(prefix):]) < min_height]
+                 if int(path[len(prefix):]) < min_segment]
+        paths.extend(glob('meta/block[0-9]*'))
         if paths:
             for path in paths:
                 try:
@@ -575,6 +789,17 @@ class DB(object):
         self.logger.info(f'UTXO DB version: {self.db_version}')
         self.logger.info('Upgrading your DB; this can take some time...')
 
+        if self.db_version < 8:
+            self.upgrade_utxo_keys()
+        if self.db_version < 9:
+            self.upgrade_balances()
+
+        self.db_version = max(self.DB_VERSIONS)
+        with self.utxo_db.write_batch() as batch:
+            self.write_utxo_state(batch)
+
+    def upgrade_utxo_keys(self):
+        '''Upgrade the UTXO table keys to 5-byte tx_nums.'''
         def upgrade_u_prefix(prefix):
             count = 0
             with self.utxo_db.write_batch() as batch:
@@ -650,11 +875,37 @@ class DB(object):
             tx_counts = array.array('Q', tx_counts)
             self.tx_counts_file.write(0, tx_counts.tobytes())
 
-        self.db_version = max(self.DB_VERSIONS)
+        self.db_version = 8
         with self.utxo_db.write_batch() as batch:
             self.write_utxo_state(batch)
         self.logger.info('DB 2 of 3 upgraded successfully')
 
+    def upgrade_balances(self):
+        '''Write the balance rows from the UTXO table.'''
+        def upgrade_prefix(prefix):
+            balances = {}
+            # Key: b'u' + address_hashX + tx_idx + tx_num
+            for db_key, db_value in self.utxo_db.iterator(prefix=b'u' + prefix):
+                hashX = db_key[1:-9]
+                value, = unpack_le_uint64(db_value)
+                balance, utxo_count = balances.get(hashX, (0, 0))
+                balances[hashX] = (balance + value, utxo_count + 1)
+            with self.utxo_db.write_batch() as batch:
+                for hashX, (balance, utxo_count) in balances.items():
+                    batch.put(b'b' + hashX, struct_balance.pack(balance, utxo_count))
+            return len(balances)
+
+        last = time.monotonic()
+        count = 0
+        for cursor in range(65536):
+            count += upgrade_prefix(pack_be_uint16(cursor))
+            now = time.monotonic()
+            if now > last + 10:
+                last = now
+                self.logger.info(f'DB balances: {count:,d} addresses written, '
+                                 f'{cursor * 100 / 65536:.1f}% complete')
+        self.logger.info('DB balances written successfully')
+
     def write_utxo_state(self, batch):
         '''Write (UTXO) state to the batch.'''
         state = {
@@ -669,16 +920,19 @@ class DB(object):
         }
         batch.put(b'state', repr(state).encode())
 
-    def set_flush_count(self, count):
-        self.utxo_flush_count = count
-        with self.utxo_db.write_batch() as batch:
-            self.write_utxo_state(batch)
+    async def confirmed_balance(self, hashX):
+        '''Return a (balance, UTXO count) pair for an address.'''
+        def read_balance():
+            row = self.utxo_db.get(b'b' + hashX)
+            return struct_balance.unpack(row) if row else (0, 0)
+
+        return await run_in_thread(read_balance)
 
     async def all_utxos(self, hashX):
         '''Return all UTXOs for an address sorted in no particular order.'''
         def read_utxos():
-            utxos = []
-            utxos_append = utxos.append
+            entries = []
+            entries_append = entries.append
             # Key: b'u' + address_hashX + tx_idx + tx_num
             # Value: the UTXO value as a 64-bit unsigned integer
             prefix = b'u' + hashX
@@ -686,9 +940,11 @@ class DB(object):
                 tx_pos, = unpack_le_uint32(db_key[-9:-5])
                 tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
                 value, = unpack_le_uint64(db_value)
-                tx_hash, height = self.fs_tx_hash(tx_num)
-                utxos_append(UTXO(tx_num, tx_pos, tx_hash, height, value))
-            return utxos
+                entries_append((tx_num, tx_pos, value))
+            tx_nums = sorted({tx_num for tx_num, _tx_pos, _value in entries})
+            tx_hashes = dict(zip(tx_nums, self.fs_tx_hashes(tx_nums)))
+            return [UTXO(tx_num, tx_pos, *tx_hashes[tx_num], value)
+                    for tx_num, tx_pos, value in entries]
 
         while True:
             utxos = await run_in_thread(read_utxos)
@@ -697,6 +953,84 @@ class DB(object):
             self.logger.warning('all_utxos: tx hash not found (reorg?), retrying...')
             await sleep(0.25)
 
+    async def paged_utxos(self, hashX, *, min_value=0, limit=1000, cursor=b''):
+        '''Return a pair (utxos, cursor).  utxos is a list of at most limit
+        UTXOs of an address with a value of at least min_value, in DB key
+        order.  At most MAX_UTXO_SCAN rows are read, so there may be fewer.
+        Pass the returned cursor to read the next page; it is None when
+        there are no more.
+
+        Only the rows returned need their tx hash read.
+        '''
+        def read_utxos():
+            entries = []
+            cursor_key = None
+            prefix = b'u' + hashX
+            # Keys are all the same length so this follows the cursor key
+            start = prefix + cursor + b'\0' if cursor else prefix
+            # Key: b'u' + address_hashX + tx_idx + tx_num
+            # Value: the UTXO value as a 64-bit unsigned integer
+            for count, (db_key, db_value) in enumerate(
+                    self.utxo_db.iterator_from(prefix, start)):
+                if len(entries) == limit or count == self.MAX_UTXO_SCAN:
+                    cursor_key = last_key
+                    break
+                last_key = db_key
+                value, = unpack_le_uint64(db_value)
+                if value < min_value:
+                    continue
+                tx_pos, = unpack_le_uint32(db_key[-9:-5])
+                tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
+                entries.append((tx_num, tx_pos, value))
+            tx_nums = sorted({tx_num for tx_num, _tx_pos, _value in entries})
+            tx_hashes = dict(zip(tx_nums, self.fs_tx_hashes(tx_nums)))
+            utxos = [UTXO(tx_num, tx_pos, *tx_hashes[tx_num], value)
+                     for tx_num, tx_pos, value in entries]
+            return utxos, (cursor_key[-9:] if cursor_key else None)
+
+        while True:
+            utxos, next_cursor = await run_in_thread(read_utxos)
+            if all(utxo.tx_hash is not None for utxo in utxos):
+                return utxos, next_cursor
+            self.logger.warning('paged_utxos: tx hash not found (reorg?), retrying...')
+            await sleep(0.25)
+
+    def lookup_spent_utxos(self, prevouts):
+        '''Look up the UTXOs spent by prevouts, an iterable of 36-byte
+        TX_HASH + TX_IDX keys.
+
+        Return a dictionary mapping each prevout found to a (hdb_key,
+        udb_key, value) triple, value being the 24-byte cache value.  Each
+        table is read in key order so bulk lookups are largely sequential.
+        '''
+        # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
+        # Value: hashX
+        iterator = self.utxo_db.iterator
+        candidates = []
+        for prefix, prevout in sorted((b'h' + prevout[:4] + prevout[32:], prevout)
+                                      for prevout in prevouts):
+            matches = list(iterator(prefix=prefix))
+            for hdb_key, hashX in matches:
+                if len(matches) > 1:
+                    tx_num, = unpack_le_uint64(hdb_key[-5:] + bytes(3))
+                    fs_hash, _height = self.fs_tx_hash(tx_num)
+                    if fs_hash != prevout[:32]:
+                        assert fs_hash is not None  # Should always be found
+                        continue
+                candidates.append((b'u' + hashX + hdb_key[-9:], hdb_key, prevout))
+
+        # Key: b'u' + address_hashX + tx_idx + tx_num
+        # Value: the UTXO value as a 64-bit unsigned integer
+        get = self.utxo_db.get
+        utxos = {}
+        for udb_key, hdb_key, prevout in sorted(candidates):
+            if prevout not in utxos:
+                utxo_value_packed = get(udb_key)
+                if utxo_value_packed:
+                    utxos[prevout] = (hdb_key, udb_key,
+                                      udb_key[1:-9] + udb_key[-5:] + utxo_value_packed)
+        return utxos
+
     async def lookup_utxos(self, prevouts):
         '''For each prevout, lookup it up in the DB and return a (hashX,
         value) pair or None if not found.
@@ -12,7 +12,7 @@ import re
 from ipaddress import IPv4Address, IPv6Address
 
 from aiorpcx import Service, ServicePart
-from electrumx.lib.coins import Coin
+from electrumx.lib.coins import Novo
 from electrumx.lib.env_base import EnvBase
 
 
@@ -42,13 +42,17 @@ class Env(EnvBase):
 
         self.db_dir = self.required('DB_DIRECTORY')
         self.daemon_url = self.required('DAEMON_URL')
+        self.daemon_rest = self.boolean('DAEMON_REST', False)
+        self.blocks_dir = self.default('BLOCKS_DIR', None)
+        self.zmq_urls = [url.strip() for url in self.default('ZMQ_URL', '').split(',')
+                         if url.strip()]
         if coin is not None:
-            assert issubclass(coin, Coin)
+            assert issubclass(coin, Novo)
             self.coin = coin
         else:
             coin_name = self.required('COIN').strip()
             network = self.default('NET', 'mainnet').strip()
-            self.coin = Coin.lookup_coin_class(coin_name, network)
+            self.coin = Novo.lookup_coin_class(coin_name, network)
 
         # Peer discovery
 
@@ -71,6 +75,11 @@ class Env(EnvBase):
         self.drop_client = self.custom("DROP_CLIENT", None, re.compile)
         self.cache_MB = self.integer('CACHE_MB', 1200)
         self.reorg_limit = self.integer('REORG_LIMIT', self.coin.REORG_LIMIT)
+        self.parse_processes = self.integer('PARSE_PROCESSES', 0)
+        self.pipelined_flush = self.boolean('PIPELINED_FLUSH', False)
+        self.compact_utxo_cache = self.boolean('COMPACT_UTXO_CACHE', False)
+        self.prefetch_MB = self.integer('PREFETCH_MB', 200)
+        self.prefetch_concurrency = self.integer('PREFETCH_CONCURRENCY', 4)
 
         # Server limits to help prevent DoS
 
@@ -84,6 +93,7 @@ class Env(EnvBase):
         self.request_sleep = self.integer('REQUEST_SLEEP', 2500)
         self.request_timeout = self.integer('REQUEST_TIMEOUT', 30)
         self.session_timeout = self.integer('SESSION_TIMEOUT', 600)
+        self.status_cache_MB = self.integer('STATUS_CACHE_MB', 16)
 
         # Services last - uses some env vars above
 
@@ -15,15 +15,29 @@ import time
 from collections import defaultdict
 
 from electrumx.lib import util
-from electrumx.lib.util import (
-    pack_be_uint16, pack_le_uint64, unpack_be_uint16_from, unpack_le_uint64,
-)
+from electrumx.lib.util import pack_be_uint16, pack_le_uint64, unpack_le_uint64
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
 
 
+def tx_num_key(tx_num):
+    '''The 5-byte big-endian key suffix of a history row ending at tx_num.'''
+    return tx_num.to_bytes(5, 'big')
+
+
+def row_key(hashX, hist):
+    '''The key of a history row.
+
+    Rows are keyed by hashX and the tx_num of their last entry, so the
+    row holding a tx_num is the first with a key not less than
+    hashX + tx_num_key(tx_num).  The last entry is the little-endian
+    form of that suffix.
+    '''
+    return hashX + bytes(hist[-5:][::-1])
+
+
 class History(object):
 
-    DB_VERSIONS = [0, 1]
+    DB_VERSIONS = [0, 1, 2]
 
     def __init__(self):
         self.logger = util.class_logger(__name__, self.__class__.__name__)
@@ -32,16 +46,15 @@ class History(object):
         self.unflushed = defaultdict(bytearray)
         self.unflushed_count = 0
         self.flush_count = 0
-        self.comp_flush_count = -1
         self.comp_cursor = -1
         self.db_version = max(self.DB_VERSIONS)
         self.upgrade_cursor = -1
         self.db = None
 
-    def open_db(self, db_class, for_sync, utxo_flush_count, compacting):
+    def open_db(self, db_class, for_sync, utxo_flush_count, tx_count, compacting):
         self.db = db_class('hist', for_sync)
         self.read_state()
-        self.clear_excess(utxo_flush_count)
+        self.clear_excess(utxo_flush_count, tx_count)
         # An incomplete compaction needs to be cancelled otherwise
         # restarting it will corrupt the history
         if not compacting:
@@ -60,13 +73,11 @@ class History(object):
             if not isinstance(state, dict):
                 raise RuntimeError('failed reading state from history DB')
             self.flush_count = state['flush_count']
-            self.comp_flush_count = state.get('comp_flush_count', -1)
             self.comp_cursor = state.get('comp_cursor', -1)
             self.db_version = state.get('db_version', 0)
             self.upgrade_cursor = state.get('upgrade_cursor', -1)
         else:
             self.flush_count = 0
-            self.comp_flush_count = -1
             self.comp_cursor = -1
             self.db_version = max(self.DB_VERSIONS)
             self.upgrade_cursor = -1
@@ -81,36 +92,35 @@ class History(object):
         self.logger.info(f'history DB version: {self.db_version}')
         self.logger.info(f'flush count: {self.flush_count:,d}')
 
-    def clear_excess(self, utxo_flush_count):
-        # < might happen at end of compaction as both DBs cannot be
-        # updated atomically
+    def clear_excess(self, utxo_flush_count, tx_count):
+        '''Remove history flushed after the UTXO DB was last flushed, that
+        is history of tx_nums >= tx_count.'''
         if self.flush_count <= utxo_flush_count:
             return
 
         self.logger.info('DB shut down uncleanly.  Scanning for '
                          'excess history flushes...')
 
-        keys = []
+        key_len = HASHX_LEN + 5
+        hashXs = set()
         for key, _hist in self.db.iterator(prefix=b''):
-            flush_id, = unpack_be_uint16_from(key[-2:])
-            if flush_id > utxo_flush_count:
-                keys.append(key)
-
-        self.logger.info(f'deleting {len(keys):,d} history entries')
+            # Ignore non-history entries
+            if len(key) != key_len:
+                continue
+            if int.from_bytes(key[-5:], 'big') >= tx_count:
+                hashXs.add(key[:HASHX_LEN])
 
         self.flush_count = utxo_flush_count
         with self.db.write_batch() as batch:
-            for key in keys:
-                batch.delete(key)
+            nremoves = self._remove_history(batch, hashXs, tx_count)
             self.write_state(batch)
 
-        self.logger.info('deleted excess history entries')
+        self.logger.info(f'deleted {nremoves:,d} excess history entries')
 
     def write_state(self, batch):
         '''Write state to the history DB.'''
         state = {
             'flush_count': self.flush_count,
-            'comp_flush_count': self.comp_flush_count,
             'comp_cursor': self.comp_cursor,
             'db_version': self.db_version,
             'upgrade_cursor': self.upgrade_cursor,
@@ -131,26 +141,38 @@ class History(object):
         self.unflushed_count += count
 
     def unflushed_memsize(self):
-        return len(self.unflushed) * 180 + self.unflushed_count * 5
+        return util.sampled_getsizeof(self.unflushed)
 
     def assert_flushed(self):
         assert not self.unflushed
 
-    def flush(self):
+    def take_unflushed(self):
+        '''Return the unflushed history and start afresh.
+
+        The returned history can be passed to flush() in another thread
+        while new history accumulates.'''
+        unflushed = self.unflushed
+        self.unflushed = defaultdict(bytearray)
+        self.unflushed_count = 0
+        return unflushed
+
+    def flush(self, unflushed=None):
+        '''Flush the unflushed history, or a history previously returned by
+        take_unflushed().'''
         start_time = time.monotonic()
         self.flush_count += 1
-        flush_id = pack_be_uint16(self.flush_count)
-        unflushed = self.unflushed
+        if unflushed is None:
+            unflushed = self.unflushed
+            self.unflushed_count = 0
 
         with self.db.write_batch() as batch:
             for hashX in sorted(unflushed):
-                key = hashX + flush_id
-                batch.put(key, bytes(unflushed[hashX]))
+                hist = bytes(unflushed[hashX])
+                batch.put(row_key(hashX, hist), hist)
             self.write_state(batch)
 
         count = len(unflushed)
         unflushed.clear()
-        self.unflushed_count = 0
 
         if self.db.for_sync:
             elapsed = time.monotonic() - start_time
@@ -160,45 +182,86 @@ class History(object):
     def backup(self, hashXs, tx_count):
         # Not certain this is needed, but it doesn't hurt
         self.flush_count += 1
-        nremoves = 0
-        bisect_left = bisect.bisect_left
-        chunks = util.chunks
 
         with self.db.write_batch() as batch:
-            for hashX in sorted(hashXs):
-                deletes = []
-                puts = {}
-                for key, hist in self.db.iterator(prefix=hashX, reverse=True):
-                    a = array.array('Q')
-                    a.frombytes(b''.join(item + bytes(3) for item in chunks(hist, 5)))
-                    # Remove all history entries >= tx_count
-                    idx = bisect_left(a, tx_count)
-                    nremoves += len(a) - idx
-                    if idx > 0:
-                        puts[key] = hist[:5 * idx]
-                        break
-                    deletes.append(key)
-
-                for key in deletes:
-                    batch.delete(key)
-                for key, value in puts.items():
-                    batch.put(key, value)
+            nremoves = self._remove_history(batch, hashXs, tx_count)
             self.write_state(batch)
 
         self.logger.info(f'backing up removed {nremoves:,d} history entries')
 
-    def get_txnums(self, hashX, limit=1000):
+    def _remove_history(self, batch, hashXs, tx_count):
+        '''Remove the history entries >= tx_count of the hashXs to the batch.
+        Returns the number of entries removed.'''
+        nremoves = 0
+        bisect_left = bisect.bisect_left
+        chunks = util.chunks
+
+        for hashX in sorted(hashXs):
+            deletes = []
+            puts = {}
+            for key, hist in self.db.iterator(prefix=hashX, reverse=True):
+                a = array.array('Q')
+                a.frombytes(b''.join(item + bytes(3) for item in chunks(hist, 5)))
+                # Remove all history entries >= tx_count
+                idx = bisect_left(a, tx_count)
+                nremoves += len(a) - idx
+                if idx == len(a):
+                    break
+                deletes.append(key)
+                if idx > 0:
+                    # The truncated row is keyed by its new last entry
+                    hist = hist[:5 * idx]
+                    puts[row_key(hashX, hist)] = hist
+                    break
+
+            for key in deletes:
+                batch.delete(key)
+            for key, value in puts.items():
+                batch.put(key, value)
+
+        return nremoves
+
+    def get_txnums(self, hashX, limit=1000, *, start=0, end=None):
         '''Generator that returns an unpruned, sorted list of tx_nums in the
         history of a hashX.  Includes both spending and receiving
         transactions.  By default yields at most 1000 entries.  Set
-        limit to None to get them all.  '''
+        limit to None to get them all.
+
+        Only tx_nums >= start and, if end is not None, < end are yielded.
+        Rows are keyed by their last tx_num, so reading seeks to the row
+        holding start and stops at end.
+        '''
         limit = util.resolve_limit(limit)
         chunks = util.chunks
-        for _key, hist in self.db.iterator(prefix=hashX):
-            for tx_numb in chunks(hist, 5):
+
+        def row_tx_num(hist, idx):
+            tx_num, = unpack_le_uint64(hist[idx * 5: idx * 5 + 5] + bytes(3))
+            return tx_num
+
+        if start:
+            rows = self.db.iterator_from(hashX, hashX + tx_num_key(start))
+        else:
+            rows = self.db.iterator(prefix=hashX)
+
+        for _key, hist in rows:
+            first = 0
+            if start:
+                count = len(hist) // 5
+                # Bisect to the first entry >= start
+                hi = count
+                while first < hi:
+                    mid = (first + hi) // 2
+                    if row_tx_num(hist, mid) < start:
+                        first = mid + 1
+                    else:
+                        hi = mid
+                start = 0
+            for tx_numb in chunks(hist[first * 5:], 5):
                 if limit == 0:
                     return
                 tx_num, = unpack_le_uint64(tx_numb + bytes(3))
+                if end is not None and tx_num >= end:
+                    return
                 yield tx_num
                 limit -= 1
 
@@ -212,22 +275,14 @@ class History(object):
     #     been compacted, and later ones have not.
     # 65536: compaction complete in-memory but not flushed
     #
-    # comp_flush_count applies during compaction, and is a flush count
-    #     for history with prefix < comp_cursor.  flush_count applies
-    #     to still uncompacted history.  It is -1 when no compaction is
-    #     taking place.  Key suffixes up to and including comp_flush_count
-    #     are used, so a parallel history flush must first increment this
-    #
-    # When compaction is complete and the final flush takes place,
-    # flush_count is reset to comp_flush_count, and comp_flush_count to -1
+    # Compacted rows are keyed by their last tx_num like flushed rows,
+    # so compaction leaves the flush count alone.
 
     def _flush_compaction(self, cursor, write_items, keys_to_delete):
         '''Flush a single compaction pass as a batch.'''
         # Update compaction state
         if cursor == 65536:
-            self.flush_count = self.comp_flush_count
             self.comp_cursor = -1
-            self.comp_flush_count = -1
         else:
             self.comp_cursor = cursor
 
@@ -265,7 +320,7 @@ class History(object):
         keys_to_delete.update(hist_map)
         n = 0   # In case of no loops
         for n, chunk in enumerate(util.chunks(full_hist, max_row_size)):
-            key = hashX + pack_be_uint16(n)
+            key = row_key(hashX, chunk)
             if hist_map.get(key) == chunk:
                 keys_to_delete.remove(key)
             else:
@@ -273,7 +328,6 @@ class History(object):
                 write_size += len(chunk)
 
         assert n + 1 == nrows
-        self.comp_flush_count = max(self.comp_flush_count, n)
 
         return write_size
 
@@ -284,13 +338,13 @@ class History(object):
         hist_map = {}
         hist_list = []
 
-        key_len = HASHX_LEN + 2
+        key_len = HASHX_LEN + 5
         write_size = 0
         for key, hist in self.db.iterator(prefix=prefix):
             # Ignore non-history entries
             if len(key) != key_len:
                 continue
-            hashX = key[:-2]
+            hashX = key[:HASHX_LEN]
             if hashX != prior_hashX and prior_hashX:
                 write_size += self._compact_hashX(prior_hashX, hist_map,
                                                   hist_list, write_items,
@@ -322,20 +376,17 @@ class History(object):
                                                keys_to_delete)
             cursor += 1
 
-        max_rows = self.comp_flush_count + 1
         self._flush_compaction(cursor, write_items, keys_to_delete)
 
         self.logger.info('history compaction: wrote {:,d} rows ({:.1f} MB), '
-                         'removed {:,d} rows, largest: {:,d}, {:.1f}% complete'
+                         'removed {:,d} rows, {:.1f}% complete'
                          .format(len(write_items), write_size / 1000000,
-                                 len(keys_to_delete), max_rows,
-                                 100 * cursor / 65536))
+                                 len(keys_to_delete), 100 * cursor / 65536))
         return write_size
 
     def _cancel_compaction(self):
         if self.comp_cursor != -1:
             self.logger.warning('cancelling in-progress history compaction')
-            self.comp_flush_count = -1
             self.comp_cursor = -1
 
     #
@@ -346,11 +397,20 @@ class History(object):
         self.logger.info(f'history DB version: {self.db_version}')
         self.logger.info('Upgrading your history DB; this can take some time...')
 
-        def upgrade_cursor(cursor):
+        def convert_entries(key, hist, batch):
+            # Version 1: 5-byte tx_nums
+            return key, b''.join(item + b'\0' for item in util.chunks(hist, 4))
+
+        def rekey_row(key, hist, batch):
+            # Version 2: rows keyed by their last tx_num rather than flush id
+            batch.delete(key)
+            return row_key(key[:HASHX_LEN], hist), hist
+
+        def upgrade_cursor(cursor, upgrade_row):
             count = 0
             prefix = pack_be_uint16(cursor)
+            # Both upgrades apply to rows keyed by flush id
             key_len = HASHX_LEN + 2
-            chunks = util.chunks
             with self.db.write_batch() as batch:
                 batch_put = batch.put
                 for key, hist in self.db.iterator(prefix=prefix):
@@ -358,25 +418,27 @@ class History(object):
                     if len(key) != key_len:
                         continue
                     count += 1
-                    hist = b''.join(item + b'\0' for item in chunks(hist, 4))
-                    batch_put(key, hist)
+                    batch_put(*upgrade_row(key, hist, batch))
                 self.upgrade_cursor = cursor
                 self.write_state(batch)
             return count
 
-        last = time.monotonic()
-        count = 0
+        upgrades = {1: convert_entries, 2: rekey_row}
+        while self.db_version < max(self.DB_VERSIONS):
+            upgrade_row = upgrades[self.db_version + 1]
+            last = time.monotonic()
+            count = 0
 
-        for cursor in range(self.upgrade_cursor + 1, 65536):
-            count += upgrade_cursor(cursor)
-            now = time.monotonic()
-            if now > last + 10:
-                last = now
-                self.logger.info(f'DB 3 of 3: {count:,d} entries updated, '
-                                 f'{cursor * 100 / 65536:.1f}% complete')
+            for cursor in range(self.upgrade_cursor + 1, 65536):
+                count += upgrade_cursor(cursor, upgrade_row)
+                now = time.monotonic()
+                if now > last + 10:
+                    last = now
+                    self.logger.info(f'DB 3 of 3: {count:,d} entries updated, '
+                                     f'{cursor * 100 / 65536:.1f}% complete')
 
-        self.db_version = max(self.DB_VERSIONS)
-        self.upgrade_cursor = -1
-        with self.db.write_batch() as batch:
-            self.write_state(batch)
+            self.db_version += 1
+            self.upgrade_cursor = -1
+            with self.db.write_batch() as batch:
+                self.write_state(batch)
         self.logger.info('DB 3 of 3 upgraded successfully')
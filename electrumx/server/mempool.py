@@ -8,15 +8,21 @@
 '''Mempool handling.'''
 
 import itertools
+import os
 import time
 from abc import ABC, abstractmethod
+from asyncio import Event
 from collections import defaultdict
+from struct import Struct
 
 import attr
-from aiorpcx import TaskGroup, run_in_thread, sleep
+from aiorpcx import TaskGroup, ignore_after, run_in_thread, sleep
 
 from electrumx.lib.hash import hash_to_hex_str, hex_str_to_hash
-from electrumx.lib.util import class_logger, chunks
+from electrumx.lib.util import (
+    class_logger, chunks, pack_byte, pack_le_uint32, pack_le_uint64,
+    unpack_le_uint32_from, unpack_le_uint64_from,
+)
 from electrumx.server.db import UTXO
 
 
@@ -41,6 +47,12 @@ class DBSyncError(Exception):
     pass
 
 
+# Snapshot header: version, DB height, DB tip, tx count
+snapshot_header = Struct('<II32sI')
+# Per tx after its hash: fee, size, input count, output count
+snapshot_tx = Struct('<QIII')
+
+
 class MemPoolAPI(ABC):
     '''A concrete instance of this class is passed to the MemPool object
     and used by it to query DB and blockchain state.'''
@@ -59,6 +71,10 @@ class MemPoolAPI(ABC):
     def db_height(self):
         '''Return the height flushed to the on-disk DB.'''
 
+    @abstractmethod
+    def db_tip(self):
+        '''Return the hash of the block at db_height().'''
+
     @abstractmethod
     async def mempool_hashes(self):
         '''Query bitcoind for the hashes of all transactions in its
@@ -96,19 +112,66 @@ class MemPool(object):
     response to the calls in the external interface.  To that end we
     maintain the following maps:
 
-       tx:     tx_hash -> MemPoolTx
-       hashXs: hashX   -> set of all hashes of txs touching the hashX
+       tx:        tx_hash -> MemPoolTx
+       hashXs:    hashX   -> set of all hashes of txs touching the hashX
+       deltas:    hashX   -> net unconfirmed value of txs touching the hashX
+       utxos:     hashX   -> (tx_hash, tx_pos) -> UTXO of outputs paying it
+       spends:    hashX   -> set of prevouts of its outputs that txs spend
+       summaries: tx_hash -> MemPoolTxSummary
+       children:  tx_hash -> set of hashes of mempool txs spending it
+       fee_histogram: fee rate -> total size of txs paying it
+
+    All are updated as transactions are accepted and removed.  The
+    compact fee histogram is rebuilt from fee_histogram after a refresh
+    that changed it.
+
+    If snapshot_path is given the transactions are written there on
+    shutdown, tagged with the DB height and tip they were synchronized
+    against.  If the DB is still at that block on startup they are
+    reloaded, and only the difference from the daemon's mempool is
+    fetched.
+
+    If resync_secs is None the daemon's mempool is polled every
+    refresh_secs.  Otherwise transactions are pushed with the notify_
+    methods, for example by a ZMQSubscriber, and the mempool refreshes as
+    they arrive from just those transactions.  The daemon's full mempool
+    is then only polled after a new block, and otherwise every
+    resync_secs in case a notification was missed or a transaction left
+    the mempool without one.
     '''
 
-    def __init__(self, coin, api, refresh_secs=5.0, log_status_secs=60.0):
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self, coin, api, refresh_secs=5.0, log_status_secs=60.0,
+                 resync_secs=None, snapshot_path=None):
         assert isinstance(api, MemPoolAPI)
         self.coin = coin
         self.api = api
         self.logger = class_logger(__name__, self.__class__.__name__)
         self.txs = {}
         self.hashXs = defaultdict(set)  # None can be a key
+        self.deltas = defaultdict(int)
+        self.utxos = defaultdict(dict)
+        self.spends = defaultdict(set)
+        self.summaries = {}
+        self.children = defaultdict(set)
+        self.fee_histogram = defaultdict(int)
+        self.cached_compact_histogram = []
+        self.histogram_changed = False
         self.refresh_secs = refresh_secs
         self.log_status_secs = log_status_secs
+        self.resync_secs = resync_secs
+        # Pushed notifications: added tx hashes to their raw txs or None,
+        # and the hashes of removed txs
+        self.notified_adds = {}
+        self.notified_removes = set()
+        self.resync_due = True
+        self.refresh_event = Event()
+        self.snapshot_path = snapshot_path
+        # The DB height and tip the transactions were last synchronized
+        # against
+        self.synced_height = None
+        self.synced_tip = None
 
     async def _logging(self, synchronized_event):
         '''Print regular logs of mempool stats.'''
@@ -125,20 +188,80 @@ class MemPool(object):
             await sleep(self.log_status_secs)
             await synchronized_event.wait()
 
-    def _accept_transactions(self, tx_map, utxo_map, touched):
+    @staticmethod
+    def _fee_rate(tx):
+        '''The histogram key of a tx: its fee rate in tenths of a satoshi
+        per byte, rounded down so it falls in the expected interval of
+        the compact histogram.'''
+        return tx.fee * 10 // tx.size if tx.size else 0
+
+    def _update_compact_histogram(self, bin_size=100_000):
+        histogram = {fee_rate / 10: size for fee_rate, size in self.fee_histogram.items()}
+        self.cached_compact_histogram = self._compress_histogram(histogram, bin_size=bin_size)
+        self.histogram_changed = False
+
+    @classmethod
+    def _compress_histogram(cls, histogram, *, bin_size):
+        '''Return a compact fee histogram from a map of fee rate to size,
+        as needed for "mempool.get_fee_histogram".
+
+        The compact histogram is a list of (fee_rate, size) pairs in
+        decreasing fee rate order.  size_n is the cumulative size of
+        mempool transactions with a fee rate in the interval
+        [rate_n, rate_(n-1)).  Intervals are chosen to create tranches
+        of at least bin_size bytes, growing by 10% each time.
+        '''
+        assert bin_size > 0
+        compact = []
+        cum_size = 0
+        prev_fee_rate = None
+        for fee_rate, size in sorted(histogram.items(), reverse=True):
+            # If there is a big lump of txs at this fee rate, close the
+            # previous tranche first so it is not swamped
+            if size > 2 * bin_size and prev_fee_rate is not None and cum_size > 0:
+                compact.append((prev_fee_rate, cum_size))
+                cum_size = 0
+                bin_size *= 1.1
+            cum_size += size
+            if cum_size > bin_size:
+                compact.append((fee_rate, cum_size))
+                cum_size = 0
+                bin_size *= 1.1
+            prev_fee_rate = fee_rate
+        return compact
+
+    def _accept_transactions(self, tx_map, utxo_map, parents, touched):
         '''Accept transactions in tx_map to the mempool if all their inputs
-        can be found in the existing mempool or a utxo_map from the
-        DB.
+        can be found in the existing mempool, a utxo_map from the DB, or
+        other transactions in tx_map.
 
-        Returns an (unprocessed tx_map, unspent utxo_map) pair.
+        parents maps the hashes of transactions in tx_map to the set of
+        mempool transactions they spend.  Transactions are visited in a
+        single pass in topological order, each once all its parents in
+        tx_map have been visited.
+
+        Returns the number of transactions not accepted.
         '''
-        hashXs = self.hashXs
         txs = self.txs
 
-        deferred = {}
-        unspent = set(utxo_map)
-        # Try to find all prevouts so we can accept the TX
-        for tx_hash, tx in tx_map.items():
+        # The count of unvisited parents of each tx waiting on them
+        pending = {}
+        children = defaultdict(list)
+        for tx_hash, tx_parents in parents.items():
+            count = 0
+            for parent in tx_parents:
+                if parent in tx_map:
+                    children[parent].append(tx_hash)
+                    count += 1
+            if count:
+                pending[tx_hash] = count
+        ready = [tx_hash for tx_hash in tx_map if tx_hash not in pending]
+
+        accepted = 0
+        while ready:
+            tx_hash = ready.pop()
+            tx = tx_map[tx_hash]
+            # Try to find all prevouts so we can accept the TX
             in_pairs = []
             try:
                 for prevout in tx.prevouts:
@@ -149,105 +272,224 @@ class MemPool(object):
                         utxo = txs[prev_hash].out_pairs[prev_index]
                     in_pairs.append(utxo)
             except KeyError:
-                deferred[tx_hash] = tx
+                # Its descendants are never ready so are not accepted either
                 continue
 
-            # Spend the prevouts
-            unspent.difference_update(tx.prevouts)
-
             # Save the in_pairs, compute the fee and accept the TX
             tx.in_pairs = tuple(in_pairs)
             # Avoid negative fees if dealing with generation-like transactions
             # because some in_parts would be missing
             tx.fee = max(0, (sum(v for _, v in tx.in_pairs) -
                              sum(v for _, v in tx.out_pairs)))
-            txs[tx_hash] = tx
+            self._add_tx(tx_hash, tx, touched)
+            accepted += 1
+
+            for child in children.pop(tx_hash, ()):
+                pending[child] -= 1
+                if not pending[child]:
+                    del pending[child]
+                    ready.append(child)
+
+        return len(tx_map) - accepted
 
-            for hashX, _value in itertools.chain(tx.in_pairs, tx.out_pairs):
-                touched.add(hashX)
-                hashXs[hashX].add(tx_hash)
+    def _add_tx(self, tx_hash, tx, touched):
+        '''Add an accepted transaction and update the aggregates.'''
+        txs = self.txs
+        hashXs = self.hashXs
+        deltas = self.deltas
+        utxos = self.utxos
+        spends = self.spends
+
+        tx_parents = {prev_hash for prev_hash, _prev_idx in tx.prevouts
+                      if prev_hash in txs}
+        for prev_hash in tx_parents:
+            self.children[prev_hash].add(tx_hash)
+        txs[tx_hash] = tx
+        self.summaries[tx_hash] = MemPoolTxSummary(tx_hash, tx.fee, bool(tx_parents))
+        self.fee_histogram[self._fee_rate(tx)] += tx.size
+        self.histogram_changed = True
+
+        for prevout, (hashX, value) in zip(tx.prevouts, tx.in_pairs):
+            deltas[hashX] -= value
+            spends[hashX].add(prevout)
+        for tx_pos, (hashX, value) in enumerate(tx.out_pairs):
+            deltas[hashX] += value
+            utxos[hashX][(tx_hash, tx_pos)] = UTXO(-1, tx_pos, tx_hash, 0, value)
+        for hashX, _value in itertools.chain(tx.in_pairs, tx.out_pairs):
+            touched.add(hashX)
+            hashXs[hashX].add(tx_hash)
+
+    def _remove_txs(self, tx_hashes, touched):
+        '''Remove transactions and update the aggregates.'''
+        txs = self.txs
+        hashXs = self.hashXs
+        deltas = self.deltas
+        utxos = self.utxos
+        spends = self.spends
+        children = self.children
+
+        fee_histogram = self.fee_histogram
+
+        orphans = set()
+        for tx_hash in tx_hashes:
+            tx = txs.pop(tx_hash)
+            del self.summaries[tx_hash]
+            fee_rate = self._fee_rate(tx)
+            fee_histogram[fee_rate] -= tx.size
+            if not fee_histogram[fee_rate]:
+                del fee_histogram[fee_rate]
+            self.histogram_changed = True
+            orphans.update(children.pop(tx_hash, ()))
+            for prev_hash, _prev_idx in tx.prevouts:
+                if prev_hash in children:
+                    children[prev_hash].discard(tx_hash)
+
+            for prevout, (hashX, value) in zip(tx.prevouts, tx.in_pairs):
+                deltas[hashX] += value
+                spends[hashX].discard(prevout)
+            for tx_pos, (hashX, value) in enumerate(tx.out_pairs):
+                deltas[hashX] -= value
+                del utxos[hashX][(tx_hash, tx_pos)]
+            tx_hashXs = set(hashX for hashX, value in tx.in_pairs)
+            tx_hashXs.update(hashX for hashX, value in tx.out_pairs)
+            for hashX in tx_hashXs:
+                hashXs[hashX].remove(tx_hash)
+                if not hashXs[hashX]:
+                    del hashXs[hashX]
+                    del deltas[hashX]
+                    utxos.pop(hashX, None)
+                    spends.pop(hashX, None)
+            touched.update(tx_hashXs)
 
-        return deferred, {prevout: utxo_map[prevout] for prevout in unspent}
+        # Children whose parents have all gone, typically into a block,
+        # no longer have unconfirmed inputs
+        for tx_hash in orphans:
+            if tx_hash in txs:
+                tx = txs[tx_hash]
+                self.summaries[tx_hash].has_unconfirmed_inputs = any(
+                    prev_hash in txs for prev_hash, _prev_idx in tx.prevouts)
 
     async def _refresh_hashes(self, synchronized_event):
         '''Refresh our view of the daemon's mempool.'''
         # Touched accumulates between calls to on_mempool and each
         # call transfers ownership
         touched = set()
+        next_resync = 0
+        await self._load_snapshot(touched)
         while True:
             height = self.api.cached_height()
-            hex_hashes = await self.api.mempool_hashes()
-            if height != await self.api.height():
-                continue
-            hashes = set(hex_str_to_hash(hh) for hh in hex_hashes)
+            # Take notifications before querying the height so that any
+            # for a new block's transactions are seen with a new height
+            raw_txs, removes = self.notified_adds, self.notified_removes
+            self.notified_adds, self.notified_removes = {}, set()
+            full_resync = (self.resync_secs is None or self.resync_due
+                           or time.monotonic() >= next_resync)
+            # Cleared first so a block notified during the resync is not missed
+            self.resync_due = False
             try:
-                await self._process_mempool(hashes, touched, height)
+                if full_resync:
+                    if self.resync_secs is not None and height != self.api.db_height():
+                        # Don't fetch the daemon's mempool before the DB catches up
+                        raise DBSyncError
+                    hex_hashes = await self.api.mempool_hashes()
+                    hashes = set(hex_str_to_hash(hh) for hh in hex_hashes)
+                else:
+                    hashes = set(self.txs).difference(removes)
+                    hashes.update(raw_txs)
+                if height != await self.api.height():
+                    # A new block; the raw txs may still be useful
+                    self._restore_notified(raw_txs)
+                    self.resync_due = True
+                    continue
+                await self._process_mempool(hashes, touched, height, raw_txs)
             except DBSyncError:
                 # The UTXO DB is not at the same height as the
                 # mempool; wait and try again
                 self.logger.debug('waiting for DB to sync')
+                if self.resync_secs is not None:
+                    self._restore_notified(raw_txs)
+                    self.resync_due = True
+                    await sleep(0.25)
+                    continue
             else:
+                if full_resync and self.resync_secs is not None:
+                    next_resync = time.monotonic() + self.resync_secs
+                if self.histogram_changed:
+                    self._update_compact_histogram()
                 synchronized_event.set()
                 synchronized_event.clear()
                 await self.api.on_mempool(touched, height)
                 touched = set()
+            await self._wait_for_refresh(next_resync)
+
+    def _restore_notified(self, raw_txs):
+        raw_txs.update(self.notified_adds)
+        self.notified_adds = raw_txs
+
+    async def _wait_for_refresh(self, next_resync):
+        '''Wait until the next poll, or with pushed notifications until one
+        arrives or a resync is due.'''
+        if self.resync_secs is None:
             await sleep(self.refresh_secs)
+            return
+        async with ignore_after(max(next_resync - time.monotonic(), 0)):
+            await self.refresh_event.wait()
+        self.refresh_event.clear()
 
-    async def _process_mempool(self, all_hashes, touched, mempool_height):
+    async def _process_mempool(self, all_hashes, touched, mempool_height, raw_txs=None):
         # Re-sync with the new set of hashes
         txs = self.txs
-        hashXs = self.hashXs
 
         if mempool_height != self.api.db_height():
             raise DBSyncError
+        self.synced_height = mempool_height
+        self.synced_tip = self.api.db_tip()
 
         # First handle txs that have disappeared
-        for tx_hash in set(txs).difference(all_hashes):
-            tx = txs.pop(tx_hash)
-            tx_hashXs = set(hashX for hashX, value in tx.in_pairs)
-            tx_hashXs.update(hashX for hashX, value in tx.out_pairs)
-            for hashX in tx_hashXs:
-                hashXs[hashX].remove(tx_hash)
-                if not hashXs[hashX]:
-                    del hashXs[hashX]
-            touched.update(tx_hashXs)
+        self._remove_txs(set(txs).difference(all_hashes), touched)
 
         # Process new transactions
         new_hashes = list(all_hashes.difference(txs))
         if new_hashes:
             group = TaskGroup()
             for hashes in chunks(new_hashes, 200):
-                coro = self._fetch_and_accept(hashes, all_hashes, touched)
+                coro = self._fetch_transactions(hashes, all_hashes, raw_txs or {})
                 await group.spawn(coro)
 
             tx_map = {}
             utxo_map = {}
+            parents = {}
             async for task in group:
-                deferred, unspent = task.result()
-                tx_map.update(deferred)
-                utxo_map.update(unspent)
-
-            prior_count = 0
-            # FIXME: this is not particularly efficient
-            while tx_map and len(tx_map) != prior_count:
-                prior_count = len(tx_map)
-                tx_map, utxo_map = self._accept_transactions(tx_map, utxo_map,
-                                                             touched)
-            if tx_map:
-                self.logger.error(f'{len(tx_map)} txs dropped')
+                chunk_txs, chunk_utxos, chunk_parents = task.result()
+                tx_map.update(chunk_txs)
+                utxo_map.update(chunk_utxos)
+                parents.update(chunk_parents)
+
+            dropped = self._accept_transactions(tx_map, utxo_map, parents, touched)
+            if dropped:
+                self.logger.error(f'{dropped:,d} txs dropped')
 
         return touched
 
-    async def _fetch_and_accept(self, hashes, all_hashes, touched):
-        '''Fetch a list of mempool transactions.'''
-        hex_hashes_iter = (hash_to_hex_str(hash) for hash in hashes)
-        raw_txs = await self.api.raw_transactions(hex_hashes_iter)
+    async def _fetch_transactions(self, hashes, all_hashes, known_raw_txs):
+        '''Fetch a list of mempool transactions.  Those in known_raw_txs, a
+        map of tx hash to raw tx, are not fetched from the daemon.
+
+        Returns a (tx_map, utxo_map, parents) triple for
+        _accept_transactions().'''
+        raw_txs = [known_raw_txs.get(tx_hash) for tx_hash in hashes]
+        missing = [tx_hash for tx_hash, raw_tx in zip(hashes, raw_txs) if raw_tx is None]
+        if missing:
+            hex_hashes_iter = (hash_to_hex_str(hash) for hash in missing)
+            fetched = iter(await self.api.raw_transactions(hex_hashes_iter))
+            raw_txs = [next(fetched) if raw_tx is None else raw_tx for raw_tx in raw_txs]
 
         def deserialize_txs():    # This function is pure
             to_hashX = self.coin.hashX_from_script
             deserializer = self.coin.DESERIALIZER
 
             txs = {}
+            parents = {}
             for tx_hash, raw_tx in zip(hashes, raw_txs):
                 # The daemon may have evicted the tx from its
                 # mempool or it may have gotten in a block
@@ -263,10 +505,15 @@ class MemPool(object):
                                     for txout in tx.outputs)
                 txs[tx_hash] = MemPoolTx(txin_pairs, None, txout_pairs,
                                          0, tx_size)
-            return txs
+                # The mempool transactions this one spends
+                tx_parents = {prev_hash for prev_hash, _prev_idx in txin_pairs
+                              if prev_hash in all_hashes}
+                if tx_parents:
+                    parents[tx_hash] = tx_parents
+            return txs, parents
 
         # Thread this potentially slow operation so as not to block
-        tx_map = await run_in_thread(deserialize_txs)
+        tx_map, parents = await run_in_thread(deserialize_txs)
 
         # Determine all prevouts not in the mempool, and fetch the
         # UTXO information from the database.  Failed prevout lookups
@@ -279,56 +526,163 @@ class MemPool(object):
         utxos = await self.api.lookup_utxos(prevouts)
         utxo_map = {prevout: utxo for prevout, utxo in zip(prevouts, utxos)}
 
-        return self._accept_transactions(tx_map, utxo_map, touched)
+        return tx_map, utxo_map, parents
+
+    def _write_snapshot(self):
+        '''Write the transactions to the snapshot file.  They are in the
+        order accepted so parents precede their children.'''
+        def pack_pair(pair):
+            hashX, value = pair
+            hashX = hashX or b''
+            return pack_byte(len(hashX)) + hashX + pack_le_uint64(value)
+
+        parts = [snapshot_header.pack(self.SNAPSHOT_VERSION, self.synced_height,
+                                      self.synced_tip, len(self.txs))]
+        for tx_hash, tx in self.txs.items():
+            parts.append(tx_hash)
+            parts.append(snapshot_tx.pack(tx.fee, tx.size, len(tx.prevouts),
+                                          len(tx.out_pairs)))
+            parts.extend(prev_hash + pack_le_uint32(prev_idx)
+                         for prev_hash, prev_idx in tx.prevouts)
+            parts.extend(pack_pair(pair) for pair in tx.in_pairs)
+            parts.extend(pack_pair(pair) for pair in tx.out_pairs)
+
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(parts))
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _read_snapshot(self):
+        '''Read and remove the snapshot file.  Return a (height, tip, tx_map)
+        tuple.'''
+        with open(self.snapshot_path, 'rb') as f:
+            data = f.read()
+        os.remove(self.snapshot_path)
+
+        version, height, tip, count = snapshot_header.unpack_from(data)
+        if version != self.SNAPSHOT_VERSION:
+            raise ValueError(f'unknown snapshot version {version:d}')
+        cursor = snapshot_header.size
+
+        def read_pair():
+            nonlocal cursor
+            hashX_len = data[cursor]
+            hashX = data[cursor + 1: cursor + 1 + hashX_len] or None
+            cursor += 1 + hashX_len
+            value, = unpack_le_uint64_from(data, cursor)
+            cursor += 8
+            return hashX, value
+
+        tx_map = {}
+        for _ in range(count):
+            tx_hash = data[cursor: cursor + 32]
+            fee, size, in_count, out_count = snapshot_tx.unpack_from(data, cursor + 32)
+            cursor += 32 + snapshot_tx.size
+            prevouts = []
+            for _ in range(in_count):
+                prevouts.append((data[cursor: cursor + 32],
+                                 unpack_le_uint32_from(data, cursor + 32)[0]))
+                cursor += 36
+            in_pairs = tuple(read_pair() for _ in range(in_count))
+            out_pairs = tuple(read_pair() for _ in range(out_count))
+            tx_map[tx_hash] = MemPoolTx(tuple(prevouts), in_pairs, out_pairs, fee, size)
+        if cursor != len(data):
+            raise ValueError('snapshot has trailing data')
+        return height, tip, tx_map
+
+    async def _load_snapshot(self, touched):
+        '''Restore the transactions of a snapshot taken at the current DB
+        height and tip.  The first refresh then reconciles them with the
+        daemon.'''
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            height, tip, tx_map = await run_in_thread(self._read_snapshot)
+        except Exception as e:   # pylint:disable=W0703
+            self.logger.error(f'ignoring mempool snapshot: {e!r}')
+            return
+        # A reorg to the same height leaves the height but not the tip
+        if height != self.api.db_height() or tip != self.api.db_tip():
+            self.logger.info(f'ignoring mempool snapshot from block '
+                             f'{hash_to_hex_str(tip)} height {height:,d}')
+            return
+        for tx_hash, tx in tx_map.items():
+            self._add_tx(tx_hash, tx, touched)
+        self.synced_height = height
+        self.synced_tip = tip
+        self.logger.info(f'loaded {len(tx_map):,d} txs from mempool snapshot')
+
+    def save_snapshot(self):
+        '''Write a snapshot of the transactions if they have been
+        synchronized with the DB.'''
+        if not self.snapshot_path or self.synced_height is None:
+            return
+        try:
+            self._write_snapshot()
+        except OSError as e:
+            self.logger.error(f'error writing mempool snapshot: {e!r}')
+        else:
+            self.logger.info(f'wrote snapshot of {len(self.txs):,d} mempool txs')
 
     #
     # External interface
     #
 
-    async def keep_synchronized(self, synchronized_event):
-        '''Keep the mempool synchronized with the daemon.'''
-        async with TaskGroup() as group:
-            await group.spawn(self._refresh_hashes(synchronized_event))
-            await group.spawn(self._logging(synchronized_event))
+    def notify_tx(self, tx_hash, raw_tx=None):
+        '''Notify that a transaction entered the daemon's mempool, with its
+        raw form if known.'''
+        if raw_tx is not None or tx_hash not in self.notified_adds:
+            self.notified_adds[tx_hash] = raw_tx
+        self.notified_removes.discard(tx_hash)
+        self.refresh_event.set()
+
+    def notify_tx_removed(self, tx_hash):
+        '''Notify that a transaction left the daemon's mempool.'''
+        self.notified_adds.pop(tx_hash, None)
+        self.notified_removes.add(tx_hash)
+        self.refresh_event.set()
+
+    def notify_block(self):
+        '''Notify that the daemon's chain tip changed.'''
+        self.resync_due = True
+        self.refresh_event.set()
 
-            async for task in group:
-                if not task.cancelled():
-                    task.result()
+    async def keep_synchronized(self, synchronized_event):
+        '''Keep the mempool synchronized with the daemon.  A snapshot is
+        saved on exit.'''
+        try:
+            async with TaskGroup() as group:
+                await group.spawn(self._refresh_hashes(synchronized_event))
+                await group.spawn(self._logging(synchronized_event))
+
+                async for task in group:
+                    if not task.cancelled():
+                        task.result()
+        finally:
+            self.save_snapshot()
 
     async def balance_delta(self, hashX):
         '''Return the unconfirmed amount in the mempool for hashX.
 
         Can be positive or negative.
         '''
-        value = 0
-        if hashX in self.hashXs:
-            for hash_ in self.hashXs[hashX]:
-                tx = self.txs[hash_]
-                value -= sum(v for h168, v in tx.in_pairs if h168 == hashX)
-                value += sum(v for h168, v in tx.out_pairs if h168 == hashX)
-        return value
+        return self.deltas.get(hashX, 0)
 
-    async def potential_spends(self, hashX):
-        '''Return a set of (prev_hash, prev_idx) pairs from mempool
-        transactions that touch hashX.
+    async def compact_fee_histogram(self):
+        '''Return a compact fee histogram of the current mempool.'''
+        return self.cached_compact_histogram
 
-        None, some or all of these may be spends of the hashX, but all
-        actual spends of it (in the DB or mempool) will be included.
+    async def potential_spends(self, hashX):
+        '''Return a set of (prev_hash, prev_idx) pairs of the outputs
+        paying hashX, in the DB or mempool, that mempool transactions
+        spend.
         '''
-        result = set()
-        for tx_hash in self.hashXs.get(hashX, ()):
-            tx = self.txs[tx_hash]
-            result.update(tx.prevouts)
-        return result
+        return set(self.spends.get(hashX, ()))
 
     async def transaction_summaries(self, hashX):
         '''Return a list of MemPoolTxSummary objects for the hashX.'''
-        result = []
-        for tx_hash in self.hashXs.get(hashX, ()):
-            tx = self.txs[tx_hash]
-            has_ui = any(hash in self.txs for hash, idx in tx.prevouts)
-            result.append(MemPoolTxSummary(tx_hash, tx.fee, has_ui))
-        return result
+        summaries = self.summaries
+        return [summaries[tx_hash] for tx_hash in self.hashXs.get(hashX, ())]
 
     async def unordered_UTXOs(self, hashX):
         '''Return an unordered list of UTXO named tuples from mempool
@@ -337,10 +691,4 @@ class MemPool(object):
         This does not consider if any other mempool transactions spend
         the outputs.
         '''
-        utxos = []
-        for tx_hash in self.hashXs.get(hashX, ()):
-            tx = self.txs.get(tx_hash)
-            for pos, (hX, value) in enumerate(tx.out_pairs):
-                if hX == hashX:
-                    utxos.append(UTXO(-1, pos, tx_hash, 0, value))
-        return utxos
+        return list(self.utxos.get(hashX, {}).values())
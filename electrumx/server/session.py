@@ -8,12 +8,14 @@
 '''Classes for local RPC server and remote client TCP/SSL servers.'''
 
 import codecs
+import hashlib
 import itertools
 import json
 import math
 import os
 import ssl
 import time
+from bisect import bisect_left
 from collections import defaultdict
 from functools import partial
 from ipaddress import IPv4Address, IPv6Address
@@ -30,7 +32,7 @@ import electrumx
 from electrumx.lib.merkle import MerkleCache
 from electrumx.lib.text import sessions_lines
 from electrumx.lib import util
-from electrumx.lib.hash import (sha256, hash_to_hex_str, hex_str_to_hash, HASHX_LEN, Base58Error,
+from electrumx.lib.hash import (hash_to_hex_str, hex_str_to_hash, HASHX_LEN, Base58Error,
                                 double_sha256)
 from electrumx.server.daemon import DaemonError
 from electrumx.server.peers import PeerManager
@@ -107,6 +109,69 @@ class SessionReferences:
     unknown = attr.ib()     # Strings
 
 
+class StatusCache:
+    '''An LRU cache of SHA-256 midstates of the confirmed part of address
+    statuses.
+
+    Confirmed history only grows at its tail except in reorgs, so a midstate
+    can be extended with newly confirmed entries rather than the whole status
+    string being formatted and hashed again.  Entries are bounded by a memory
+    budget, see STATUS_CACHE_MB, and short histories are cheap to hash so are
+    not cached.
+
+    A cached midstate is reused if the last entry it hashed is still at the
+    same position in the history.  That only holds because confirmed history
+    changes other than at its tail just in reorgs, so the cache must be
+    cleared on every reorg; SessionManager does so on the block processor's
+    backed_up_event.
+    '''
+
+    # Approximate bytes per entry: the hash object and its context, the
+    # entry tuple and the LRU node
+    ENTRY_SIZE = 500
+    MIN_HISTORY = 10
+
+    def __init__(self, max_MB):
+        # pylru needs a positive size; nothing is cached with a budget of 0
+        self.size = max_MB * 1_000_000 // self.ENTRY_SIZE
+        self.cache = pylru.lrucache(max(1, self.size))
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def clear(self):
+        self.cache.clear()
+
+    def hasher(self, hashX, history):
+        '''Return a pair (hasher, size).  hasher is a SHA-256 object that has
+        hashed the status string of the confirmed history, and that the caller
+        is free to update.  size is the length of status string hashed to
+        bring the midstate up to date.'''
+        self.lookups += 1
+        count = 0
+        entry = self.cache.get(hashX)
+        if entry is not None:
+            count, last, hasher = entry
+            # The cached prefix must still be a prefix of the history
+            if count <= len(history) and history[count - 1] == last:
+                self.hits += 1
+            else:
+                count = 0
+        if not count:
+            hasher = hashlib.sha256()
+        status = ''.join(f'{hash_to_hex_str(tx_hash)}:{height:d}:'
+                         for tx_hash, height in history[count:]).encode()
+        hasher.update(status)
+        if len(history) >= self.MIN_HISTORY and self.size:
+            self.cache[hashX] = (len(history), history[-1], hasher)
+            hasher = hasher.copy()
+        elif entry is not None:
+            del self.cache[hashX]
+        return hasher, len(status)
+
+
 class SessionManager:
     '''Holds global state about all sessions.'''
 
@@ -138,6 +203,7 @@ class SessionManager:
         self._merkle_cache = pylru.lrucache(1000)
         self._merkle_lookups = 0
         self._merkle_hits = 0
+        self._status_cache = StatusCache(env.status_cache_MB)
         self.notified_height = None
         self.hsub_results = None
         self._sslc = None
@@ -258,10 +324,11 @@ class SessionManager:
         '''Clear caches on chain reorgs.'''
         while True:
             await self.bp.backed_up_event.wait()
-            self.logger.info('reorg signalled; clearing tx_hashes and merkle caches')
+            self.logger.info('reorg signalled; clearing tx_hashes, merkle and status caches')
             self._reorg_count += 1
             self._tx_hashes_cache.clear()
             self._merkle_cache.clear()
+            self._status_cache.clear()
 
     async def _recalc_concurrency(self):
         '''Periodically recalculate session concurrency.'''
@@ -294,6 +361,7 @@ class SessionManager:
         cache_fmt = '{:,d} lookups {:,d} hits {:,d} entries'
         sessions = self.sessions
         return {
+            'cache policy': self.bp.cache_policy.info(),
             'coin': self.env.coin.__name__,
             'daemon': self.daemon.logged_url(),
             'daemon height': self.daemon.cached_height(),
@@ -306,6 +374,7 @@ class SessionManager:
                 self._merkle_lookups, self._merkle_hits, len(self._merkle_cache)),
             'pid': os.getpid(),
             'peers': self.peer_mgr.info(),
+            'prefetcher': self.bp.prefetcher.info(),
             'request counts': self._method_counts,
             'request total': sum(self._method_counts.values()),
             'sessions': {
@@ -316,6 +385,8 @@ class SessionManager:
                 'pending requests': sum(s.unanswered_request_count() for s in sessions),
                 'subs': sum(s.sub_count() for s in sessions),
             },
+            'status cache': cache_fmt.format(
+                self._status_cache.lookups, self._status_cache.hits, len(self._status_cache)),
             'tx hashes cache': cache_fmt.format(
                 self._tx_hashes_lookups, self._tx_hashes_hits, len(self._tx_hashes_cache)),
             'txs sent': self.txs_sent,
@@ -814,10 +885,20 @@ class SessionManager:
         self.txs_sent += 1
         return hex_hash
 
-    async def limited_history(self, hashX):
+    async def limited_history(self, hashX, from_height=0, to_height=None):
         '''Returns a pair (history, cost).
 
-        History is a sorted list of (tx_hash, height) tuples, or an RPCError.'''
+        History is a sorted list of (tx_hash, height) tuples, or an RPCError.
+        If from_height or to_height is given only history with from_height <=
+        height < to_height is returned; see history_page() for reading a
+        range too large to return whole.'''
+        if from_height or to_height is not None:
+            history, cursor, cost = await self.history_page(hashX, from_height, to_height)
+            if cursor is not None:
+                raise RPCError(BAD_REQUEST, 'history too large for the height range; use '
+                               'blockchain.scripthash.get_history_paged', cost=cost)
+            return history, cost
+
         # History DoS limit.  Each element of history is about 99 bytes when encoded
         # as JSON.
         limit = self.env.max_send // 99
@@ -837,6 +918,38 @@ class SessionManager:
             raise result
         return result, cost
 
+    async def history_page(self, hashX, from_height=0, to_height=None, cursor=0):
+        '''Returns a triple (history, cursor, cost).
+
+        History is a sorted list of at most as many (tx_hash, height) tuples
+        as limited_history() returns, with from_height <= height < to_height
+        and starting at tx number cursor.  The returned cursor is passed to
+        read the next page; it is None when there are no more.
+
+        A first page is served from the history cache when the full history
+        is cached.  Otherwise only the page is read from the DB and it is
+        not cached.'''
+        limit = self.env.max_send // 99
+        if not cursor:
+            self._history_lookups += 1
+            result = self._history_cache.get(hashX)
+            # A cached history is shorter than limit
+            if isinstance(result, list):
+                self._history_hits += 1
+                heights = [height for _tx_hash, height in result]
+                start = bisect_left(heights, from_height)
+                end = len(heights) if to_height is None else bisect_left(heights, to_height)
+                return result[start:end], None, 0.1
+
+        result, cursor = await self.db.history_page(
+            hashX, limit=limit, from_height=from_height, to_height=to_height,
+            cursor=cursor)
+        return result, cursor, 0.2 + len(result) * 0.001
+
+    def status_hasher(self, hashX, history):
+        '''Return a pair (hasher, size); see StatusCache.hasher().'''
+        return self._status_cache.hasher(hashX, history)
+
     async def _notify_sessions(self, height, touched):
         '''Notify sessions about height changes and touched addresses.'''
         height_changed = height != self.notified_height
@@ -991,6 +1104,8 @@ class ElectrumX(SessionBase):
 
     PROTOCOL_MIN = (1, 4)
     PROTOCOL_MAX = (1, 4, 2)
+    # The most UTXOs blockchain.scripthash.listunspent_paged returns
+    MAX_UTXO_PAGE = 5000
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1132,18 +1247,18 @@ class ElectrumX(SessionBase):
         db_history, cost = await self.session_mgr.limited_history(hashX)
         mempool = await self.mempool.transaction_summaries(hashX)
 
-        status = ''.join(f'{hash_to_hex_str(tx_hash)}:'
-                         f'{height:d}:'
-                         for tx_hash, height in db_history)
-        status += ''.join(f'{hash_to_hex_str(tx.hash)}:'
-                          f'{-tx.has_unconfirmed_inputs:d}:'
-                          for tx in mempool)
+        # The confirmed part is hashed incrementally from a cached midstate
+        hasher, size = self.session_mgr.status_hasher(hashX, db_history)
+        status = ''.join(f'{hash_to_hex_str(tx.hash)}:'
+                         f'{-tx.has_unconfirmed_inputs:d}:'
+                         for tx in mempool)
+        hasher.update(status.encode())
 
         # Add status hashing cost
-        self.bump_cost(cost + 0.1 + len(status) * 0.00002)
+        self.bump_cost(cost + 0.1 + (size + len(status)) * 0.00002)
 
-        if status:
-            status = sha256(status.encode()).hex()
+        if db_history or mempool:
+            status = hasher.hexdigest()
         else:
             status = None
 
@@ -1185,10 +1300,9 @@ class ElectrumX(SessionBase):
         return result
 
     async def get_balance(self, hashX):
-        utxos = await self.db.all_utxos(hashX)
-        confirmed = sum(utxo.value for utxo in utxos)
+        confirmed, _utxo_count = await self.db.confirmed_balance(hashX)
         unconfirmed = await self.mempool.balance_delta(hashX)
-        self.bump_cost(1.0 + len(utxos) / 50)
+        self.bump_cost(1.0)
         return {'confirmed': confirmed, 'unconfirmed': unconfirmed}
 
     async def scripthash_get_balance(self, scripthash):
@@ -1206,18 +1320,70 @@ class ElectrumX(SessionBase):
         self.bump_cost(0.25 + len(result) / 50)
         return result
 
-    async def confirmed_and_unconfirmed_history(self, hashX):
+    async def confirmed_and_unconfirmed_history(self, hashX, from_height=0, to_height=-1):
         # Note history is ordered but unconfirmed is unordered in e-s
-        history, cost = await self.session_mgr.limited_history(hashX)
+        # A to_height of -1 means all confirmed history and the mempool
+        history, cost = await self.session_mgr.limited_history(
+            hashX, from_height, None if to_height == -1 else to_height)
         self.bump_cost(cost)
         conf = [{'tx_hash': hash_to_hex_str(tx_hash), 'height': height}
                 for tx_hash, height in history]
+        if to_height != -1:
+            return conf
         return conf + await self.unconfirmed_history(hashX)
 
-    async def scripthash_get_history(self, scripthash):
-        '''Return the confirmed and unconfirmed history of a scripthash.'''
+    async def scripthash_get_history(self, scripthash, from_height=0, to_height=-1):
+        '''Return the confirmed and unconfirmed history of a scripthash.
+
+        from_height: only return history at or above this height
+        to_height: only return history below this height; -1 includes the
+           mempool
+        '''
+        hashX = scripthash_to_hashX(scripthash)
+        from_height = non_negative_integer(from_height)
+        if to_height != -1:
+            to_height = non_negative_integer(to_height)
+        return await self.confirmed_and_unconfirmed_history(hashX, from_height, to_height)
+
+    async def scripthash_get_history_paged(self, scripthash, from_height=0, to_height=-1,
+                                           cursor=None):
+        '''Return a page of the confirmed and unconfirmed history of a
+        scripthash, and a cursor for the next page.
+
+        from_height: only return history at or above this height
+        to_height: only return history below this height; -1 includes the
+           mempool
+        cursor: None for the first page, otherwise the cursor returned with
+           the previous page
+        '''
         hashX = scripthash_to_hashX(scripthash)
-        return await self.confirmed_and_unconfirmed_history(hashX)
+        from_height = non_negative_integer(from_height)
+        if to_height != -1:
+            to_height = non_negative_integer(to_height)
+        if cursor is None:
+            tx_num = 0
+        else:
+            try:
+                raw_cursor = bytes.fromhex(cursor)
+            except (ValueError, TypeError):
+                raw_cursor = b''
+            if len(raw_cursor) != 5:
+                raise RPCError(BAD_REQUEST, f'invalid cursor: {cursor}')
+            tx_num = int.from_bytes(raw_cursor, 'big')
+
+        history, tx_num, cost = await self.session_mgr.history_page(
+            hashX, from_height, None if to_height == -1 else to_height, tx_num)
+        self.bump_cost(cost)
+        conf = [{'tx_hash': hash_to_hex_str(tx_hash), 'height': height}
+                for tx_hash, height in history]
+        # Mempool transactions come with the last page
+        if tx_num is None and to_height == -1:
+            conf.extend(await self.unconfirmed_history(hashX))
+
+        return {
+            'history': conf,
+            'cursor': None if tx_num is None else tx_num.to_bytes(5, 'big').hex(),
+        }
 
     async def scripthash_get_mempool(self, scripthash):
         '''Return the mempool transactions touching a scripthash.'''
@@ -1229,6 +1395,49 @@ class ElectrumX(SessionBase):
         hashX = scripthash_to_hashX(scripthash)
         return await self.hashX_listunspent(hashX)
 
+    async def scripthash_listunspent_paged(self, scripthash, min_value=0, limit=1000,
+                                           cursor=None):
+        '''Return a page of the UTXOs of a scripthash with a value of at least
+        min_value, and a cursor for the next page.
+
+        min_value: the smallest UTXO value to return
+        limit: the most UTXOs to return
+        cursor: None for the first page, otherwise the cursor returned with
+           the previous page
+        '''
+        hashX = scripthash_to_hashX(scripthash)
+        min_value = non_negative_integer(min_value)
+        limit = non_negative_integer(limit)
+        if not 1 <= limit <= self.MAX_UTXO_PAGE:
+            raise RPCError(BAD_REQUEST, f'limit must be from 1 to {self.MAX_UTXO_PAGE:,d}')
+        if cursor is None:
+            raw_cursor = b''
+        else:
+            try:
+                raw_cursor = bytes.fromhex(cursor)
+            except (ValueError, TypeError):
+                raw_cursor = b''
+            if len(raw_cursor) != 9:
+                raise RPCError(BAD_REQUEST, f'invalid cursor: {cursor}')
+
+        utxos, cursor = await self.db.paged_utxos(hashX, min_value=min_value, limit=limit,
+                                                  cursor=raw_cursor)
+        # Mempool UTXOs come with the last page
+        if cursor is None:
+            utxos.extend(utxo for utxo in await self.mempool.unordered_UTXOs(hashX)
+                         if utxo.value >= min_value)
+        self.bump_cost(1.0 + len(utxos) / 50)
+        spends = await self.mempool.potential_spends(hashX)
+
+        return {
+            'utxos': [{'tx_hash': hash_to_hex_str(utxo.tx_hash),
+                       'tx_pos': utxo.tx_pos,
+                       'height': utxo.height, 'value': utxo.value}
+                      for utxo in utxos
+                      if (utxo.tx_hash, utxo.tx_pos) not in spends],
+            'cursor': None if cursor is None else cursor.hex(),
+        }
+
     async def scripthash_subscribe(self, scripthash):
         '''Subscribe to a script hash.
 
@@ -1501,7 +1710,7 @@ class ElectrumX(SessionBase):
 
     async def compact_fee_histogram(self):
         self.bump_cost(1.0)
-        return []
+        return await self.mempool.compact_fee_histogram()
 
     def set_request_handlers(self, ptuple):
         self.protocol_tuple = ptuple
@@ -1514,8 +1723,10 @@ class ElectrumX(SessionBase):
             'blockchain.relayfee': self.relayfee,
             'blockchain.scripthash.get_balance': self.scripthash_get_balance,
             'blockchain.scripthash.get_history': self.scripthash_get_history,
+            'blockchain.scripthash.get_history_paged': self.scripthash_get_history_paged,
             'blockchain.scripthash.get_mempool': self.scripthash_get_mempool,
             'blockchain.scripthash.listunspent': self.scripthash_listunspent,
+            'blockchain.scripthash.listunspent_paged': self.scripthash_listunspent_paged,
             'blockchain.scripthash.subscribe': self.scripthash_subscribe,
             'blockchain.transaction.broadcast': self.transaction_broadcast,
             'blockchain.transaction.get': self.transaction_get,
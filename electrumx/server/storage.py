@@ -8,6 +8,8 @@
 '''Backend database abstraction.'''
 
 import os
+import threading
+from bisect import bisect_left
 from functools import partial
 
 from electrumx.lib import util
@@ -67,6 +69,13 @@ class Storage(object):
         '''
         raise NotImplementedError
 
+    def iterator_from(self, prefix, start):
+        '''Return an iterator that yields (key, value) pairs from the
+        database sorted by key, for keys starting with `prefix` that are
+        not less than `start`.  This seeks rather than scans to `start`.
+        '''
+        raise NotImplementedError
+
 # pylint:disable=W0223
 
 
@@ -90,6 +99,11 @@ class LevelDB(Storage):
         self.write_batch = partial(self.db.write_batch, transaction=True,
                                    sync=True)
 
+    def iterator_from(self, prefix, start):
+        # plyvel does not combine prefix with start
+        return self.db.iterator(start=max(prefix, start),
+                                stop=util.increment_byte_string(prefix))
+
 
 # pylint:disable=E1101
 
@@ -129,6 +143,9 @@ class RocksDB(Storage):
     def iterator(self, prefix=b'', reverse=False):
         return RocksDBIterator(self.db, prefix, reverse)
 
+    def iterator_from(self, prefix, start):
+        return RocksDBIterator(self.db, prefix, False, start)
+
 
 class RocksDBWriteBatch(object):
     '''A write batch for RocksDB.'''
@@ -148,7 +165,7 @@ class RocksDBWriteBatch(object):
 class RocksDBIterator(object):
     '''An iterator for RocksDB.'''
 
-    def __init__(self, db, prefix, reverse):
+    def __init__(self, db, prefix, reverse, start=b''):
         self.prefix = prefix
         if reverse:
             self.iterator = reversed(db.iteritems())
@@ -163,7 +180,7 @@ class RocksDBIterator(object):
                 self.iterator.seek_to_last()
         else:
             self.iterator = db.iteritems()
-            self.iterator.seek(prefix)
+            self.iterator.seek(max(prefix, start))
 
     def __iter__(self):
         return self
@@ -173,3 +190,144 @@ class RocksDBIterator(object):
         if not k.startswith(self.prefix):
             raise StopIteration
         return k, v
+
+
+class Memory(Storage):
+    '''An in-memory database engine, for tests and benchmarks.
+
+    Databases live for the life of the process, keyed by absolute path,
+    so one closed and opened again retains its contents.  Keys are held in
+    a dictionary, plus a list of them sorted lazily when first iterated
+    after a change.  Iterators see the keys present when they were
+    created.
+    '''
+
+    databases = {}
+
+    def __init__(self, name, for_sync):
+        self.is_new = os.path.abspath(name) not in self.databases
+        self.for_sync = for_sync or self.is_new
+        self.open(name, create=self.is_new)
+
+    @classmethod
+    def import_module(cls):
+        pass
+
+    def open(self, name, create):
+        path = os.path.abspath(name)
+        if create:
+            self.databases[path] = {}
+        self.data = self.databases[path]
+        self.lock = threading.Lock()
+        self.sorted_keys = sorted(self.data)
+        # Keys added and whether any were deleted since the sort
+        self.added = set()
+        self.deleted = False
+
+    def close(self):
+        self.data = self.sorted_keys = None
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def put(self, key, value):
+        with self.lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        if key not in self.data:
+            self.added.add(key)
+        self.data[key] = value
+
+    def _delete(self, key):
+        if self.data.pop(key, None) is not None:
+            self.added.discard(key)
+            self.deleted = True
+
+    def write_batch(self):
+        return MemoryWriteBatch(self)
+
+    def _apply_batch(self, ops):
+        with self.lock:
+            for key, value in ops:
+                if value is None:
+                    self._delete(key)
+                else:
+                    self._put(key, value)
+
+    def _keys(self):
+        '''Return the sorted list of keys.  It is never modified, so
+        iterators can hold on to it.'''
+        with self.lock:
+            if self.added or self.deleted:
+                data = self.data
+                added = self.added
+                if self.deleted:
+                    # A key deleted and put again is in both
+                    keys = [key for key in self.sorted_keys
+                            if key in data and key not in added]
+                else:
+                    keys = self.sorted_keys.copy()
+                # Two sorted runs, which sort() merges in linear time
+                keys.extend(sorted(added))
+                keys.sort()
+                self.sorted_keys = keys
+                self.added = set()
+                self.deleted = False
+            return self.sorted_keys
+
+    def iterator(self, prefix=b'', reverse=False):
+        keys = self._keys()
+        start = bisect_left(keys, prefix)
+        nxt_prefix = util.increment_byte_string(prefix)
+        end = bisect_left(keys, nxt_prefix) if nxt_prefix else len(keys)
+        return MemoryIterator(self.data, keys, start, end, reverse)
+
+    def iterator_from(self, prefix, start):
+        keys = self._keys()
+        first = bisect_left(keys, max(prefix, start))
+        nxt_prefix = util.increment_byte_string(prefix)
+        end = bisect_left(keys, nxt_prefix) if nxt_prefix else len(keys)
+        return MemoryIterator(self.data, keys, first, max(first, end), False)
+
+
+class MemoryWriteBatch(object):
+    '''A write batch for the in-memory engine.'''
+
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not exc_val:
+            self.db._apply_batch(self.ops)
+
+    def put(self, key, value):
+        self.ops.append((key, value))
+
+    def delete(self, key):
+        self.ops.append((key, None))
+
+
+class MemoryIterator(object):
+    '''An iterator for the in-memory engine.'''
+
+    def __init__(self, data, keys, start, end, reverse):
+        self.data = data
+        self.keys = keys
+        self.indices = iter(range(end - 1, start - 1, -1) if reverse else range(start, end))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for index in self.indices:
+            key = self.keys[index]
+            # Skip keys deleted since the iterator was created
+            value = self.data.get(key)
+            if value is not None:
+                return key, value
+        raise StopIteration
@@ -0,0 +1,165 @@
+# Copyright (c) 2016-2018, Neil Booth
+# Copyright (c) 2017, the ElectrumX authors
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''A compact UTXO cache.'''
+
+import sys
+from array import array
+
+from electrumx.lib.hash import HASHX_LEN
+
+
+EMPTY = -1
+DUMMY = -2
+_MISSING = object()
+
+
+class UTXOCache(object):
+    '''A map of fixed-length binary keys to fixed-length binary values,
+    with the subset of the dict interface the block processor and DB use.
+
+    Entries are stored back-to-back in a single bytearray, key then value,
+    in the manner of CPython's compact dict.  An open-addressing index of
+    entry numbers, probed linearly, maps key hashes to entries.  Popping an
+    entry moves the last entry into the hole so the entries stay dense.
+
+    With the default UTXO key and value sizes of 36 and 24 bytes each entry
+    costs about 70 bytes of memory, compared to about 205 bytes for a dict
+    entry.  The price is paid in CPU as the probing is done in Python.
+    '''
+
+    def __init__(self, key_len=36, value_len=HASHX_LEN + 13):
+        self.key_len = key_len
+        self.entry_len = key_len + value_len
+        self.clear()
+
+    def clear(self):
+        self.entries = bytearray()
+        self.count = 0
+        # Index slots that are not EMPTY
+        self.fill = 0
+        self._resize(0)
+
+    def _resize(self, min_size):
+        '''Rebuild the index with a power-of-2 size above min_size.'''
+        size = 8
+        while size <= min_size:
+            size <<= 1
+        index = array('i', [EMPTY]) * size
+        mask = size - 1
+        entries = self.entries
+        key_len = self.key_len
+        for start in range(0, len(entries), self.entry_len):
+            slot = hash(bytes(entries[start:start + key_len])) & mask
+            while index[slot] != EMPTY:
+                slot = (slot + 1) & mask
+            index[slot] = start // self.entry_len
+        self.index = index
+        self.fill = self.count
+
+    def _find(self, key):
+        '''Return an (slot, entry) pair.  If key is not present entry is
+        EMPTY and slot is where it should be inserted.'''
+        index = self.index
+        mask = len(index) - 1
+        entries = self.entries
+        key_len = self.key_len
+        entry_len = self.entry_len
+        free = EMPTY
+        slot = hash(key) & mask
+        while True:
+            entry = index[slot]
+            if entry >= 0:
+                start = entry * entry_len
+                if entries[start:start + key_len] == key:
+                    return slot, entry
+            elif entry == EMPTY:
+                return (slot if free == EMPTY else free), EMPTY
+            elif free == EMPTY:
+                free = slot
+            slot = (slot + 1) & mask
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self._find(key)[1] != EMPTY
+
+    def __iter__(self):
+        entries = self.entries
+        key_len = self.key_len
+        for start in range(0, len(entries), self.entry_len):
+            yield bytes(entries[start:start + key_len])
+
+    def items(self):
+        entries = self.entries
+        key_len = self.key_len
+        entry_len = self.entry_len
+        for start in range(0, len(entries), entry_len):
+            yield (bytes(entries[start:start + key_len]),
+                   bytes(entries[start + key_len:start + entry_len]))
+
+    def get(self, key, default=None):
+        entry = self._find(key)[1]
+        if entry == EMPTY:
+            return default
+        start = entry * self.entry_len
+        return bytes(self.entries[start + self.key_len:start + self.entry_len])
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        assert len(key) + len(value) == self.entry_len
+        slot, entry = self._find(key)
+        if entry != EMPTY:
+            start = entry * self.entry_len + self.key_len
+            self.entries[start:start + len(value)] = value
+            return
+
+        if self.index[slot] == EMPTY:
+            self.fill += 1
+        self.index[slot] = self.count
+        self.entries += key
+        self.entries += value
+        self.count += 1
+        # Keep the index at most 2/3 full
+        if self.fill * 3 >= len(self.index) * 2:
+            self._resize(self.count * 3)
+
+    def pop(self, key, default=_MISSING):
+        slot, entry = self._find(key)
+        if entry == EMPTY:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+
+        entries = self.entries
+        key_len = self.key_len
+        entry_len = self.entry_len
+        start = entry * entry_len
+        value = bytes(entries[start + key_len:start + entry_len])
+        self.index[slot] = DUMMY
+
+        # Move the last entry into the hole
+        last = self.count - 1
+        if entry != last:
+            last_start = last * entry_len
+            last_slot, _ = self._find(bytes(entries[last_start:last_start + key_len]))
+            self.index[last_slot] = entry
+            entries[start:start + entry_len] = entries[last_start:]
+        del entries[-entry_len:]
+        self.count = last
+        return value
+
+    def memsize(self):
+        '''Return the memory used in bytes.'''
+        return sys.getsizeof(self.entries) + sys.getsizeof(self.index)
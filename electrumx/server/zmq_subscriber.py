@@ -0,0 +1,89 @@
+# Copyright (c) 2016-2018, Neil Booth
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''Subscribe to a daemon's ZMQ notifications.'''
+
+from electrumx.lib import util
+
+
+class ZMQSubscriber(object):
+    '''Subscribes to the ZMQ notifications a daemon publishes so that new
+    transactions and blocks are pushed rather than polled for.
+
+    New transactions are passed to the mempool, with their raw form for
+    rawtx notifications so they need not be fetched.  New blocks wake the
+    prefetcher and prompt the mempool to resync.  The daemon may publish
+    any of the topics, on one or more URLs.  Notifications can be lost,
+    for example if the daemon restarts, so the mempool still resyncs
+    periodically.
+
+    Requires the pyzmq package.
+    '''
+
+    TOPICS = (b'hashblock', b'hashtx', b'rawtx', b'sequence')
+
+    def __init__(self, urls, coin, mempool, prefetcher):
+        self.logger = util.class_logger(__name__, self.__class__.__name__)
+        self.urls = urls
+        self.coin = coin
+        self.mempool = mempool
+        self.prefetcher = prefetcher
+
+    @classmethod
+    def import_module(cls):
+        '''Import pyzmq.  Raises ImportError if it is not installed.'''
+        import zmq    # pylint:disable=E0401
+        import zmq.asyncio    # pylint:disable=E0401
+        cls.module = zmq
+
+    async def run(self):
+        '''Receive and handle notifications forever.'''
+        self.import_module()
+        zmq = self.module
+        context = zmq.asyncio.Context()
+        socket = context.socket(zmq.SUB)
+        # Do not drop notifications of busy periods
+        socket.setsockopt(zmq.RCVHWM, 0)
+        try:
+            for url in self.urls:
+                socket.connect(url)
+            for topic in self.TOPICS:
+                socket.setsockopt(zmq.SUBSCRIBE, topic)
+            self.logger.info(f'subscribed to {", ".join(self.urls)}')
+            while True:
+                # Parts are the topic, body and a sequence number
+                parts = await socket.recv_multipart()
+                try:
+                    self.on_message(parts[0], parts[1])
+                except Exception:   # pylint:disable=W0703
+                    self.logger.exception(f'ignoring bad {parts[0]!r} notification')
+        finally:
+            socket.close(linger=0)
+            context.term()
+
+    def on_message(self, topic, body):
+        '''Handle a notification.  Hashes are in display byte order.'''
+        if topic == b'hashtx':
+            self.mempool.notify_tx(body[::-1])
+        elif topic == b'rawtx':
+            _tx, tx_hash = self.coin.DESERIALIZER(body).read_tx_and_hash()
+            self.mempool.notify_tx(tx_hash, body)
+        elif topic == b'hashblock':
+            self._on_block()
+        elif topic == b'sequence':
+            # A 32-byte hash, a label and for mempool events a sequence number
+            tx_hash, label = body[31::-1], body[32:33]
+            if label == b'A':
+                self.mempool.notify_tx(tx_hash)
+            elif label == b'R':
+                self.mempool.notify_tx_removed(tx_hash)
+            elif label in (b'C', b'D'):
+                self._on_block()
+
+    def _on_block(self):
+        self.prefetcher.notify_block()
+        self.mempool.notify_block()
@@ -15,6 +15,7 @@ setuptools.setup(
     extras_require={
         'rocksdb': ['python-rocksdb>=0.6.9'],
         'uvloop': ['uvloop>=0.14'],
+        'zmq': ['pyzmq>=22'],
     },
     packages=setuptools.find_packages(include=('electrumx*',)),
     description='ElectrumX Server',
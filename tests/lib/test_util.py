@@ -1,4 +1,6 @@
 import os
+import threading
+from random import randrange
 
 import pytest
 
@@ -45,6 +47,37 @@ def test_deep_getsizeof():
     assert util.deep_getsizeof({1: {1: 1}}) > 3 * int_t
 
 
+def test_sampled_getsizeof():
+    assert util.sampled_getsizeof({}) == util.deep_getsizeof({})
+    assert util.sampled_getsizeof([]) == util.deep_getsizeof([])
+    # Exact when the items are the same size
+    mapping = {os.urandom(36): os.urandom(24) for _ in range(5000)}
+    assert util.sampled_getsizeof(mapping) == util.deep_getsizeof(mapping)
+    items = [os.urandom(57) for _ in range(5000)]
+    assert util.sampled_getsizeof(items) == util.deep_getsizeof(items)
+    # Close otherwise
+    mapping = {os.urandom(11): bytearray(5 * randrange(10)) for _ in range(5000)}
+    assert abs(util.sampled_getsizeof(mapping) / util.deep_getsizeof(mapping) - 1) < 0.05
+
+    # Only the sample of a mapping is visited
+    class CountingDict(dict):
+        visited = 0
+
+        def items(self):
+            for item in super().items():
+                self.visited += 1
+                yield item
+
+    mapping = CountingDict(mapping)
+    util.sampled_getsizeof(mapping, sample_size=10)
+    assert mapping.visited == 10
+
+
+def test_process_rss():
+    rss = util.process_rss()
+    assert rss is None or rss > 0
+
+
 class Base:
     pass
 
@@ -80,9 +113,10 @@ def test_int_to_bytes():
     assert util.int_to_bytes(456789) == b'\x06\xf8U'
 
 
-def test_LogicalFile(tmpdir):
+@pytest.mark.parametrize("cls", (util.LogicalFile, util.MappedLogicalFile))
+def test_LogicalFile(tmpdir, cls):
     prefix = os.path.join(tmpdir, 'log')
-    L = util.LogicalFile(prefix, 2, 6)
+    L = cls(prefix, 2, 6)
     with pytest.raises(FileNotFoundError):
         L.open_file(0, create=False)
 
@@ -107,6 +141,56 @@ def test_LogicalFile(tmpdir):
     L.write(0, b'957' * 6)
     assert L.read(0, -1) == b'957' * 6
 
+
+def test_MappedLogicalFile(tmpdir):
+    prefix = os.path.join(tmpdir, 'log')
+    L = util.MappedLogicalFile(prefix, 2, 6)
+    assert L.read(0, 4) == b''
+    assert L.view(0, 4) == b''
+
+    L.write(0, b'0123')
+    view = L.view(1, 2)
+    assert isinstance(view, memoryview)
+    assert view == b'12'
+    # Appends are seen
+    L.write(4, b'4567')
+    assert L.read(0, -1) == b'01234567'
+    assert L.read(3, 2) == b'34'
+    # A view across files is copied
+    assert L.view(4, 3) == b'456'
+    # and overwrites, through the open files and their maps
+    mm = L.maps[0]
+    L.write(2, b'ab')
+    assert L.read(0, 5) == b'01ab4'
+    assert view == b'1a'
+    assert L.maps[0] is mm
+    assert len(L.fds) == 2
+
+
+def test_MappedLogicalFile_threads(tmpdir, monkeypatch):
+    prefix = os.path.join(tmpdir, 'log')
+    L = util.MappedLogicalFile(prefix, 2, 6)
+    L.write(0, b'01')
+    mmap_class = util.mmap.mmap
+    writers = []
+
+    def mmap(*args, **kwargs):
+        mm = mmap_class(*args, **kwargs)
+        # Another thread appends after the file is mapped but before the
+        # map is stored; the next read past its end remaps
+        writer = threading.Thread(target=L.write, args=(2, b'23'))
+        writer.start()
+        writer.join(0.1)
+        writers.append(writer)
+        return mm
+
+    monkeypatch.setattr(util.mmap, 'mmap', mmap)
+    assert L.read(0, 2) == b'01'
+    monkeypatch.setattr(util.mmap, 'mmap', mmap_class)
+    writers[0].join()
+    assert L.read(0, -1) == b'0123'
+
+
 def test_open_fns(tmpdir):
     tmpfile = os.path.join(tmpdir, 'file1')
     with pytest.raises(FileNotFoundError):
@@ -0,0 +1,86 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from random import randrange
+
+from electrumx.lib.hash import double_sha256
+from electrumx.lib.util import pack_le_uint32, pack_le_uint64
+from electrumx.server.block_files import BlockFiles
+
+
+MAGIC = bytes.fromhex('e3e1f3e8')
+
+
+class Coin:
+
+    @classmethod
+    def header_hash(cls, header):
+        return double_sha256(header)
+
+
+def random_block():
+    return os.urandom(randrange(80, 5000))
+
+
+def record(block, large=False):
+    if large:
+        return MAGIC + pack_le_uint32(0xffffffff) + pack_le_uint64(len(block)) + block
+    return MAGIC + pack_le_uint32(len(block)) + block
+
+
+def write_blocks(path, blocks, zeros=0):
+    with open(path, 'ab') as f:
+        for n, block in enumerate(blocks):
+            f.write(record(block, large=(n == 1)))
+        f.write(bytes(zeros))
+
+
+def test_block_files(tmpdir):
+    blocks_dir = str(tmpdir)
+    first = [random_block() for _ in range(5)]
+    write_blocks(os.path.join(blocks_dir, 'blk00000.dat'), first, zeros=1000)
+
+    block_files = BlockFiles(blocks_dir, Coin)
+    hashes = [Coin.header_hash(block[:80]) for block in first]
+    assert block_files.read_block(hashes[0]) is None
+    assert block_files.scan() == 5
+    assert block_files.scan() == 0
+    for block_hash, block in zip(hashes, first[:-1]):
+        view = block_files.read_block(block_hash)
+        assert isinstance(view, memoryview)
+        assert view == block
+        # Blocks are dropped from the index once read
+        assert block_files.read_block(block_hash) is None
+
+    # The daemon moves on to a second file
+    second = [random_block() for _ in range(3)]
+    write_blocks(os.path.join(blocks_dir, 'blk00001.dat'), second[:2])
+    second_hashes = [Coin.header_hash(block[:80]) for block in second]
+    unknown = os.urandom(32)
+    assert block_files.read_blocks(second_hashes[:2] + [unknown]) == second[:2] + [None]
+    # The first file is scanned, but not all its blocks are read
+    assert list(block_files.mmaps) == [0, 1]
+
+    # Blocks appended to the current file are found by a rescan
+    write_blocks(os.path.join(blocks_dir, 'blk00001.dat'), second[2:])
+    assert block_files.read_blocks(hashes[-1:] + second_hashes[2:]) == first[-1:] + second[2:]
+    # The first file is released once all its blocks are read
+    assert list(block_files.mmaps) == [1]
+    assert not block_files.index
+
+
+def test_block_files_threads(tmpdir):
+    blocks_dir = str(tmpdir)
+    files = [[random_block() for _ in range(20)] for _ in range(6)]
+    for file_num, blocks in enumerate(files):
+        write_blocks(os.path.join(blocks_dir, f'blk{file_num:05d}.dat'), blocks)
+    hashes = [Coin.header_hash(block[:80]) for blocks in files for block in blocks]
+    blocks = [block for blocks in files for block in blocks]
+
+    block_files = BlockFiles(blocks_dir, Coin)
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(block_files.read_blocks,
+                                    [hashes[n: n + 7] for n in range(0, len(hashes), 7)]))
+    assert [block for result in results for block in result] == blocks
+    assert not block_files.index
+    # Only the last file, which the daemon may append to, stays mapped
+    assert list(block_files.mmaps) == [len(files) - 1]
@@ -0,0 +1,391 @@
+import asyncio
+import os
+import threading
+from glob import glob
+from os import environ
+from random import randrange
+
+import pytest
+
+from electrumx.lib.coins import Novo
+from electrumx.lib.hash import (
+    HASHX_LEN, double_sha256, hash_to_hex_str, hex_str_to_hash, sha256
+)
+from electrumx.lib.tx import Tx, TxInput, TxOutput
+from electrumx.lib.util import pack_le_uint32, pack_varint, unpack_le_uint64
+from electrumx.server import block_processor
+from electrumx.server.block_processor import (
+    BlockParser, BlockProcessor, CachePolicy, Prefetcher, parse_block
+)
+from electrumx.server.db import DB, struct_balance
+from electrumx.server.env import Env
+
+
+class Coin(Novo):
+
+    @classmethod
+    def hashX_from_script(cls, script):
+        return sha256(script)[:HASHX_LEN]
+
+
+OP_RETURN_SCRIPT = b'\x00\x6a\x04abcd'
+
+
+def random_script():
+    return b'\x76\xa9\x14' + os.urandom(20) + b'\x88\xac'
+
+
+def make_block(tx_count=5):
+    '''Return a (raw_block, txs) pair of a random block of version 1 txs.'''
+    coinbase = Tx(1, [TxInput(bytes(32), 0xffffffff, b'\x01\x02', 0xffffffff)],
+                  [TxOutput(5000, random_script())], 0)
+    txs = [coinbase]
+    for _ in range(tx_count - 1):
+        inputs = [TxInput(os.urandom(32), randrange(5), b'', 0xffffffff)
+                  for _ in range(randrange(1, 4))]
+        outputs = [TxOutput(randrange(1, 10000), random_script())
+                   for _ in range(randrange(1, 4))]
+        outputs.append(TxOutput(0, OP_RETURN_SCRIPT))
+        txs.append(Tx(1, inputs, outputs, 0))
+    raw_block = b''.join((os.urandom(80), pack_varint(len(txs)),
+                          b''.join(tx.serialize() for tx in txs)))
+    return raw_block, txs
+
+
+def test_parse_block():
+    raw_block, txs = make_block()
+    header, parsed = parse_block(Coin, raw_block, 1)
+    assert header == raw_block[:80]
+    assert len(parsed) == len(txs)
+    for tx, (tx_hash, prevouts, outputs) in zip(txs, parsed):
+        assert tx_hash == double_sha256(tx.serialize())
+        assert prevouts == tuple(txin.prev_hash + pack_le_uint32(txin.prev_idx)
+                                 for txin in tx.inputs if not txin.is_generation())
+        # The OP_RETURN output is dropped
+        assert outputs == tuple((idx, Coin.hashX_from_script(txout.pk_script), txout.value)
+                                for idx, txout in enumerate(tx.outputs)
+                                if txout.pk_script != OP_RETURN_SCRIPT)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("processes", (0, 2))
+async def test_block_parser(processes):
+    blocks = [make_block() for _ in range(6)]
+    raw_blocks = [raw_block for raw_block, _txs in blocks]
+    parser = BlockParser(Coin, processes)
+    parser.start()
+    try:
+        results = [result async for result in parser.parsed_blocks(raw_blocks, 10)]
+        batches = [batch async for batch in parser.parsed_batches(raw_blocks, 10)]
+    finally:
+        parser.shutdown()
+
+    assert all(batches)
+    assert [block for batch in batches for block in batch] == results
+
+    assert len(results) == len(raw_blocks)
+    for height, (raw_block, result) in enumerate(zip(raw_blocks, results), start=10):
+        assert result == (raw_block, ) + parse_block(Coin, raw_block, height)
+
+
+def hex_hash(height):
+    return f'{height:064x}'
+
+
+class Daemon:
+    '''A daemon with blocks of random size that records its requests.'''
+
+    def __init__(self, height):
+        self.blocks = [os.urandom(randrange(100, 50_000)) for _ in range(height + 1)]
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def height(self):
+        return len(self.blocks) - 1
+
+    async def block_hex_hashes(self, first, count):
+        return [hex_hash(height) for height in range(first, first + count)]
+
+    async def raw_blocks(self, hex_hashes):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.001 * randrange(5))
+        self.in_flight -= 1
+        return [self.blocks[int(hex_hash, 16)] for hex_hash in hex_hashes]
+
+
+@pytest.mark.asyncio
+async def test_prefetcher():
+    daemon = Daemon(500)
+    prefetcher = Prefetcher(daemon, Coin, asyncio.Event(), prefetch_MB=1, concurrency=3)
+    await prefetcher.reset_height(0)
+    blocks = []
+    while True:
+        more = await prefetcher._prefetch_blocks()
+        # Request sizes are estimates so allow some overshoot
+        assert prefetcher.cache_size < prefetcher.max_cache_size * 2
+        blocks.extend(prefetcher.get_prefetched_blocks())
+        if not more:
+            break
+
+    assert blocks == daemon.blocks[1:]
+    assert prefetcher.caught_up
+    assert daemon.max_in_flight > 1
+    info = prefetcher.info()
+    assert info['fetch rate MB/s'] > 0
+    assert info['requests in flight'] == 0
+
+
+
+class BlockFiles:
+    '''Has the even height blocks of a daemon.'''
+
+    def __init__(self, daemon):
+        self.blocks = {hex_str_to_hash(hex_hash(height)): memoryview(block)
+                       for height, block in enumerate(daemon.blocks) if height % 2 == 0}
+
+    def read_blocks(self, block_hashes):
+        return [self.blocks.get(block_hash) for block_hash in block_hashes]
+
+
+@pytest.mark.asyncio
+async def test_prefetcher_block_files():
+    daemon = Daemon(50)
+    prefetcher = Prefetcher(daemon, Coin, asyncio.Event(), block_files=BlockFiles(daemon))
+    await prefetcher.reset_height(0)
+    while await prefetcher._prefetch_blocks():
+        pass
+    assert prefetcher.get_prefetched_blocks() == daemon.blocks[1:]
+
+
+def test_cache_policy(monkeypatch):
+    rss = 1000_000_000
+    monkeypatch.setattr(block_processor, 'process_rss', lambda: rss)
+    MB = 1_000_000
+    policy = CachePolicy(100, headroom_MB=50)
+    assert policy.rss_limit == rss + 150 * MB
+
+    assert policy.check(50 * MB, 10 * MB) is None
+    # History over its share
+    assert policy.check(50 * MB, 20 * MB) is False
+    # Over budget
+    assert policy.check(70 * MB, 30 * MB) is False
+    assert policy.check(80 * MB, 20 * MB) is True
+
+    # Spends from the DB cost more than flushing the UTXOs
+    policy.note_flush(True, 1.0)
+    policy.note_db_spends(1000, 2.0)
+    assert policy.check(80 * MB, 20 * MB) is True
+    assert policy.utxo_fraction == pytest.approx(0.85)
+    assert policy.check(82 * MB, 18 * MB) is False
+    policy.note_flush(True, 1.0)
+    assert policy.db_spends == 0
+    policy.check(85 * MB, 15 * MB)
+    assert policy.utxo_fraction == pytest.approx(0.8)
+
+    # The budget shrinks while the process uses too much memory
+    rss += 200 * MB
+    assert policy.check(50 * MB, 10 * MB) is None
+    assert policy.budget() == 90 * MB
+    assert policy.check(75 * MB, 10 * MB) is True
+    assert policy.budget() == 81 * MB
+    # and recovers when it does not
+    rss -= 200 * MB
+    policy.check(0, 0)
+    assert policy.budget() == 86 * MB
+    info = policy.info()
+    assert info['budget MB'] == 86
+    assert info['UTXO fraction'] == 0.75
+
+
+def make_chain(count, spend_latest=False):
+    '''Return a list of count raw blocks, each spending outputs of earlier
+    blocks, those of the block before first if spend_latest.'''
+    raw_blocks = []
+    unspent = []
+    prev_hash = bytes(32)
+    for height in range(count):
+        coinbase = Tx(1, [TxInput(bytes(32), 0xffffffff, pack_le_uint32(height), 0xffffffff)],
+                      [TxOutput(5000, random_script())], 0)
+        txs = [coinbase]
+        for _ in range(min(randrange(1, 6), len(unspent) // 2)):
+            inputs = [TxInput(*unspent.pop(-1 if spend_latest else randrange(len(unspent))),
+                              b'', 0xffffffff)
+                      for _ in range(randrange(1, 3))]
+            outputs = [TxOutput(randrange(1, 10000), random_script())
+                       for _ in range(randrange(1, 4))]
+            txs.append(Tx(1, inputs, outputs, 0))
+        for tx in txs:
+            tx_hash = double_sha256(tx.serialize())
+            unspent.extend((tx_hash, idx) for idx in range(len(tx.outputs)))
+        header = pack_le_uint32(1) + prev_hash + os.urandom(44)
+        prev_hash = Novo.header_hash(header)
+        raw_blocks.append(header + pack_varint(len(txs))
+                          + b''.join(tx.serialize() for tx in txs))
+    return raw_blocks
+
+
+class ChainDaemon:
+
+    def __init__(self, raw_blocks):
+        self.blocks = {hash_to_hex_str(Novo.header_hash(raw_block[:80])): raw_block
+                       for raw_block in raw_blocks}
+        self._height = len(raw_blocks) - 1
+        self.requested = 0
+
+    async def height(self):
+        return self._height
+
+    def cached_height(self):
+        return self._height
+
+    async def raw_blocks(self, hex_hashes):
+        self.requested += len(hex_hashes)
+        return [self.blocks[hex_hash] for hex_hash in hex_hashes]
+
+
+async def open_block_processor(db_dir, chain):
+    environ.clear()
+    environ['DB_DIRECTORY'] = str(db_dir)
+    environ['DAEMON_URL'] = ''
+    environ['DB_ENGINE'] = 'memory'
+    env = Env(coin=Coin)
+    bp = BlockProcessor(env, DB(env), ChainDaemon(chain), None)
+    await bp._first_open_dbs()
+    return bp
+
+
+async def advance(bp, raw_blocks):
+    async with bp.state_lock:
+        for raw_block in raw_blocks:
+            header, txs = parse_block(bp.coin, raw_block, bp.height + 1)
+            await bp._advance_block(header, txs)
+        await bp.flush(True)
+
+
+def db_state(bp):
+    db = bp.db
+    utxos = {key: value for key, value in db.utxo_db.iterator()
+             if key[:1] in (b'b', b'h', b'u')}
+    history = {}
+    for key, hist in db.history.db.iterator():
+        if len(key) == HASHX_LEN + 2:
+            history[key[:HASHX_LEN]] = history.get(key[:HASHX_LEN], b'') + hist
+    return (bp.height, bp.tip, bp.tx_count, db.db_height, db.db_tx_count, db.fs_height,
+            db.fs_tx_count, list(db.tx_counts), utxos, history)
+
+
+def check_balances(db):
+    '''Check the balance rows agree with the UTXO table.'''
+    balances = {}
+    for key, value in db.utxo_db.iterator(prefix=b'u'):
+        balance, count = balances.get(key[1:-9], (0, 0))
+        balances[key[1:-9]] = (balance + unpack_le_uint64(value)[0], count + 1)
+    assert balances
+    assert {key[1:]: struct_balance.unpack(value)
+            for key, value in db.utxo_db.iterator(prefix=b'b')} == balances
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("digests", (True, False))
+async def test_reorg_chain(tmpdir, digests):
+    chain = make_chain(20)
+    expected = await open_block_processor(tmpdir.mkdir('expected'), chain)
+    await advance(expected, chain[:12])
+
+    bp = await open_block_processor(tmpdir.mkdir('reorged'), chain)
+    await advance(bp, chain[:10])
+    await advance(bp, chain[10:])
+    check_balances(bp.db)
+    if not digests:
+        # The blocks come from the daemon
+        for path in glob('meta/digests*'):
+            os.remove(path)
+    async with bp.state_lock:
+        await bp._reorg_chain(8)
+    assert bp.height == 11
+    assert bp.daemon.requested == (0 if digests else 8)
+    assert db_state(bp) == db_state(expected)
+    check_balances(bp.db)
+
+    # It carries on from there
+    await advance(bp, chain[12:])
+    await advance(expected, chain[12:])
+    assert db_state(bp) == db_state(expected)
+
+
+@pytest.mark.asyncio
+async def test_background_flush(tmpdir):
+    chain = make_chain(24, spend_latest=True)
+    expected = await open_block_processor(tmpdir.mkdir('expected'), chain)
+    bp = await open_block_processor(tmpdir.mkdir('pipelined'), chain)
+
+    # Hold each background flush until the next blocks are advanced
+    flush_dbs = bp.db.flush_dbs
+    release = threading.Event()
+
+    def held_flush_dbs(*args):
+        assert release.wait(10)
+        release.clear()
+        flush_dbs(*args)
+
+    bp.db.flush_dbs = held_flush_dbs
+    flushing_spends = 0
+    for start in range(0, len(chain), 4):
+        blocks = chain[start: start + 4]
+        await advance(expected, blocks)
+        async with bp.state_lock:
+            for raw_block in blocks:
+                header, txs = parse_block(bp.coin, raw_block, bp.height + 1)
+                flushing_spends += sum(prevout in bp.flushing_adds
+                                       for _tx_hash, prevouts, _outputs in txs
+                                       for prevout in prevouts)
+                await bp._advance_block(header, txs)
+            if bp._flush_task:
+                # The previous flush is still committing
+                assert not bp._flush_task.done()
+                release.set()
+            await bp.flush(True, background=True)
+    release.set()
+    async with bp.state_lock:
+        await bp.wait_for_background_flush()
+
+    # Some UTXOs were spent while only in a committing flush
+    assert flushing_spends
+    assert db_state(bp) == db_state(expected)
+    check_balances(bp.db)
+
+
+@pytest.mark.asyncio
+async def test_advance_blocks_parser_pool(tmpdir):
+    chain = make_chain(16)
+    expected = await open_block_processor(tmpdir.mkdir('expected'), chain)
+    await advance(expected, chain)
+
+    bp = await open_block_processor(tmpdir.mkdir('pool'), chain)
+    bp.block_parser = BlockParser(bp.coin, 2)
+    bp.block_parser.start()
+    # Not caught up, so no notifications
+    bp.daemon._height = 100
+    bp._caught_up_event = asyncio.Event()
+    prefetch_utxos = bp.prefetch_utxos
+    batch_sizes = []
+
+    async def recording_prefetch_utxos(blocks):
+        batch_sizes.append(len(blocks))
+        assert not bp.prefetched_utxos
+        await prefetch_utxos(blocks)
+
+    bp.prefetch_utxos = recording_prefetch_utxos
+    try:
+        async with bp.state_lock:
+            await bp._advance_blocks(chain)
+            await bp.flush(True)
+    finally:
+        bp.block_parser.shutdown()
+
+    # UTXOs are prefetched a batch at a time
+    assert sum(batch_sizes) == len(chain)
+    assert not bp.prefetched_utxos
+    assert db_state(bp) == db_state(expected)
+    check_balances(bp.db)
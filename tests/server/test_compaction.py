@@ -1,14 +1,17 @@
 # Test of compaction code in server/history.py
 
 import array
-import asyncio
 from os import environ, urandom
 import random
 
+import pytest
+
+from electrumx.lib.coins import Novo
 from electrumx.lib.hash import HASHX_LEN
-from electrumx.lib.util import pack_be_uint16, pack_le_uint64
+from electrumx.lib.util import pack_le_uint64
 from electrumx.server.env import Env
 from electrumx.server.db import DB
+from electrumx.server.history import row_key
 
 
 def create_histories(history, hashX_count=100):
@@ -49,8 +52,8 @@ def check_hashX_compaction(history):
     hist_list = []
     hist_map = {}
     for flush_count, count in pairs:
-        key = hashX + pack_be_uint16(flush_count)
         hist = full_hist[cum * 5: (cum+count) * 5]
+        key = row_key(hashX, hist)
         hist_map[key] = hist
         hist_list.append(hist)
         cum += count
@@ -65,10 +68,9 @@ def check_hashX_compaction(history):
     assert len(keys_to_delete) == 3
     assert len(hist_map) == len(pairs)
     for n, item in enumerate(write_items):
-        assert item == (hashX + pack_be_uint16(n),
-                        full_hist[n * row_size: (n + 1) * row_size])
-    for flush_count, count in pairs:
-        assert hashX + pack_be_uint16(flush_count) in keys_to_delete
+        chunk = full_hist[n * row_size: (n + 1) * row_size]
+        assert item == (row_key(hashX, chunk), chunk)
+    assert keys_to_delete == set(hist_map)
 
     # Check re-compaction is null
     hist_map = {key: value for key, value in write_items}
@@ -82,27 +84,27 @@ def check_hashX_compaction(history):
     assert len(keys_to_delete) == 0
     assert len(hist_map) == len(pairs)
 
-    # Check re-compaction adding a single tx writes the one row
-    hist_list[-1] += array.array('I', [100]).tobytes()
+    # Check re-compaction adding a single tx writes the one row under
+    # the key of its new last entry
+    last_key = row_key(hashX, hist_list[-1])
+    hist_list[-1] += pack_le_uint64(100)[:5]
     write_size = history._compact_hashX(hashX, hist_map, hist_list,
                                         write_items, keys_to_delete)
     assert write_size == len(hist_list[-1])
-    assert write_items == [(hashX + pack_be_uint16(2), hist_list[-1])]
-    assert len(keys_to_delete) == 1
-    assert write_items[0][0] in keys_to_delete
+    assert write_items == [(row_key(hashX, hist_list[-1]), hist_list[-1])]
+    assert keys_to_delete == {last_key}
     assert len(hist_map) == len(pairs)
 
 
 def check_written(history, histories):
     for hashX, hist in histories.items():
-        db_hist = array.array('I', history.get_txnums(hashX, limit=None))
+        db_hist = array.array('Q', history.get_txnums(hashX, limit=None))
         assert hist == db_hist
 
 def compact_history(history):
     '''Synchronously compact the DB history.'''
     history.comp_cursor = 0
 
-    history.comp_flush_count = max(history.comp_flush_count, 1)
     limit = 5 * 1000
 
     write_size = 0
@@ -114,8 +116,9 @@ async def run_test(db_dir):
     environ.clear()
     environ['DB_DIRECTORY'] = db_dir
     environ['DAEMON_URL'] = ''
-    environ['COIN'] = 'BitcoinSV'
-    db = DB(Env())
+    # LevelDB cannot open a second 'utxo' DB in the process
+    environ['DB_ENGINE'] = 'memory'
+    db = DB(Env(coin=Novo))
     await db.open_for_serving()
     history = db.history
 
@@ -127,8 +130,8 @@ async def run_test(db_dir):
     compact_history(history)
     check_written(history, histories)
 
-def test_compaction(tmpdir):
+@pytest.mark.asyncio
+async def test_compaction(tmpdir):
     db_dir = str(tmpdir)
     print('Temp dir: {}'.format(db_dir))
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(run_test(db_dir))
+    await run_test(db_dir)
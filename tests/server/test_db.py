@@ -0,0 +1,251 @@
+import os
+from os import environ
+from random import randrange
+
+import pytest
+
+from electrumx.lib.coins import Novo
+from electrumx.lib.hash import HASHX_LEN
+from electrumx.lib.util import pack_le_uint32, pack_le_uint64
+from electrumx.server.env import Env
+from electrumx.server.db import DB, pack_block_digest, unpack_block_digest
+
+
+async def open_db(tmpdir, engine='leveldb'):
+    environ.clear()
+    environ['DB_DIRECTORY'] = str(tmpdir)
+    environ['DAEMON_URL'] = ''
+    environ['DB_ENGINE'] = engine
+    db = DB(Env(coin=Novo))
+    await db.open_for_sync()
+    return db
+
+
+def put_utxo(db, prevout, hashX, tx_num, value):
+    suffix = prevout[32:] + pack_le_uint64(tx_num)[:5]
+    db.utxo_db.put(b'h' + prevout[:4] + suffix, hashX)
+    db.utxo_db.put(b'u' + hashX + suffix, pack_le_uint64(value))
+    return hashX + pack_le_uint64(tx_num)[:5] + pack_le_uint64(value)
+
+
+@pytest.mark.asyncio
+async def test_lookup_spent_utxos(tmpdir):
+    db = await open_db(tmpdir)
+    prevouts = [os.urandom(32) + pack_le_uint32(idx) for idx in range(20)]
+    expected = {}
+    for tx_num, prevout in enumerate(prevouts[:15]):
+        hashX = os.urandom(HASHX_LEN)
+        value = put_utxo(db, prevout, hashX, tx_num, 1000 + tx_num)
+        suffix = prevout[32:] + pack_le_uint64(tx_num)[:5]
+        expected[prevout] = (b'h' + prevout[:4] + suffix, b'u' + hashX + suffix, value)
+
+    # A compressed tx hash collision is resolved via the tx hashes
+    collider = prevouts[0][:4] + os.urandom(28) + prevouts[0][32:]
+    value = put_utxo(db, collider, os.urandom(HASHX_LEN), 100, 5)
+    tx_hashes = {0: prevouts[0][:32], 100: collider[:32]}
+    db.fs_tx_hash = lambda tx_num: (tx_hashes[tx_num], 0)
+
+    utxos = db.lookup_spent_utxos(prevouts + [collider])
+    assert utxos.pop(collider)[2] == value
+    assert utxos == expected
+    assert db.lookup_spent_utxos([prevouts[3]]) == {prevouts[3]: expected[prevouts[3]]}
+    assert db.lookup_spent_utxos([prevouts[-1]]) == {}
+
+
+def random_txs():
+    return [(os.urandom(32),
+             tuple(os.urandom(36) for _ in range(randrange(3))),
+             tuple((randrange(10), os.urandom(HASHX_LEN), randrange(-1, 1 << 50))
+                   for _ in range(randrange(3))))
+            for _ in range(randrange(1, 5))]
+
+
+def test_block_digest_round_trip():
+    header = os.urandom(80)
+    txs = random_txs()
+    assert unpack_block_digest(pack_block_digest(header, txs)) == (header, txs)
+
+
+@pytest.mark.asyncio
+async def test_block_digests(tmpdir):
+    # LevelDB cannot open a second 'utxo' DB in the process
+    db = await open_db(tmpdir, 'memory')
+    blocks = {height: (os.urandom(80), random_txs()) for height in range(40)}
+    for height, (header, txs) in blocks.items():
+        db.write_block_digest(height, header, txs)
+    for height, block in blocks.items():
+        assert db.read_block_digest(height) == block
+    assert db.read_block_digest(40) is None
+
+    # After a reorg the latest digest for a height is read
+    block = (os.urandom(80), random_txs())
+    db.write_block_digest(39, *block)
+    assert db.read_block_digest(39) == block
+    assert db.read_block_digest(38) == blocks[38]
+
+    # A partial record from a crash is dropped
+    path = db.block_digest_path(39 // db.DIGEST_SEGMENT)
+    with open(path, 'ab') as f:
+        f.write(b'\1\2\3')
+    assert db.read_block_digest(39) == block
+    block = (os.urandom(80), random_txs())
+    db.write_block_digest(40, *block)
+    assert db.read_block_digest(40) == block
+
+    # Segments are deleted once below the undo height
+    for height in range(41, db.env.reorg_limit + 2 * db.DIGEST_SEGMENT):
+        db.write_block_digest(height, *block)
+    assert db.read_block_digest(0) is None
+    assert db.read_block_digest(db.DIGEST_SEGMENT) is None
+    assert db.read_block_digest(2 * db.DIGEST_SEGMENT) == blocks[2 * db.DIGEST_SEGMENT]
+
+
+@pytest.mark.asyncio
+async def test_fs_tx_hashes(tmpdir):
+    db = await open_db(tmpdir, 'memory')
+    tx_count = 0
+    for height in range(100):
+        tx_count += randrange(1, 40)
+        db.tx_counts.append(tx_count)
+    db.hashes_file.write(0, os.urandom(tx_count * 32))
+    # The last few blocks are not flushed
+    db.db_height = 95
+
+    assert db.fs_tx_hashes([]) == []
+    for _ in range(20):
+        tx_nums = sorted(set(randrange(tx_count + 10) for _ in range(randrange(1, 200))))
+        assert db.fs_tx_hashes(tx_nums) == [db.fs_tx_hash(tx_num) for tx_num in tx_nums]
+    tx_nums = list(range(tx_count))
+    assert db.fs_tx_hashes(tx_nums) == [db.fs_tx_hash(tx_num) for tx_num in tx_nums]
+
+
+@pytest.mark.asyncio
+async def test_limited_history_ranges(tmpdir):
+    db = await open_db(tmpdir, 'memory')
+    hashX = os.urandom(HASHX_LEN)
+    tx_count = 0
+    for height in range(100):
+        hashXs_by_tx = [[hashX] if randrange(3) == 0 else []
+                        for _ in range(randrange(1, 20))]
+        db.history.add_unflushed(hashXs_by_tx, tx_count)
+        tx_count += len(hashXs_by_tx)
+        db.tx_counts.append(tx_count)
+        # Spread the history over several rows
+        if randrange(10) == 0:
+            db.history.flush()
+    db.history.flush()
+    db.hashes_file.write(0, os.urandom(tx_count * 32))
+    db.db_height = 99
+
+    history = await db.limited_history(hashX, limit=None)
+    assert history == db.fs_tx_hashes(list(db.history.get_txnums(hashX, None)))
+    for _ in range(50):
+        from_height = randrange(110)
+        to_height = randrange(from_height, 111)
+        expected = [item for item in history if from_height <= item[1] < to_height]
+        assert await db.limited_history(hashX, limit=None, from_height=from_height,
+                                        to_height=to_height) == expected
+        assert await db.limited_history(hashX, limit=2, from_height=from_height,
+                                        to_height=to_height) == expected[:2]
+        assert (await db.limited_history(hashX, limit=None, from_height=from_height)
+                == [item for item in history if item[1] >= from_height])
+
+
+@pytest.mark.asyncio
+async def test_history_page(tmpdir):
+    db = await open_db(tmpdir, 'memory')
+    hashX = os.urandom(HASHX_LEN)
+    tx_count = 0
+    for height in range(100):
+        hashXs_by_tx = [[hashX] if randrange(3) == 0 else []
+                        for _ in range(randrange(1, 20))]
+        db.history.add_unflushed(hashXs_by_tx, tx_count)
+        tx_count += len(hashXs_by_tx)
+        db.tx_counts.append(tx_count)
+        if randrange(10) == 0:
+            db.history.flush()
+    db.history.flush()
+    db.hashes_file.write(0, os.urandom(tx_count * 32))
+    db.db_height = 99
+
+    history = await db.limited_history(hashX, limit=None)
+    for from_height, to_height in ((0, None), (30, 70)):
+        expected = [item for item in history
+                    if item[1] >= from_height and (to_height is None or item[1] < to_height)]
+        pages = []
+        cursor = 0
+        while True:
+            page, cursor = await db.history_page(hashX, limit=7, from_height=from_height,
+                                                 to_height=to_height, cursor=cursor)
+            assert len(page) == 7 or cursor is None
+            pages.extend(page)
+            if cursor is None:
+                break
+        assert pages == expected
+
+
+@pytest.mark.asyncio
+async def test_balances(tmpdir):
+    db = await open_db(tmpdir, 'memory')
+    hashXs = [os.urandom(HASHX_LEN) for _ in range(5)]
+    expected = {}
+    for n in range(100):
+        hashX = hashXs[n % len(hashXs)]
+        value = randrange(1, 1 << 40)
+        put_utxo(db, os.urandom(36), hashX, n, value)
+        balance, count = expected.get(hashX, (0, 0))
+        expected[hashX] = (balance + value, count + 1)
+
+    db.upgrade_balances()
+    for hashX in hashXs:
+        assert await db.confirmed_balance(hashX) == expected[hashX]
+    assert await db.confirmed_balance(os.urandom(HASHX_LEN)) == (0, 0)
+
+    # Flushes apply adds and spends
+    hashX, spent_hashX = hashXs[:2]
+    adds = {os.urandom(36): hashX + pack_le_uint64(200)[:5] + pack_le_uint64(7)}
+    spent_values = [spent_hashX + key[-5:] + value
+                    for key, value in db.utxo_db.iterator(prefix=b'u' + spent_hashX)]
+    with db.utxo_db.write_batch() as batch:
+        db.flush_balances(batch, adds, spent_values)
+    balance, count = expected[hashX]
+    assert await db.confirmed_balance(hashX) == (balance + 7, count + 1)
+    assert await db.confirmed_balance(spent_hashX) == (0, 0)
+    assert not list(db.utxo_db.iterator(prefix=b'b' + spent_hashX))
+
+
+@pytest.mark.asyncio
+async def test_paged_utxos(tmpdir, monkeypatch):
+    db = await open_db(tmpdir, 'memory')
+    hashX = os.urandom(HASHX_LEN)
+    tx_count = 0
+    for height in range(20):
+        tx_count += randrange(1, 10)
+        db.tx_counts.append(tx_count)
+    db.hashes_file.write(0, os.urandom(tx_count * 32))
+    db.db_height = 19
+    for _ in range(200):
+        put_utxo(db, os.urandom(32) + pack_le_uint32(randrange(5)), hashX,
+                 randrange(tx_count), randrange(1, 1000))
+    put_utxo(db, os.urandom(36), os.urandom(HASHX_LEN), 0, 500)
+    all_utxos = await db.all_utxos(hashX)
+
+    async def pages(**kwargs):
+        utxos = []
+        cursor = b''
+        while cursor is not None:
+            page, cursor = await db.paged_utxos(hashX, cursor=cursor, **kwargs)
+            assert len(page) <= kwargs.get('limit', 1000)
+            utxos.extend(page)
+        return utxos
+
+    # In DB order, which all_utxos() also follows
+    assert await pages() == all_utxos
+    assert await pages(limit=7) == all_utxos
+    assert await pages(limit=1, min_value=500) == [utxo for utxo in all_utxos
+                                                   if utxo.value >= 500]
+    assert await pages(min_value=1000) == []
+    # A scan limit can leave pages short
+    monkeypatch.setattr(db, 'MAX_UTXO_SCAN', 10)
+    assert await pages(limit=8, min_value=300) == [utxo for utxo in all_utxos
+                                                   if utxo.value >= 300]
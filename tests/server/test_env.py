@@ -17,7 +17,7 @@ BASE_DB_DIR = '/some/dir'
 base_environ = {
     'DB_DIRECTORY': BASE_DB_DIR,
     'DAEMON_URL': BASE_DAEMON_URL,
-    'COIN': 'BitcoinSV',
+    'COIN': 'Novo',
 }
 
 
@@ -86,17 +86,35 @@ def test_DAEMON_URL():
     assert e.daemon_url == BASE_DAEMON_URL
 
 
+def test_DAEMON_REST():
+    setup_base_env()
+    assert_boolean('DAEMON_REST', 'daemon_rest', False)
+
+
+def test_BLOCKS_DIR():
+    assert_default('BLOCKS_DIR', 'blocks_dir', None)
+
+
+def test_ZMQ_URL():
+    setup_base_env()
+    e = Env()
+    assert e.zmq_urls == []
+    os.environ['ZMQ_URL'] = 'tcp://127.0.0.1:28332, tcp://127.0.0.1:28333,'
+    e = Env()
+    assert e.zmq_urls == ['tcp://127.0.0.1:28332', 'tcp://127.0.0.1:28333']
+
+
 def test_COIN_NET():
     '''Test COIN and NET defaults and redirection.'''
     setup_base_env()
     e = Env()
-    assert e.coin == lib_coins.BitcoinSV
-    os.environ['NET'] = 'testnet'
+    assert e.coin == lib_coins.Novo
+    os.environ['NET'] = ' mainnet '
     e = Env()
-    assert e.coin == lib_coins.BitcoinSVTestnet
-    os.environ['NET'] = ' testnet '
-    e = Env()
-    assert e.coin == lib_coins.BitcoinSVTestnet
+    assert e.coin == lib_coins.Novo
+    os.environ['NET'] = 'testnet'
+    with pytest.raises(lib_coins.CoinError):
+        Env()
 
 
 def test_CACHE_MB():
@@ -228,7 +246,29 @@ def test_REPORT_SERVICES_localhost():
 
 def test_REORG_LIMIT():
     assert_integer('REORG_LIMIT', 'reorg_limit',
-                   lib_coins.BitcoinSV.REORG_LIMIT)
+                   lib_coins.Novo.REORG_LIMIT)
+
+
+def test_PARSE_PROCESSES():
+    assert_integer('PARSE_PROCESSES', 'parse_processes', 0)
+
+
+def test_PIPELINED_FLUSH():
+    setup_base_env()
+    assert_boolean('PIPELINED_FLUSH', 'pipelined_flush', False)
+
+
+def test_COMPACT_UTXO_CACHE():
+    setup_base_env()
+    assert_boolean('COMPACT_UTXO_CACHE', 'compact_utxo_cache', False)
+
+
+def test_PREFETCH_MB():
+    assert_integer('PREFETCH_MB', 'prefetch_MB', 200)
+
+
+def test_PREFETCH_CONCURRENCY():
+    assert_integer('PREFETCH_CONCURRENCY', 'prefetch_concurrency', 4)
 
 
 def test_COST_HARD_LIMIT():
@@ -260,7 +300,7 @@ def test_DB_ENGINE():
 
 
 def test_MAX_SEND():
-    assert_integer('MAX_SEND', 'max_send', 1000000)
+    assert_integer('MAX_SEND', 'max_send', lib_coins.Novo.DEFAULT_MAX_SEND)
 
 
 def test_LOG_LEVEL():
@@ -288,6 +328,10 @@ def test_SESSION_TIMEOUT():
     assert_integer('SESSION_TIMEOUT', 'session_timeout', 600)
 
 
+def test_STATUS_CACHE_MB():
+    assert_integer('STATUS_CACHE_MB', 'status_cache_MB', 16)
+
+
 def test_BANNER_FILE():
     e = Env()
     assert e.banner_file is None
@@ -362,5 +406,5 @@ def test_ban_versions():
 
 
 def test_coin_class_provided():
-    e = Env(lib_coins.BitcoinSV)
-    assert e.coin == lib_coins.BitcoinSV
+    e = Env(lib_coins.Novo)
+    assert e.coin == lib_coins.Novo
@@ -0,0 +1,141 @@
+import os
+from random import randrange
+
+from electrumx.lib.hash import HASHX_LEN
+from electrumx.lib.util import pack_be_uint16, pack_le_uint64
+from electrumx.server.history import History, row_key
+from electrumx.server.storage import Memory
+
+
+def open_history(tmpdir, monkeypatch, utxo_flush_count=0, tx_count=0):
+    monkeypatch.chdir(tmpdir)
+    history = History()
+    history.open_db(Memory, False, utxo_flush_count, tx_count, False)
+    return history
+
+
+def add_history(history, hashX, tx_count=2000):
+    '''Add history of hashX over many flushes, returning its tx_nums.'''
+    tx_nums = []
+    for tx_num in range(tx_count):
+        if randrange(3) == 0:
+            history.add_unflushed([[hashX]], tx_num)
+            tx_nums.append(tx_num)
+        if randrange(50) == 0:
+            history.flush()
+    history.flush()
+    return tx_nums
+
+
+def history_tx_nums(hist):
+    return [int.from_bytes(hist[n: n + 5], 'little') for n in range(0, len(hist), 5)]
+
+
+def history_keys(history):
+    return [key for key, _hist in history.db.iterator()
+            if len(key) != len(b'state\0\0')]
+
+
+def test_rows_keyed_by_last_tx_num(tmpdir, monkeypatch):
+    history = open_history(tmpdir, monkeypatch)
+    hashX = os.urandom(HASHX_LEN)
+    add_history(history, hashX)
+    for key, hist in history.db.iterator(prefix=hashX):
+        assert key == row_key(hashX, hist)
+        assert int.from_bytes(key[HASHX_LEN:], 'big') == history_tx_nums(hist)[-1]
+
+
+def test_get_txnums_reads_slice(tmpdir, monkeypatch):
+    history = open_history(tmpdir, monkeypatch)
+    hashX = os.urandom(HASHX_LEN)
+    tx_nums = add_history(history, hashX)
+    other = os.urandom(HASHX_LEN)
+    add_history(history, other)
+
+    # Count the rows read
+    rows_read = []
+    iterator_from = history.db.iterator_from
+
+    def counting_iterator_from(prefix, start):
+        for key, hist in iterator_from(prefix, start):
+            rows_read.append(key)
+            yield key, hist
+
+    history.db.iterator_from = counting_iterator_from
+    rows = [history_tx_nums(hist) for _key, hist in history.db.iterator(prefix=hashX)]
+    assert len(rows) > 10
+
+    assert list(history.get_txnums(hashX, None)) == tx_nums
+    for _ in range(100):
+        start = randrange(1, 2100)
+        end = randrange(start, 2100)
+        expected = [tx_num for tx_num in tx_nums if start <= tx_num < end]
+        assert list(history.get_txnums(hashX, 3, start=start, end=end)) == expected[:3]
+        rows_read.clear()
+        assert list(history.get_txnums(hashX, None, start=start, end=end)) == expected
+        # Only rows overlapping [start, end), and perhaps the next, are read
+        needed = [row for row in rows if row[-1] >= start and row[0] < end]
+        assert len(needed) <= len(rows_read) <= len(needed) + 1
+
+
+def test_backup_rekeys_truncated_row(tmpdir, monkeypatch):
+    history = open_history(tmpdir, monkeypatch)
+    hashX = os.urandom(HASHX_LEN)
+    tx_nums = add_history(history, hashX)
+
+    for tx_count in (1900, 1500, tx_nums[200] + 1, tx_nums[100]):
+        history.backup([hashX], tx_count)
+        expected = [tx_num for tx_num in tx_nums if tx_num < tx_count]
+        assert list(history.get_txnums(hashX, None)) == expected
+        assert list(history.get_txnums(hashX, None, start=expected[-1])) == expected[-1:]
+        for key, hist in history.db.iterator(prefix=hashX):
+            assert key == row_key(hashX, hist)
+
+
+def test_clear_excess(tmpdir, monkeypatch):
+    history = open_history(tmpdir, monkeypatch)
+    hashXs = [os.urandom(HASHX_LEN) for _ in range(3)]
+    tx_nums = {hashX: add_history(history, hashX) for hashX in hashXs}
+    history.close_db()
+
+    # The UTXO DB was last flushed at tx_count 1000
+    history = open_history(tmpdir, monkeypatch, 1, 1000)
+    assert history.flush_count == 1
+    for hashX in hashXs:
+        expected = [tx_num for tx_num in tx_nums[hashX] if tx_num < 1000]
+        assert list(history.get_txnums(hashX, None)) == expected
+        assert list(history.get_txnums(hashX, None, start=expected[-1])) == expected[-1:]
+
+
+def write_old_history(history, hashX, tx_nums, entry_len):
+    '''Write history rows keyed by flush id as in DB versions 0 and 1.'''
+    with history.db.write_batch() as batch:
+        for flush_id, n in enumerate(range(0, len(tx_nums), 50), start=1):
+            hist = b''.join(pack_le_uint64(tx_num)[:entry_len]
+                            for tx_num in tx_nums[n: n + 50])
+            batch.put(hashX + pack_be_uint16(flush_id), hist)
+
+
+def test_upgrade(tmpdir, monkeypatch):
+    for db_version, entry_len in ((0, 4), (1, 5)):
+        history = open_history(tmpdir.mkdir(f'v{db_version}'), monkeypatch)
+        hashXs = [os.urandom(HASHX_LEN) for _ in range(20)]
+        tx_nums = {hashX: sorted(set(randrange(1 << 32) for _ in range(200)))
+                   for hashX in hashXs}
+        for hashX in hashXs:
+            write_old_history(history, hashX, tx_nums[hashX], entry_len)
+        history.db_version = db_version
+        with history.db.write_batch() as batch:
+            history.write_state(batch)
+        history.close_db()
+
+        history = open_history(os.getcwd(), monkeypatch)
+        assert history.db_version == max(History.DB_VERSIONS)
+        assert history.upgrade_cursor == -1
+        assert len(history_keys(history)) == 20 * 4
+        for hashX in hashXs:
+            for key, hist in history.db.iterator(prefix=hashX):
+                assert key == row_key(hashX, hist)
+            assert list(history.get_txnums(hashX, None)) == tx_nums[hashX]
+            start = tx_nums[hashX][120]
+            assert list(history.get_txnums(hashX, None, start=start)) == tx_nums[hashX][120:]
@@ -1,5 +1,6 @@
 import datetime
 import logging
+import math
 import os
 from collections import defaultdict
 from functools import partial
@@ -9,15 +10,32 @@ import pytest
 from aiorpcx import Event, TaskGroup, sleep, ignore_after
 
 from electrumx.server.mempool import MemPool, MemPoolAPI
-from electrumx.lib.coins import Bitcoin
-from electrumx.lib.hash import HASHX_LEN, hex_str_to_hash, hash_to_hex_str, double_sha256
+from electrumx.lib.coins import Novo
+from electrumx.lib.hash import (
+    HASHX_LEN, hex_str_to_hash, hash_to_hex_str, double_sha256, sha256
+)
 from electrumx.lib.tx import Tx, TxInput, TxOutput
 from electrumx.lib.util import make_logger
 
 
-coin = Bitcoin
+class Coin(Novo):
+
+    @classmethod
+    def hashX_from_script(cls, script):
+        return sha256(script)[:HASHX_LEN]
+
+    @classmethod
+    def hash160_to_P2PKH_script(cls, hash160):
+        return b'\x76\xa9\x14' + hash160 + b'\x88\xac'
+
+    @classmethod
+    def hash160_to_P2PKH_hashX(cls, hash160):
+        return cls.hashX_from_script(cls.hash160_to_P2PKH_script(hash160))
+
+
+coin = Coin
 # Change seed daily
-seed(datetime.date.today().toordinal)
+seed(datetime.date.today().toordinal())
 
 
 def random_tx(hash160s, utxos):
@@ -63,6 +81,7 @@ class API(MemPoolAPI):
     def __init__(self):
         self._height = 0
         self._cached_height = self._db_height = self._height
+        self._db_tip = bytes(32)
         # Create a pool of hash160s.  Map them to their script hashes
         # Create a bunch of UTXOs paying to those script hashes
         # Create a bunch of TXs that spend from the UTXO set and create
@@ -205,6 +224,9 @@ class API(MemPoolAPI):
     def db_height(self):
         return self._db_height
 
+    def db_tip(self):
+        return self._db_tip
+
     def cached_height(self):
         return self._cached_height
 
@@ -321,7 +343,7 @@ async def test_potential_spends():
     spends = api.spends()
     for hashX in api.hashXs:
         ps = await mempool.potential_spends(hashX)
-        assert all(spend in ps for spend in spends[hashX])
+        assert ps == set(spends[hashX])
 
 
 async def _test_summaries(mempool, api):
@@ -398,6 +420,17 @@ async def test_mempool_removals():
         await _test_summaries(mempool, api)
         # Removed hashXs should have key destroyed
         assert all(mempool.hashXs.values())
+        assert set(mempool.deltas) == set(mempool.hashXs)
+        assert set(mempool.utxos) <= set(mempool.hashXs)
+        assert set(mempool.spends) <= set(mempool.hashXs)
+        deltas = api.balance_deltas()
+        utxos = api.UTXOs()
+        spends = api.spends()
+        for hashX in api.hashXs:
+            assert await mempool.balance_delta(hashX) == deltas.get(hashX, 0)
+            assert (set(await mempool.unordered_UTXOs(hashX))
+                    == set(utxos.get(hashX, [])))
+            assert await mempool.potential_spends(hashX) == set(spends.get(hashX, []))
         # Remove the rest
         api.txs.clear()
         api.raw_txs.clear()
@@ -405,6 +438,11 @@ async def test_mempool_removals():
         await _test_summaries(mempool, api)
         assert not mempool.hashXs
         assert not mempool.txs
+        assert not mempool.deltas
+        assert not mempool.utxos
+        assert not mempool.spends
+        assert not mempool.summaries
+        assert not mempool.children
         await group.cancel_remaining()
 
 
@@ -489,9 +527,44 @@ async def test_notifications(caplog):
         touched, height = api.on_mempool_calls[2]
         assert height == api._db_height == new_height
         assert touched == first_touched
+        # Spends of the confirmed txs no longer have unconfirmed inputs
+        await _test_summaries(mempool, api)
+        deltas = api.balance_deltas()
+        for hashX in api.hashXs:
+            assert await mempool.balance_delta(hashX) == deltas.get(hashX, 0)
         await group.cancel_remaining()
 
 
+@pytest.mark.asyncio
+async def test_deep_chain(caplog):
+    api = API()
+    api.initialize(mempool_size=0)
+    hash160s = [os.urandom(20) for n in range(10)]
+    api.hashXs = [coin.hash160_to_P2PKH_hashX(hash160) for hash160 in hash160s]
+    # A chain of txs each spending only outputs of the one before
+    utxos = dict([next(iter(api.db_utxos.items()))])
+    for n in range(1000):
+        tx, tx_hash, raw_tx = random_tx(hash160s, utxos)
+        utxos = {prevout: utxo for prevout, utxo in utxos.items() if prevout[0] == tx_hash}
+        api.raw_txs[tx_hash] = raw_tx
+        api.txs[tx_hash] = tx
+    # Children before parents, and across fetch chunks
+    api.txs = dict(reversed(api.txs.items()))
+    mempool = MemPool(coin, api)
+    event = Event()
+    with caplog.at_level(logging.INFO):
+        async with TaskGroup() as group:
+            await group.spawn(mempool.keep_synchronized, event)
+            await event.wait()
+            await group.cancel_remaining()
+
+    assert not in_caplog(caplog, 'txs dropped')
+    assert set(mempool.txs) == set(api.txs)
+    deltas = api.balance_deltas()
+    for hashX in api.hashXs:
+        assert await mempool.balance_delta(hashX) == deltas.get(hashX, 0)
+
+
 @pytest.mark.asyncio
 async def test_dropped_txs(caplog):
     api = API()
@@ -510,3 +583,188 @@ async def test_dropped_txs(caplog):
             await group.cancel_remaining()
 
     assert in_caplog(caplog, 'txs dropped')
+
+
+class CountingAPI(API):
+
+    def __init__(self):
+        super().__init__()
+        self.mempool_hashes_calls = 0
+        self.raw_transactions_calls = 0
+
+    async def mempool_hashes(self):
+        self.mempool_hashes_calls += 1
+        return await super().mempool_hashes()
+
+    async def raw_transactions(self, hex_hashes):
+        self.raw_transactions_calls += 1
+        return await super().raw_transactions(hex_hashes)
+
+
+@pytest.mark.asyncio
+async def test_pushed_notifications():
+    api = CountingAPI()
+    api.initialize()
+    mempool = MemPool(coin, api, log_status_secs=0, resync_secs=60)
+    event = Event()
+
+    raw_txs = api.raw_txs.copy()
+    txs = api.txs.copy()
+    n = len(api.ordered_adds) // 2
+    first_hashes = api.ordered_adds[:n]
+    second_hashes = api.ordered_adds[n:]
+    api.raw_txs = {hash: raw_txs[hash] for hash in first_hashes}
+    api.txs = {hash: txs[hash] for hash in first_hashes}
+
+    async with TaskGroup() as group:
+        await group.spawn(mempool.keep_synchronized, event)
+        # Starts with a full resync
+        await event.wait()
+        assert set(mempool.txs) == set(first_hashes)
+        assert api.mempool_hashes_calls == 1
+        fetches = api.raw_transactions_calls
+
+        # Pushed raw txs are not fetched and don't prompt a resync
+        api.raw_txs, api.txs = raw_txs, txs
+        for tx_hash in second_hashes:
+            mempool.notify_tx(tx_hash, raw_txs[tx_hash])
+        await event.wait()
+        assert set(mempool.txs) == set(raw_txs)
+        assert api.mempool_hashes_calls == 1
+        assert api.raw_transactions_calls == fetches
+        touched, height = api.on_mempool_calls[-1]
+        assert touched == api.touched(second_hashes)
+
+        # A pushed hash alone is fetched
+        tx_hash = second_hashes[-1]
+        mempool.notify_tx_removed(tx_hash)
+        await event.wait()
+        assert tx_hash not in mempool.txs
+        mempool.notify_tx(tx_hash)
+        await event.wait()
+        assert tx_hash in mempool.txs
+        assert api.raw_transactions_calls == fetches + 1
+        assert api.mempool_hashes_calls == 1
+
+        # A block prompts a resync
+        mempool.notify_block()
+        await event.wait()
+        assert api.mempool_hashes_calls == 2
+        assert set(mempool.txs) == set(raw_txs)
+        await group.cancel_remaining()
+
+    deltas = api.balance_deltas()
+    for hashX in api.hashXs:
+        assert await mempool.balance_delta(hashX) == deltas.get(hashX, 0)
+
+
+def test_compress_histogram():
+    histogram = {10.0: 60, 5.0: 30, 2.5: 400, 1.0: 150, 0.5: 20}
+    compact = MemPool._compress_histogram(histogram, bin_size=100)
+    # The lump at 2.5 closes the tranche before it; the last tranche is
+    # below the bin size
+    assert compact == [(5.0, 90), (2.5, 400), (1.0, 150)]
+    assert MemPool._compress_histogram({}, bin_size=100) == []
+
+
+@pytest.mark.asyncio
+async def test_fee_histogram():
+    api = API()
+    api.initialize(mempool_size=200)
+    mempool = MemPool(coin, api, refresh_secs=0.01)
+    event = Event()
+
+    def expected_histogram():
+        histogram = defaultdict(int)
+        for tx in mempool.txs.values():
+            histogram[math.floor(10 * tx.fee / tx.size) / 10] += tx.size
+        return MemPool._compress_histogram(histogram, bin_size=2_000)
+
+    async with TaskGroup() as group:
+        await group.spawn(mempool.keep_synchronized, event)
+        await event.wait()
+        assert sum(mempool.fee_histogram.values()) == sum(tx.size for tx in mempool.txs.values())
+        mempool._update_compact_histogram(bin_size=2_000)
+        histogram = await mempool.compact_fee_histogram()
+        assert histogram
+        assert histogram == expected_histogram()
+
+        # Remove half the txs
+        for tx_hash in api.ordered_adds[len(api.ordered_adds) // 2:]:
+            del api.txs[tx_hash]
+            del api.raw_txs[tx_hash]
+        await event.wait()
+        mempool._update_compact_histogram(bin_size=2_000)
+        assert await mempool.compact_fee_histogram() == expected_histogram()
+
+        # And the rest
+        api.txs.clear()
+        api.raw_txs.clear()
+        await event.wait()
+        assert not mempool.fee_histogram
+        assert await mempool.compact_fee_histogram() == []
+        await group.cancel_remaining()
+
+
+@pytest.mark.asyncio
+async def test_snapshot(tmpdir):
+    api = CountingAPI()
+    api.initialize()
+    snapshot_path = os.path.join(tmpdir, 'mempool')
+    # Remove a tx no other spends, and add the last
+    spent = set(prev_hash for prev_hash, _prev_idx in api.mempool_spends())
+    added = api.ordered_adds[-1]
+    removed = next(tx_hash for tx_hash in api.ordered_adds[:-1] if tx_hash not in spent)
+    raw_added, tx_added = api.raw_txs.pop(added), api.txs.pop(added)
+
+    async def sync(mempool):
+        event = Event()
+        async with TaskGroup() as group:
+            await group.spawn(mempool.keep_synchronized, event)
+            await event.wait()
+            await group.cancel_remaining()
+
+    # Nothing is saved before the mempool is synchronized
+    mempool = MemPool(coin, api, snapshot_path=snapshot_path)
+    mempool.save_snapshot()
+    assert not os.path.exists(snapshot_path)
+    await sync(mempool)
+    assert os.path.exists(snapshot_path)
+
+    # Reload it and reconcile with a changed daemon mempool
+    del api.txs[removed]
+    del api.raw_txs[removed]
+    api.raw_txs[added], api.txs[added] = raw_added, tx_added
+    api.raw_transactions_calls = 0
+    mempool = MemPool(coin, api, snapshot_path=snapshot_path)
+    await sync(mempool)
+    assert set(mempool.txs) == set(api.txs)
+    # Only the new tx is fetched
+    assert api.raw_transactions_calls == 1
+    await _test_summaries(mempool, api)
+    deltas = api.balance_deltas()
+    for hashX in api.hashXs:
+        assert await mempool.balance_delta(hashX) == deltas.get(hashX, 0)
+
+    # A snapshot from another height is ignored
+    api._height = api._db_height = api._cached_height = 1
+    api.raw_transactions_calls = 0
+    mempool = MemPool(coin, api, snapshot_path=snapshot_path)
+    await sync(mempool)
+    assert set(mempool.txs) == set(api.txs)
+    assert api.raw_transactions_calls == 1
+
+    # As is one from another block at the same height
+    api._db_tip = os.urandom(32)
+    api.raw_transactions_calls = 0
+    mempool = MemPool(coin, api, snapshot_path=snapshot_path)
+    await sync(mempool)
+    assert set(mempool.txs) == set(api.txs)
+    assert api.raw_transactions_calls == 1
+
+    # As is a corrupt one
+    with open(snapshot_path, 'r+b') as f:
+        f.truncate(100)
+    mempool = MemPool(coin, api, snapshot_path=snapshot_path)
+    await sync(mempool)
+    assert set(mempool.txs) == set(api.txs)
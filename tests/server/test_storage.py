@@ -41,6 +41,16 @@ def test_batch(db):
     assert db.get(b"a") == b"2"
 
 
+def test_batch_exception(db):
+    db.put(b"a", b"1")
+    with pytest.raises(ValueError):
+        with db.write_batch() as b:
+            b.put(b"a", b"2")
+            b.delete(b"a")
+            raise ValueError
+    assert db.get(b"a") == b"1"
+
+
 def test_iterator(db):
     """
     The iterator should contain all key/value pairs starting with prefix
@@ -68,6 +78,37 @@ def test_iterator_reverse(db):
         ]
 
 
+def test_iterator_from(db):
+    for i in range(5):
+        db.put(b"abc" + str.encode(str(i)), str.encode(str(i)))
+    db.put(b"a", b"xyz")
+    db.put(b"abd", b"x")
+    assert list(db.iterator_from(b"abc", b"abc2")) == [
+            (b"abc" + str.encode(str(i)), str.encode(str(i))) for
+            i in range(2, 5)
+        ]
+    assert list(db.iterator_from(b"abc", b"a")) == list(db.iterator(prefix=b"abc"))
+    assert not list(db.iterator_from(b"abc", b"abc9"))
+    assert not list(db.iterator_from(b"abc", b"b"))
+
+
+def test_iterator_delete_put(db):
+    for i in range(3):
+        db.put(b"abc" + str.encode(str(i)), str.encode(str(i)))
+    assert len(list(db.iterator(prefix=b"abc"))) == 3
+    # Delete and put again before the next iteration
+    with db.write_batch() as b:
+        b.delete(b"abc1")
+    db.put(b"abc1", b"x")
+    with db.write_batch() as b:
+        b.delete(b"abc2")
+        b.put(b"abc2", b"y")
+    assert list(db.iterator(prefix=b"abc")) == [
+        (b"abc0", b"0"), (b"abc1", b"x"), (b"abc2", b"y")]
+    assert list(db.iterator(prefix=b"abc", reverse=True)) == [
+        (b"abc2", b"y"), (b"abc1", b"x"), (b"abc0", b"0")]
+
+
 def test_close(db):
     db.put(b"a", b"b")
     db.close()
@@ -0,0 +1,90 @@
+import os
+from random import choice, randrange
+
+import pytest
+
+from electrumx.server.utxo_cache import UTXOCache
+
+
+def random_key():
+    return os.urandom(36)
+
+
+def random_value():
+    return os.urandom(24)
+
+
+def test_basic():
+    cache = UTXOCache()
+    assert not cache
+    key, value = random_key(), random_value()
+    assert cache.get(key) is None
+    assert cache.pop(key, None) is None
+    with pytest.raises(KeyError):
+        cache.pop(key)
+    with pytest.raises(KeyError):
+        cache[key]
+
+    cache[key] = value
+    assert cache
+    assert len(cache) == 1
+    assert key in cache
+    assert cache[key] == cache.get(key) == value
+    assert list(cache.items()) == [(key, value)]
+    assert list(cache) == [key]
+
+    value2 = random_value()
+    cache[key] = value2
+    assert len(cache) == 1
+    assert cache[key] == value2
+
+    assert cache.pop(key) == value2
+    assert key not in cache
+    assert not cache
+
+
+def test_bad_lengths():
+    cache = UTXOCache()
+    with pytest.raises(AssertionError):
+        cache[random_key()] = bytes(23)
+    with pytest.raises(AssertionError):
+        cache[bytes(35)] = random_value()
+
+
+def test_against_dict():
+    cache = UTXOCache()
+    mirror = {}
+    keys = []
+    for n in range(20000):
+        op = randrange(10)
+        if op < 6 or not keys:
+            key = random_key()
+            keys.append(key)
+            value = random_value()
+            cache[key] = value
+            mirror[key] = value
+        elif op < 7:
+            key = choice(keys)
+            value = random_value()
+            cache[key] = value
+            mirror[key] = value
+        else:
+            key = choice(keys)
+            assert cache.pop(key, None) == mirror.pop(key, None)
+        assert len(cache) == len(mirror)
+
+    assert dict(cache.items()) == mirror
+    for key in keys:
+        assert cache.get(key) == mirror.get(key)
+    cache.clear()
+    assert not cache
+    assert not list(cache.items())
+
+
+def test_memsize():
+    cache = UTXOCache()
+    count = 100000
+    for n in range(count):
+        cache[random_key()] = random_value()
+    # Within 1.5 times the raw payload
+    assert cache.memsize() < count * 60 * 1.5
@@ -0,0 +1,103 @@
+import os
+import sys
+
+import pytest
+from aiorpcx import TaskGroup, sleep
+
+from electrumx.lib.coins import Novo
+from electrumx.lib.hash import double_sha256
+from electrumx.lib.tx import Tx, TxInput, TxOutput
+from electrumx.server.zmq_subscriber import ZMQSubscriber
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def notify_tx(self, tx_hash, raw_tx=None):
+        self.calls.append(('tx', tx_hash, raw_tx))
+
+    def notify_tx_removed(self, tx_hash):
+        self.calls.append(('removed', tx_hash))
+
+    def notify_block(self):
+        self.calls.append(('block', ))
+
+
+def raw_tx():
+    tx = Tx(1, [TxInput(os.urandom(32), 0, b'', 0xffffffff)],
+            [TxOutput(1000, b'\x76\xa9\x14' + os.urandom(20) + b'\x88\xac')], 0)
+    raw = tx.serialize()
+    return raw, double_sha256(raw)
+
+
+def subscriber():
+    return ZMQSubscriber(['tcp://127.0.0.1:1'], Novo, Recorder(), Recorder())
+
+
+def test_on_message():
+    sub = subscriber()
+    tx_hash = os.urandom(32)
+    sub.on_message(b'hashtx', tx_hash[::-1])
+    raw, raw_hash = raw_tx()
+    sub.on_message(b'rawtx', raw)
+    sub.on_message(b'hashblock', os.urandom(32))
+    assert sub.mempool.calls == [('tx', tx_hash, None), ('tx', raw_hash, raw), ('block', )]
+    assert sub.prefetcher.calls == [('block', )]
+
+
+def test_sequence():
+    sub = subscriber()
+    tx_hash = os.urandom(32)
+    sequence = (5).to_bytes(8, 'little')
+    sub.on_message(b'sequence', tx_hash[::-1] + b'A' + sequence)
+    sub.on_message(b'sequence', tx_hash[::-1] + b'R' + sequence)
+    sub.on_message(b'sequence', os.urandom(32) + b'C')
+    sub.on_message(b'sequence', os.urandom(32) + b'D')
+    assert sub.mempool.calls == [('tx', tx_hash, None), ('removed', tx_hash),
+                                 ('block', ), ('block', )]
+    assert sub.prefetcher.calls == [('block', ), ('block', )]
+
+
+def test_import_module(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'zmq', None)
+    with pytest.raises(ImportError):
+        ZMQSubscriber.import_module()
+
+
+@pytest.mark.asyncio
+async def test_run():
+    zmq = pytest.importorskip('zmq')
+    pytest.importorskip('zmq.asyncio')
+
+    context = zmq.Context()
+    publisher = context.socket(zmq.PUB)
+    port = publisher.bind_to_random_port('tcp://127.0.0.1')
+    sub = subscriber()
+    sub.urls = [f'tcp://127.0.0.1:{port}']
+    tx_hash = os.urandom(32)
+    try:
+        async with TaskGroup() as group:
+            await group.spawn(sub.run())
+            # Subscriptions take a moment to reach the publisher
+            for _ in range(200):
+                publisher.send_multipart([b'hashtx', tx_hash[::-1], bytes(4)])
+                await sleep(0.01)
+                if sub.mempool.calls:
+                    break
+            publisher.send_multipart([b'bogus', b'', bytes(4)])
+            publisher.send_multipart([b'rawtx', b'junk', bytes(4)])
+            publisher.send_multipart([b'hashblock', os.urandom(32), bytes(4)])
+            for _ in range(200):
+                await sleep(0.01)
+                if sub.prefetcher.calls:
+                    break
+            await group.cancel_remaining()
+    finally:
+        publisher.close(linger=0)
+        context.term()
+
+    assert sub.mempool.calls[0] == ('tx', tx_hash, None)
+    assert sub.mempool.calls[-1] == ('block', )
+    assert sub.prefetcher.calls == [('block', )]